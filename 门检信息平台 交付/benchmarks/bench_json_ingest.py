@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+JSON 文件导入基准测试（编码检测 + 控制字符清理）
+
+生成指定大小的 UTF-8 / GBK 合成聊天导出文件（"var page = " 包装、带缩进和换行），报告：
+  - 原实现：整个文件读入后按 JSON_ENCODINGS 依次整体试解码，再对全文 re.sub 去控制字符
+    （默认不含 json.loads；--legacy-parse 时包含，1 GB 文件需要 6 GB 以上内存）
+  - 编码检测：逐块试解码整个文件 vs detect_file_encoding 抽样检测
+  - 解码 + 清理：逐块解码后用正则删除控制字符 vs iter_json_text（解码前 bytes.translate 按字节删除）
+  - 流式导入：iter_json_records 解析出全部条目的总耗时
+
+用法: python benchmarks/bench_json_ingest.py --size-mb 1024 --encodings utf-8 gbk
+"""
+import argparse
+import codecs
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import (CONTROL_CHARS, JSON_ENCODINGS, STREAM_READ_BYTES, detect_file_encoding,  # noqa: E402
+                  iter_json_records, iter_json_text)
+
+PHRASES = ['今天下午三点在老地方见面', '记得带上合同和发票', '货已经发出，注意查收', '收到，明天转账',
+           '这个账号别再用了', '电话打不通，微信联系', '好的', '在吗？']
+
+
+def write_export(path, size_mb, encoding, seed):
+    # 合成导出文件：缩进格式的消息列表，直到文件达到 size_mb
+    rng = random.Random(seed)
+    target = size_mb << 20
+    with open(path, 'wb') as f:
+        f.write('var page = {\n  "type": 1,\n  "parents": [["微信", "聊天记录"]],\n  "contents": [\n'.encode(encoding))
+        written, i = 0, 0
+        while written < target:
+            entries = []
+            for _ in range(2000):
+                entries.append(json.dumps({
+                    'id': f'm{i}', 'user_name': rng.choice(['张三', '李四', '王五']),
+                    'content': {'text': '，'.join(rng.choice(PHRASES) for _ in range(rng.randint(1, 6)))},
+                    'time': f'2023-01-{i % 28 + 1:02d} 10:00:00', 'position': i % 2,
+                }, ensure_ascii=False, indent=2).replace('\n', '\n    '))
+                i += 1
+            block = ('    ' + ',\n    '.join(entries) + ',\n').encode(encoding)
+            f.write(block)
+            written += len(block)
+        f.write(('    {"id": "end", "content": {"text": "结束"}}\n  ]\n};\n').encode(encoding))
+    return i + 1
+
+
+def legacy_load(path, parse):
+    # 原实现：整体读入，依次整体试解码，全文正则清理，去包装后 json.loads
+    with open(path, 'rb') as f:
+        raw_content = f.read()
+    if raw_content.startswith(b'\xef\xbb\xbf'):
+        raw_content = raw_content[3:]
+    content = None
+    for encoding in ['utf-8', 'utf-16', 'gbk', 'gb18030', 'latin-1']:
+        try:
+            content = raw_content.decode(encoding)
+            content = re.sub(r'[\x00-\x1F\x7F-\x9F]', '', content)
+            break
+        except UnicodeDecodeError:
+            continue
+    del raw_content
+    content = content.strip()
+    if content.startswith('var page = '):
+        content = content[len('var page = '):]
+    if content.endswith(';'):
+        content = content[:-1].strip()
+    return len(json.loads(content)['contents']) if parse else len(content)
+
+
+def full_detect(path):
+    # 逐块试解码整个文件，返回第一个能完整解码的编码
+    for encoding in JSON_ENCODINGS:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(STREAM_READ_BYTES), b''):
+                    decoder.decode(block)
+            decoder.decode(b'', final=True)
+            return encoding
+        except UnicodeError:
+            continue
+    return None
+
+
+def regex_text(path, encoding):
+    # 逐块解码后用正则删除控制字符
+    decoder = codecs.getincrementaldecoder(encoding)()
+    total = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(STREAM_READ_BYTES), b''):
+            total += len(CONTROL_CHARS.sub('', decoder.decode(block)))
+    return total
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--encodings', nargs='+', default=['utf-8', 'gbk'])
+    parser.add_argument('--dir', default=tempfile.gettempdir(), help='生成测试文件的目录')
+    parser.add_argument('--skip-legacy', action='store_true', help='不运行原实现（需要数倍于文件大小的内存）')
+    parser.add_argument('--legacy-parse', action='store_true', help='原实现包含 json.loads')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    for encoding in args.encodings:
+        path = os.path.join(args.dir, f'bench_ingest_{encoding}.json')
+        start = time.perf_counter()
+        entries = write_export(path, args.size_mb, encoding, args.seed)
+        size_mb = os.path.getsize(path) / (1 << 20)
+        print(f"\n{encoding}: {size_mb:.0f} MB, {entries} 条消息, 生成 {time.perf_counter() - start:.1f}s")
+        print(f"{'步骤':<28}{'耗时(s)':>10}{'MB/s':>10}")
+
+        def report(name, seconds):
+            print(f"{name:<28}{seconds:>10.2f}{size_mb / max(seconds, 1e-6):>10.0f}")
+
+        try:
+            if not args.skip_legacy:
+                seconds, _ = timed(legacy_load, path, args.legacy_parse)
+                report('原实现' + ('(含 json.loads)' if args.legacy_parse else '(读入+试解码+正则)'), seconds)
+            seconds, detected = timed(full_detect, path)
+            report(f'检测: 全文件试解码 -> {detected}', seconds)
+            seconds, detected = timed(detect_file_encoding, path)
+            report(f'检测: 抽样 -> {detected}', seconds)
+            seconds, regex_chars = timed(regex_text, path, detected)
+            report('解码+清理: 正则', seconds)
+            seconds, chars = timed(lambda: sum(len(text) for text in iter_json_text(path, detected)))
+            report('解码+清理: bytes.translate', seconds)
+            assert chars == regex_chars, (chars, regex_chars)
+            seconds, parsed = timed(lambda: sum(len(data['contents']) for data in iter_json_records(path, detected)))
+            report('流式导入(检测后,含解析)', seconds)
+            assert parsed == entries, (parsed, entries)
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+关键词搜索动态剪枝基准测试
+
+在 Zipf 分布的合成语料上比较 BM25.search（全量打分）与
+BM25.search_pruned（block-max 动态剪枝）对高频词 / 低频词查询的延迟。
+
+用法: python benchmarks/bench_keyword_pruning.py --docs 1000000 --top-n 500
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import BM25  # noqa: E402
+
+
+def build_corpus(num_docs, vocab_size, avg_len, seed):
+    # 合成语料：词频服从 Zipf 分布，文档长度服从泊松分布
+    rng = np.random.default_rng(seed)
+    probs = 1.0 / np.arange(1, vocab_size + 1)
+    probs /= probs.sum()
+    lengths = rng.poisson(avg_len, size=num_docs)
+    tokens = rng.choice(vocab_size, size=int(lengths.sum()), p=probs)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    words = [f"w{i}" for i in range(vocab_size)]
+    return [[words[t] for t in tokens[offsets[i]:offsets[i + 1]]] for i in range(num_docs)]
+
+
+def time_query(func, query, top_n, repeat):
+    # 返回多次执行的中位延迟（毫秒）和最后一次结果
+    timings, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(query, top_n=top_n)
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings)), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=200000)
+    parser.add_argument('--vocab', type=int, default=50000)
+    parser.add_argument('--avg-len', type=int, default=12)
+    parser.add_argument('--top-n', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    corpus = build_corpus(args.docs, args.vocab, args.avg_len, args.seed)
+    bm25 = BM25(corpus)
+    print(f"语料: {args.docs} 文档, 词表 {args.vocab}, 建索引 {time.perf_counter() - start:.1f}s")
+
+    queries = {
+        'head (单个高频词)': ['w0'],
+        'head (两个高频词)': ['w0', 'w1'],
+        'head + tail': ['w0', 'w2000'],
+        'mid': ['w200', 'w300'],
+        'tail (低频词)': ['w20000', 'w30000'],
+    }
+    print(f"{'查询':<20}{'df':>12}{'全量(ms)':>12}{'剪枝(ms)':>12}{'加速':>8}")
+    for name, query in queries.items():
+        df = sum(int(bm25.df[bm25.vocabulary[w]]) for w in query if w in bm25.vocabulary)
+        bm25._bound_cache.clear()
+        bm25.search_pruned(query, top_n=args.top_n)  # 预热块上界缓存
+        full_ms, full = time_query(bm25.search, query, args.top_n, args.repeat)
+        pruned_ms, pruned = time_query(bm25.search_pruned, query, args.top_n, args.repeat)
+        assert full == pruned, f"剪枝结果与全量结果不一致: {query}"
+        print(f"{name:<20}{df:>12}{full_ms:>12.2f}{pruned_ms:>12.2f}{full_ms / max(pruned_ms, 1e-6):>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
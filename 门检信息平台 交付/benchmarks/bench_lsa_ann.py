@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+LSA 近似最近邻语义索引基准测试
+
+在带主题结构的合成语料上构建 LSAIndex（TruncatedSVD + IVF，可选 PQ），报告：
+  - 构建耗时
+  - 不同探测列表数（--probes）下的查询延迟（中位数 / p95）
+  - recall@k：与同一 LSA 向量上的精确（暴力）搜索相比的召回率
+
+用法: python benchmarks/bench_lsa_ann.py --docs 1000000 --dims 256 --probes 8 16 32 --pq 0 32
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfTransformer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import LSAIndex, rank_top_k  # noqa: E402
+
+
+def build_corpus(num_docs, vocab_size, num_topics, avg_len, seed):
+    # 合成语料：每个主题偏好词表中的一小部分词，文档由一个主题的词和 Zipf 背景词混合而成
+    rng = np.random.default_rng(seed)
+    topic_words = rng.choice(vocab_size, size=(num_topics, 300))
+    background = 1.0 / np.arange(1, vocab_size + 1)
+    background /= background.sum()
+    lengths = np.maximum(rng.poisson(avg_len, size=num_docs), 1)
+    total = int(lengths.sum())
+    doc_topics = rng.integers(num_topics, size=num_docs)
+    from_topic = rng.random(total) < 0.7
+    terms = rng.choice(vocab_size, size=total, p=background)
+    token_topics = np.repeat(doc_topics, lengths)
+    terms[from_topic] = topic_words[token_topics[from_topic], rng.integers(300, size=int(from_topic.sum()))]
+    rows = np.repeat(np.arange(num_docs, dtype=np.int32), lengths)
+    tf = csr_matrix((np.ones(total, dtype=np.float32), (rows, terms.astype(np.int32))), shape=(num_docs, vocab_size))
+    tf.sum_duplicates()
+    return tf, topic_words
+
+
+def build_queries(transformer, topic_words, vocab_size, num_queries, seed):
+    # 查询：从某个主题中取 1~3 个词
+    rng = np.random.default_rng(seed + 1)
+    queries = []
+    for _ in range(num_queries):
+        terms = rng.choice(topic_words[rng.integers(len(topic_words))], size=rng.integers(1, 4), replace=False)
+        counts = csr_matrix((np.ones(len(terms)), (np.zeros(len(terms), dtype=np.int32), terms)), shape=(1, vocab_size))
+        queries.append(transformer.transform(counts))
+    return queries
+
+
+def exact_search(doc_vectors, index, query, top_n):
+    # 精确搜索：对全部 LSA 向量暴力计算内积
+    vector = index.project(query)[0]
+    return rank_top_k(np.arange(len(doc_vectors)), (doc_vectors @ vector).astype(np.float64), top_n)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=200000)
+    parser.add_argument('--vocab', type=int, default=50000)
+    parser.add_argument('--topics', type=int, default=200)
+    parser.add_argument('--avg-len', type=int, default=12)
+    parser.add_argument('--dims', type=int, default=256)
+    parser.add_argument('--lists', type=int, default=0)
+    parser.add_argument('--probes', type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument('--pq', type=int, nargs='+', default=[0], help='PQ 子向量数，0 表示不量化')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-n', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    tf, topic_words = build_corpus(args.docs, args.vocab, args.topics, args.avg_len, args.seed)
+    transformer = TfidfTransformer().fit(tf)
+    tfidf = transformer.transform(tf).astype(np.float32).tocsc()
+    queries = build_queries(transformer, topic_words, args.vocab, args.queries, args.seed)
+    print(f"语料: {args.docs} 文档, 词表 {args.vocab}, 非零元 {tf.nnz}, 生成 {time.perf_counter() - start:.1f}s")
+
+    for pq in args.pq:
+        start = time.perf_counter()
+        index = LSAIndex.build(tfidf, dimensions=args.dims, n_lists=args.lists, pq_subvectors=pq, seed=args.seed)
+        build_s = time.perf_counter() - start
+        payload = index.codes if index.codes is not None else index.vectors
+        print(f"\n{'PQ ' + str(pq) + ' 子向量' if pq else 'float32 原始向量'}: 维数 {index.projection.shape[1]}, "
+              f"列表 {len(index.centroids)}, 构建 {build_s:.1f}s, 向量存储 {payload.nbytes >> 20} MB")
+
+        doc_vectors = index.project(tfidf)
+        exact_ms, truth = [], []
+        for query in queries:
+            t0 = time.perf_counter()
+            truth.append({doc for doc, _ in exact_search(doc_vectors, index, query, args.top_n)})
+            exact_ms.append((time.perf_counter() - t0) * 1000)
+        del doc_vectors
+        print(f"{'探测列表':<10}{'中位(ms)':>10}{'p95(ms)':>10}{f'recall@{args.top_n}':>12}")
+        print(f"{'精确':<12}{np.median(exact_ms):>10.2f}{np.percentile(exact_ms, 95):>10.2f}{1.0:>12.3f}")
+        for n_probe in args.probes:
+            timings, recalls = [], []
+            for query, expected in zip(queries, truth):
+                t0 = time.perf_counter()
+                found = index.search(query, top_n=args.top_n, n_probe=n_probe)
+                timings.append((time.perf_counter() - t0) * 1000)
+                if expected:
+                    recalls.append(len(expected & {doc for doc, _ in found}) / len(expected))
+            print(f"{n_probe:<14}{np.median(timings):>10.2f}{np.percentile(timings, 95):>10.2f}{np.mean(recalls):>12.3f}")
+
+
+if __name__ == '__main__':
+    main()
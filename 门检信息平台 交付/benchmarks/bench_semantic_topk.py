@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+语义搜索稀疏 top-k 基准测试
+
+在 Zipf 分布的合成 TF-IDF 矩阵上比较原来的做法（cosine_similarity 全量计算 +
+np.argsort）与 tfidf_top_k（只对含查询词的文档累加 + argpartition）的延迟，
+并检查两者结果一致。
+
+用法: python benchmarks/bench_semantic_topk.py --docs 1000000 10000000 --top-n 500
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.metrics.pairwise import cosine_similarity
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import tfidf_top_k  # noqa: E402
+
+
+def build_tf_matrix(num_docs, vocab_size, avg_len, seed):
+    # 合成词频矩阵：词频服从 Zipf 分布，文档长度服从泊松分布（直接生成 CSR，不经过分词）
+    rng = np.random.default_rng(seed)
+    probs = 1.0 / np.arange(1, vocab_size + 1)
+    probs /= probs.sum()
+    lengths = rng.poisson(avg_len, size=num_docs)
+    terms = rng.choice(vocab_size, size=int(lengths.sum()), p=probs).astype(np.int32)
+    rows = np.repeat(np.arange(num_docs, dtype=np.int32), lengths)
+    tf = csr_matrix((np.ones(len(terms), dtype=np.float32), (rows, terms)), shape=(num_docs, vocab_size))
+    tf.sum_duplicates()
+    return tf
+
+
+def query_vector(transformer, vocab_size, terms):
+    counts = csr_matrix((np.ones(len(terms)), (np.zeros(len(terms), dtype=np.int32), terms)), shape=(1, vocab_size))
+    return transformer.transform(counts)
+
+
+def full_scan(tfidf_csr, vector, top_n):
+    # 原实现：全量余弦相似度 + 全排序
+    similarities = cosine_similarity(vector, tfidf_csr).flatten()
+    top = np.argsort(similarities)[::-1][:top_n]
+    return [(int(i), float(similarities[i])) for i in top if similarities[i] > 0]
+
+
+def time_call(func, repeat):
+    timings, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings)), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, nargs='+', default=[1000000])
+    parser.add_argument('--vocab', type=int, default=200000)
+    parser.add_argument('--avg-len', type=int, default=12)
+    parser.add_argument('--top-n', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skip-full', action='store_true', help='不运行全量基线（文档数很大时内存不足）')
+    args = parser.parse_args()
+
+    queries = {
+        'head (高频词)': [0, 1],
+        'mid': [300, 2000],
+        'tail (低频词)': [50000, 120000],
+    }
+    for num_docs in args.docs:
+        start = time.perf_counter()
+        tf = build_tf_matrix(num_docs, args.vocab, args.avg_len, args.seed)
+        transformer = TfidfTransformer().fit(tf)
+        tfidf_csr = transformer.transform(tf)
+        tfidf_csc = tfidf_csr.astype(np.float32).tocsc()
+        print(f"\n语料: {num_docs} 文档, 词表 {args.vocab}, 非零元 {tf.nnz}, 构建 {time.perf_counter() - start:.1f}s, "
+              f"float32 CSC {tfidf_csc.data.nbytes + tfidf_csc.indices.nbytes + tfidf_csc.indptr.nbytes >> 20} MB")
+        if args.skip_full:
+            del tfidf_csr
+        print(f"{'查询':<16}{'全量(ms)':>12}{'稀疏top-k(ms)':>16}{'加速':>8}")
+        for name, terms in queries.items():
+            vector = query_vector(transformer, args.vocab, terms)
+            sparse_ms, sparse = time_call(lambda: tfidf_top_k(tfidf_csc, vector, args.top_n), args.repeat)
+            if args.skip_full:
+                print(f"{name:<16}{'-':>12}{sparse_ms:>16.2f}{'-':>8}")
+                continue
+            full_ms, full = time_call(lambda: full_scan(tfidf_csr, vector, args.top_n), args.repeat)
+            # 同分文档的先后顺序不同，按分数比较；float32 存储的误差在 1e-6 以内
+            assert len(full) == len(sparse), name
+            assert np.allclose([s for _, s in full], [s for _, s in sparse], atol=1e-6), name
+            print(f"{name:<16}{full_ms:>12.2f}{sparse_ms:>16.2f}{full_ms / max(sparse_ms, 1e-6):>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
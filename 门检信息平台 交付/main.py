@@ -6,13 +6,30 @@ import jieba
 import math
 import numpy as np
 import pandas as pd
-from collections import Counter
+from collections import Counter, OrderedDict
+import hashlib
+import codecs
+import tempfile
+from array import array
+import sqlite3
 import uuid
 import threading
 import shutil
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import pickle
+import copy
+import weakref
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.decomposition import TruncatedSVD
+from scipy.sparse import csr_matrix, csc_matrix, vstack as sparse_vstack
 import re
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+import time
 import datetime
 import logging
 
@@ -30,21 +47,379 @@ app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024 * 1024 # 20GB
 MAX_SEARCH_HISTORY = 100
 FAVORITES_FILE = 'app_data_persistence.json'
 
+# --- 搜索引擎配置 ---
+BM25_MODE = 'postings'  # 'postings' 倒排表逐词累加 | 'matrix' 预计算权重的稀疏矩阵
+INDEX_SNAPSHOT_DIR = 'index_snapshot'  # 索引快照目录，启动时自动加载
+TOKENIZE_WORKERS = 0  # 建索引时的分词进程数，0 表示使用全部 CPU 核，1 表示串行
+PARALLEL_TOKENIZE_MIN_DOCS = 20000  # 文档数低于此值时串行分词（进程池启动开销不划算）
+TOKENIZE_CHUNK_SIZE = 2000  # 每个进程任务的文档数
+TOKEN_CACHE_SIZE = 200000  # 分词缓存（内存 LRU）的最大条目数
+TOKEN_CACHE_FILE = None  # 分词缓存的磁盘层（SQLite 文件路径），None 表示不启用
+SEARCH_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 搜索结果缓存的内存上限（字节）
+SEARCH_RESULT_LIMIT = 500  # 每次搜索排序返回的最大结果数
+SEMANTIC_BACKEND = 'tfidf'  # 'tfidf' 稀疏 TF-IDF 余弦（精确） | 'lsa' LSA 稠密向量 + IVF 近似最近邻
+LSA_DIMENSIONS = 256  # LSA 降维后的维数
+LSA_LISTS = 0  # IVF 倒排列表（聚类）数，0 表示按文档数自动选择
+LSA_PROBES = 16  # 查询时扫描的列表数，越大召回越高、越慢
+LSA_PQ_SUBVECTORS = 0  # 乘积量化的子向量数（每个文档占这么多字节），0 表示保存 float32 原始向量
+LSA_REBUILD_VOCAB_GROWTH = 0.05  # 追加数据后 TF-IDF 词数比 LSA 训练时增长超过此比例则重新训练
+HYBRID_FUSION = 'rrf'  # 综合搜索的融合方式：'rrf' 倒数排名融合 | 'minmax' 分数归一化后相加
+RRF_K = 60  # 倒数排名融合的平滑常数
+HYBRID_SEARCH_WORKERS = 4  # 综合搜索中并发执行关键词检索的线程数
+POSITIONAL_INDEX = True  # 保存词位置（每个词 8 字节），支持 "短语" 和 A NEAR/k B 邻近查询
+TRIGRAM_INDEX = True  # 消息正文的字符三元组索引，支持 type=substring / type=regex 搜索
+TRIGRAM_BUILD_CHUNK = 200000  # 建三元组索引时每批处理的消息数
+PHONE_MIN_DIGITS = 3  # 号码前缀 / 尾号匹配的最少位数，更短的查询只做精确匹配
+
+# --- 文件导入配置 ---
+JSON_ENCODINGS = ['utf-8', 'utf-16', 'gbk', 'gb18030', 'latin-1']  # 按顺序尝试的文件编码
+STREAM_READ_BYTES = 1 << 20  # 流式解析 JSON 文件时每次读入的字节数
+ENCODING_SAMPLE_BYTES = 64 * 1024  # 编码检测时读取的文件头字节数，抽查块也是这么大
+ENCODING_SAMPLE_CHUNKS = 8  # 编码检测时在文件中均匀抽查的块数
+STREAM_BATCH_ENTRIES = 2000  # 每批交给提取函数的 contents 条目数
+INGEST_WORKERS = 0  # 解析文件的进程数，0 表示使用全部 CPU 核，1 表示在后台线程中逐个处理
+PARALLEL_INGEST_MIN_BYTES = 64 * 1024 * 1024  # 一批文件总大小低于此值时逐个处理（进程池启动开销不划算）
+INGEST_CACHE_DIR = 'ingest_cache'  # 按文件内容哈希缓存提取结果的目录，None 表示不启用
+INGEST_CACHE_MAX_BYTES = 8 * 1024 * 1024 * 1024  # 导入缓存的磁盘上限（字节），超出时删除最久未使用的条目
+INGEST_CACHE_VERSION = 2  # 提取逻辑改变时递增，旧的缓存条目作废
+
+# --- 列式消息存储 ---
+def _parse_time(value):
+    # 单个时间值 -> Timestamp（数字按 Unix 秒），无法解析返回 NaT
+    if isinstance(value, (int, float)):
+        try: return pd.to_datetime(value, unit='s')
+        except Exception: return pd.NaT
+    elif isinstance(value, str):
+        try: timestamp = pd.to_datetime(value) # 尝试直接解析
+        except (ValueError, TypeError):
+            for fmt in ('%Y-%m-%d %H:%M:%S', '%Y/%m/%d %H:%M:%S'):
+                try: return pd.Timestamp(datetime.datetime.strptime(value, fmt))
+                except ValueError: pass
+            return pd.NaT
+        return timestamp.tz_localize(None) if timestamp.tzinfo is not None else timestamp
+    return pd.NaT
+
+def parse_message_times(values):
+    """消息时间列 -> datetime64[ns] 数组（整列解析，失败的值再逐个解析）"""
+    series = pd.Series(list(values), dtype=object)
+    times = pd.Series(pd.NaT, index=series.index, dtype='datetime64[ns]')
+    is_str = series.map(lambda v: isinstance(v, str)).astype(bool)
+    if is_str.any():
+        try:
+            times[is_str] = pd.to_datetime(series[is_str], errors='coerce').astype('datetime64[ns]')
+        except (ValueError, TypeError):
+            pass # 格式混杂（如带时区）时整体解析失败，下面逐个解析
+    failed = times.isna() & series.notna()
+    if failed.any():
+        times[failed] = [_parse_time(value) for value in series[failed]]
+    return times.to_numpy(dtype='datetime64[ns]')
+
+
+class TextColumn:
+    # 变长字符串列：所有字符串的 UTF-8 编码首尾相接，第 i 个位于 buffer[offsets[i]:offsets[i+1]]
+    def __init__(self, buffer=None, offsets=None):
+        self.buffer = bytearray() if buffer is None else buffer
+        self.offsets = np.zeros(1, dtype=np.int64) if offsets is None else offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.buffer[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def extend(self, values):
+        encoded = [value.encode('utf-8', errors='replace') for value in values]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        if not isinstance(self.buffer, bytearray):
+            self.buffer = bytearray(self.buffer) # 从快照加载的只读缓冲区，追加前复制
+        self.buffer += b''.join(encoded)
+        self.offsets = np.concatenate((self.offsets, self.offsets[-1] + np.cumsum(lengths)))
+
+    def append_column(self, other):
+        # 整列追加另一个 TextColumn，不逐个解码
+        if not isinstance(self.buffer, bytearray):
+            self.buffer = bytearray(self.buffer)
+        self.buffer += memoryview(other.buffer)[:other.offsets[-1]]
+        self.offsets = np.concatenate((self.offsets, self.offsets[-1] + other.offsets[1:]))
+
+
+class MessageStore:
+    # 列式消息存储：每条消息不再是一个 dict，只在返回给调用方时按行组装
+    #  - 时间 datetime64[ns]（无法解析为 NaT）、是否发送 bool
+    #  - 发送者、来源文件驻留为 int32 ID
+    #  - 消息ID、正文各为一个连续文本缓冲区；消息ID另存 64 位哈希用于按 ID 查找
+    ARRAY_NAMES = ('ids_buffer', 'ids_offsets', 'contents_buffer', 'contents_offsets', 'id_hashes',
+                   'times', 'is_sent', 'sender_ids', 'source_ids')  # 快照中保存的数组
+
+    def __init__(self):
+        self.ids = TextColumn()
+        self.contents = TextColumn()
+        self.id_hashes = np.zeros(0, dtype=np.int64)
+        self.times = np.zeros(0, dtype='datetime64[ns]')
+        self.is_sent = np.zeros(0, dtype=bool)
+        self.sender_ids = np.zeros(0, dtype=np.int32)
+        self.source_ids = np.zeros(0, dtype=np.int32)
+        self.senders = []  # 发送者ID -> 名称
+        self.sources = []  # 来源文件ID -> 文件名
+        self._sender_lookup = {}
+        self._source_lookup = {}
+        self._hash_order = None  # 按哈希排序的行号及排序后的哈希（懒建）
+        self._sorted_hashes = None
+        self._time_order = None  # 按时间降序的行号（懒建）
+        self._time_rank = None  # 行号 -> 时间降序名次（懒建）
+        self._conversation_index = None  # 会话位置索引（懒建）
+        self._sender_index = None  # 发送者倒排：各发送者的行号（按时间降序，懒建）
+        self._sender_grams = {}  # 发送者名称（小写）的单字/二元组 -> 发送者ID列表
+        self._gram_indexed_senders = 0  # 已进入名称索引的发送者数
+        self._gram_lock = threading.Lock()  # 名称索引可能由并发的搜索请求补建
+
+    def __len__(self):
+        return len(self.is_sent)
+
+    @classmethod
+    def from_records(cls, records):
+        store = cls()
+        store.extend(records)
+        return store
+
+    @staticmethod
+    def _hash_id(message_id):
+        return int.from_bytes(hashlib.blake2b(message_id.encode('utf-8', errors='replace'), digest_size=8).digest(),
+                              'little', signed=True)
+
+    @staticmethod
+    def _intern(values, names, lookup):
+        ids = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            value_id = lookup.get(value)
+            if value_id is None:
+                value_id = lookup[value] = len(names)
+                names.append(value)
+            ids[i] = value_id
+        return ids
+
+    def extend(self, records):
+        # 追加消息（extract_messages 产出的 dict 列表），返回新行的起止行号
+        start = len(self)
+        if not records:
+            return start, start
+        ids = [str(r.get('id', '')) for r in records]
+        times = parse_message_times(r.get('time') for r in records)
+        is_sent = np.fromiter((bool(r.get('is_sent', False)) for r in records), dtype=bool, count=len(records))
+        sender_ids = self._intern([str(r.get('sender', '')) for r in records], self.senders, self._sender_lookup)
+        source_ids = self._intern([str(r.get('source_file', '')) for r in records], self.sources, self._source_lookup)
+        id_hashes = np.fromiter(map(self._hash_id, ids), dtype=np.int64, count=len(ids))
+
+        self.ids.extend(ids)
+        self.contents.extend(str(r.get('content', '')) for r in records)
+        self.id_hashes = np.concatenate((self.id_hashes, id_hashes))
+        self.times = np.concatenate((self.times, times))
+        self.sender_ids = np.concatenate((self.sender_ids, sender_ids))
+        self.source_ids = np.concatenate((self.source_ids, source_ids))
+        self._hash_order = self._sorted_hashes = self._time_order = self._conversation_index = None
+        self._time_rank = self._sender_index = None
+        # is_sent 最后更新：len(self) 增长时其余各列已就绪
+        self.is_sent = np.concatenate((self.is_sent, is_sent))
+        return start, len(self)
+
+    def extend_store(self, other):
+        # 按列追加另一个 MessageStore（如导入进程返回的结果），发送者和来源文件重新驻留；返回新行的起止行号
+        start = len(self)
+        if not len(other):
+            return start, start
+        sender_map = self._intern(other.senders, self.senders, self._sender_lookup)
+        source_map = self._intern(other.sources, self.sources, self._source_lookup)
+        self.ids.append_column(other.ids)
+        self.contents.append_column(other.contents)
+        self.id_hashes = np.concatenate((self.id_hashes, other.id_hashes))
+        self.times = np.concatenate((self.times, other.times))
+        self.sender_ids = np.concatenate((self.sender_ids, sender_map[other.sender_ids]))
+        self.source_ids = np.concatenate((self.source_ids, source_map[other.source_ids]))
+        self._hash_order = self._sorted_hashes = self._time_order = self._conversation_index = None
+        self._time_rank = self._sender_index = None
+        self.is_sent = np.concatenate((self.is_sent, other.is_sent))
+        return start, len(self)
+
+    def extended(self, other):
+        # 返回追加了 other 的新 MessageStore，自身不变：查询线程可继续读取当前存储，新存储建好后整体替换引用
+        # 发送者和来源文件按原顺序驻留，已有行的行号和各 ID 保持不变
+        store = MessageStore()
+        store.extend_store(self)
+        store.extend_store(other)
+        return store
+
+    def time_str(self, row):
+        value = self.times[row]
+        return None if np.isnat(value) else str(pd.Timestamp(value))
+
+    def record(self, row):
+        # 组装单条消息 dict
+        row = int(row)
+        return {
+            'id': self.ids[row], 'sender': self.senders[self.sender_ids[row]], 'content': self.contents[row],
+            'time': self.time_str(row), 'is_sent': bool(self.is_sent[row]),
+            'source_file': self.sources[self.source_ids[row]]
+        }
+
+    def records(self, rows):
+        return [self.record(row) for row in rows]
+
+    def find(self, message_id):
+        # 消息ID -> 行号（ID 重复时取第一条），不存在返回 None
+        if self._hash_order is None:
+            order = np.argsort(self.id_hashes, kind='stable')
+            self._sorted_hashes, self._hash_order = self.id_hashes[order], order
+        order, sorted_hashes = self._hash_order, self._sorted_hashes
+        target = self._hash_id(str(message_id))
+        lo = np.searchsorted(sorted_hashes, target, side='left')
+        hi = np.searchsorted(sorted_hashes, target, side='right')
+        for row in order[lo:hi]:
+            if self.ids[row] == str(message_id):
+                return int(row)
+        return None
+
+    def time_order(self):
+        # 按时间降序的行号；时间相同保持原顺序，NaT 排在最后
+        if self._time_order is None:
+            keys = self.times.view(np.int64)[::-1]
+            self._time_order = len(keys) - 1 - np.argsort(keys, kind='stable')[::-1]
+        return self._time_order
+
+    def time_rank(self):
+        # 行号 -> 在 time_order 中的名次，用于把任意行集合按时间降序排列
+        if self._time_rank is None:
+            time_order = self.time_order()
+            time_rank = np.empty(len(time_order), dtype=np.int64)
+            time_rank[time_order] = np.arange(len(time_order))
+            self._time_rank = time_rank
+        return self._time_rank
+
+    def conversation_index(self):
+        """会话位置索引：(按 来源文件、时间 排序的行号, 各来源文件在其中的起止位置, 行号 -> 位置)
+
+        时间无法解析的消息不在任何会话中（位置为 -1）。"""
+        index = self._conversation_index
+        if index is None:
+            n = len(self)
+            times, source_ids = self.times[:n], self.source_ids[:n]
+            valid = np.flatnonzero(~np.isnat(times))
+            order = valid[np.lexsort((times[valid].view(np.int64), source_ids[valid]))]
+            starts = np.searchsorted(source_ids[order], np.arange(len(self.sources) + 1))
+            positions = np.full(n, -1, dtype=np.int64)
+            positions[order] = np.arange(len(order))
+            index = self._conversation_index = (order, starts, positions)
+        return index
+
+    def conversation_position(self, row):
+        """行号 -> (会话排序行号, 会话起始位置, 当前位置, 会话结束位置)，不在会话中返回 None"""
+        order, starts, positions = self.conversation_index()
+        if row >= len(positions) or positions[row] < 0:
+            return None
+        source = self.source_ids[row]
+        return order, int(starts[source]), int(positions[row]), int(starts[source + 1])
+
+    def sender_index(self):
+        """发送者倒排：(按 发送者ID、时间降序 排序的行号, 各发送者在其中的起止位置, 行号 -> 时间降序名次)
+
+        时间无法解析的消息不在索引中。"""
+        index = self._sender_index
+        if index is None:
+            time_order, time_rank = self.time_order(), self.time_rank()
+            valid = time_order[~np.isnat(self.times[time_order])]
+            order = valid[np.argsort(self.sender_ids[valid], kind='stable')]
+            starts = np.searchsorted(self.sender_ids[order], np.arange(len(self.senders) + 1))
+            index = self._sender_index = (order, starts, time_rank)
+            self._index_sender_grams()  # 加载和追加数据时随发送者倒排一起建好，查询时通常无需再补建
+        return index
+
+    @staticmethod
+    def _name_grams(name):
+        return set(name) | {name[i:i + 2] for i in range(len(name) - 1)}
+
+    def _index_sender_grams(self):
+        # 把尚未索引的发送者名称加入单字/二元组索引
+        with self._gram_lock:
+            for sender_id in range(self._gram_indexed_senders, len(self.senders)):
+                for gram in self._name_grams(self.senders[sender_id].lower()):
+                    self._sender_grams.setdefault(gram, []).append(sender_id)
+            self._gram_indexed_senders = len(self.senders)
+
+    def match_senders(self, pattern):
+        """名称匹配正则（不区分大小写）的发送者ID列表；字面量查询先用名称的单字/二元组索引取候选
+
+        含空白的字面量按空白切分，各段的单字/二元组都要出现在名称中。"""
+        self._index_sender_grams()
+        try:
+            regex = re.compile(pattern, re.IGNORECASE)
+        except re.error:
+            regex = re.compile(re.escape(pattern), re.IGNORECASE)
+        words = pattern.lower().split()
+        if not words or any(re.escape(word) != word for word in words):
+            candidates = range(len(self.senders)) # 真正的正则：逐个名称匹配
+        else:
+            grams = set()
+            for word in words:
+                grams.update([word] if len(word) == 1 else [word[i:i + 2] for i in range(len(word) - 1)])
+            postings = sorted((self._sender_grams.get(gram, ()) for gram in grams), key=len)
+            candidates = sorted(set(postings[0]).intersection(*postings[1:]))
+        return [sender_id for sender_id in candidates if regex.search(self.senders[sender_id])]
+
+    def sender_rows(self, sender_ids):
+        """若干发送者的全部消息行号，按时间降序（同时间按行号）"""
+        order, starts, time_rank = self.sender_index()
+        if not len(sender_ids):
+            return np.zeros(0, dtype=np.int64)
+        rows = np.concatenate([order[starts[i]:starts[i + 1]] for i in sender_ids])
+        if len(sender_ids) > 1:
+            rows = rows[np.argsort(time_rank[rows], kind='stable')]
+        return rows
+
+    def valid_time_mask(self):
+        return ~np.isnat(self.times)
+
+    def to_arrays(self):
+        # 快照用：(数组, 小对象)
+        arrays = {
+            'ids_buffer': np.frombuffer(self.ids.buffer, dtype=np.uint8), 'ids_offsets': self.ids.offsets,
+            'contents_buffer': np.frombuffer(self.contents.buffer, dtype=np.uint8), 'contents_offsets': self.contents.offsets,
+            'id_hashes': self.id_hashes, 'times': self.times, 'is_sent': self.is_sent,
+            'sender_ids': self.sender_ids, 'source_ids': self.source_ids
+        }
+        return arrays, {'senders': self.senders, 'sources': self.sources}
+
+    @classmethod
+    def from_arrays(cls, arrays, objects):
+        store = cls()
+        store.ids = TextColumn(arrays['ids_buffer'], arrays['ids_offsets'])
+        store.contents = TextColumn(arrays['contents_buffer'], arrays['contents_offsets'])
+        store.id_hashes = arrays['id_hashes']
+        store.times = arrays['times']
+        store.sender_ids = arrays['sender_ids']
+        store.source_ids = arrays['source_ids']
+        store.senders, store.sources = objects['senders'], objects['sources']
+        store._sender_lookup = {name: i for i, name in enumerate(store.senders)}
+        store._source_lookup = {name: i for i, name in enumerate(store.sources)}
+        store.is_sent = arrays['is_sent']
+        return store
+
+
 # --- 全局数据 ---
 app_data = {
     'device_info': {},
     'contacts': [],
-    'messages': [],
+    'messages': MessageStore(),
     'app_summary': [],
     'wechat_groups': [],
     'wechat_contacts': [],
     'call_records': [],
+    'source_hashes': [],  # 当前数据集已导入文件的内容哈希
     'search_history': [],
     'favorites': []
 }
 
 processing_tasks = {}
 search_engine = None
+dataset_generation = 0  # 数据集代数：每次发布新的/更新后的搜索引擎时加一，作为结果缓存键的一部分
 
 def load_persistent_data():
     """搜索历史和收藏夹"""
@@ -83,88 +458,1213 @@ def save_persistent_data():
         logging.error(f"保存持久化数据时出错: {e}", exc_info=True)
 
 
+def tokenize_text(text):
+    # jieba 分词，去掉空白词
+    return [word for word in jieba.cut(text) if word.strip()]
+
+def _init_tokenize_worker():
+    # 进程池初始化：每个进程加载一次 jieba 词典
+    jieba.initialize()
+
+def _tokenize_chunk(texts):
+    # 进程池任务：对一批文本分词
+    return [tokenize_text(text) for text in texts]
+
+def tokenize_texts(texts, workers=TOKENIZE_WORKERS):
+    """批量分词：大语料使用进程池并保持顺序，小语料串行"""
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(texts) < PARALLEL_TOKENIZE_MIN_DOCS:
+        return _tokenize_chunk(texts)
+
+    chunks = [texts[i:i + TOKENIZE_CHUNK_SIZE] for i in range(0, len(texts), TOKENIZE_CHUNK_SIZE)]
+    # 使用 spawn：后台线程中 fork 可能继承其他线程持有的锁
+    context = multiprocessing.get_context('spawn')
+    tokenized = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=context,
+                             initializer=_init_tokenize_worker) as executor:
+        for chunk_result in executor.map(_tokenize_chunk, chunks):
+            tokenized.extend(chunk_result)
+    return tokenized
+
+
+def encode_documents(tokenized_docs, vocabulary, on_new_token=None):
+    """分词结果 -> (词ID缓冲区 int32, 文档偏移 int64)；新词追加到 vocabulary 末尾"""
+    token_ids = array('i')
+    offsets = array('q', [0])
+    for words in tokenized_docs:
+        for word in words:
+            token_id = vocabulary.get(word)
+            if token_id is None:
+                token_id = vocabulary[word] = len(vocabulary)
+                if on_new_token is not None:
+                    on_new_token(word)
+            token_ids.append(token_id)
+        offsets.append(len(token_ids))
+    return np.frombuffer(token_ids, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64)
+
+
+class TokenCache:
+    # 分词缓存：按文本内容哈希记忆分词结果，内存 LRU + 可选 SQLite 磁盘层
+    # 返回的分词结果为共享的 tuple，调用方不应修改
+    DISK_BATCH_SIZE = 500  # 磁盘层批量查询的键数（低于 SQLite 参数上限）
+
+    def __init__(self, max_entries=TOKEN_CACHE_SIZE, disk_path=TOKEN_CACHE_FILE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # 文本哈希 -> 分词结果
+        self._lock = threading.Lock()
+        self.hits = 0  # 内存命中（含同一批次内的重复文本）
+        self.disk_hits = 0
+        self.misses = 0  # 实际调用 jieba 分词的不同文本数
+        self._disk = None
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute('CREATE TABLE IF NOT EXISTS tokens (key BLOB PRIMARY KEY, tokens BLOB)')
+
+    @staticmethod
+    def _key(text):
+        return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+    def _remember(self, key, tokens):
+        # 调用方持有锁
+        self._entries[key] = tokens
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def tokenize(self, text):
+        """单条文本分词（带缓存）"""
+        return self.tokenize_many([text])[0]
+
+    def tokenize_many(self, texts, workers=1):
+        """批量分词：按内容去重，只有缓存未命中的不同文本才真正分词"""
+        results = [None] * len(texts)
+        pending = {}  # 文本哈希 -> (文本, 位置列表)
+        with self._lock:
+            for i, text in enumerate(texts):
+                key = self._key(text)
+                tokens = self._entries.get(key)
+                if tokens is not None:
+                    self._entries.move_to_end(key)
+                    results[i] = tokens
+                    self.hits += 1
+                elif key in pending:
+                    pending[key][1].append(i)
+                    self.hits += 1
+                else:
+                    pending[key] = (text, [i])
+
+            if pending and self._disk is not None:
+                for key, tokens in self._disk_get_many(list(pending)):
+                    text, positions = pending.pop(key)
+                    tokens = tuple(pickle.loads(tokens))
+                    self._remember(key, tokens)
+                    for i in positions:
+                        results[i] = tokens
+                    self.disk_hits += 1
+
+        if pending:
+            keys = list(pending)
+            tokenized = tokenize_texts([pending[key][0] for key in keys], workers=workers)
+            with self._lock:
+                for key, tokens in zip(keys, tokenized):
+                    tokens = tuple(tokens)
+                    self._remember(key, tokens)
+                    for i in pending[key][1]:
+                        results[i] = tokens
+                self.misses += len(keys)
+                if self._disk is not None:
+                    self._disk.executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?)',
+                                           ((key, pickle.dumps(list(results[pending[key][1][0]]))) for key in keys))
+                    self._disk.commit()
+        return results
+
+    def _disk_get_many(self, keys):
+        # 调用方持有锁
+        found = []
+        for start in range(0, len(keys), self.DISK_BATCH_SIZE):
+            batch = keys[start:start + self.DISK_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            found.extend(self._disk.execute(f'SELECT key, tokens FROM tokens WHERE key IN ({placeholders})', batch))
+        return found
+
+    def stats(self):
+        """命中/未命中计数"""
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+            'hit_rate': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            'entries': len(self._entries), 'max_entries': self.max_entries,
+            'disk_enabled': self._disk is not None
+        }
+
+
+# 全局共享的分词缓存
+token_cache = TokenCache()
+
+
+def rank_top_k(candidates, scores, top_n):
+    """按分数降序（同分按文档ID升序）取前 N 个正分文档，返回 [(文档ID, 分数)]"""
+    positive = scores > 0
+    candidates, scores = candidates[positive], scores[positive]
+    if len(scores) > top_n:
+        # 保留第 N 名及与其同分的文档，保证同分截断结果确定
+        kth = -np.partition(-scores, top_n - 1)[top_n - 1]
+        keep = scores >= kth
+        candidates, scores = candidates[keep], scores[keep]
+    order = np.lexsort((candidates, -scores))[:top_n]
+    return [(int(candidates[i]), float(scores[i])) for i in order]
+
+
+def fuse_rankings(rankings, method=HYBRID_FUSION, rrf_k=RRF_K):
+    """多路 [(文档ID, 分数)] 排序结果按文档ID融合，返回按融合分数降序（同分按文档ID升序）的 [(文档ID, 分数)]
+
+    rrf: 每路贡献 1 / (rrf_k + 名次)；minmax: 每路分数线性归一化到 [0, 1] 后相加。
+    两种方式都不直接比较 BM25 与余弦的原始分数。"""
+    rankings = [ranking for ranking in rankings if ranking]
+    if not rankings:
+        return []
+    doc_ids, weights = [], []
+    for ranking in rankings:
+        doc_ids.append(np.fromiter((doc for doc, _ in ranking), dtype=np.int64, count=len(ranking)))
+        if method == 'minmax':
+            scores = np.fromiter((score for _, score in ranking), dtype=np.float64, count=len(ranking))
+            span = scores.max() - scores.min()
+            weights.append((scores - scores.min()) / span if span > 0 else np.ones(len(scores)))
+        else:
+            weights.append(1.0 / (rrf_k + np.arange(1, len(ranking) + 1)))
+    unique, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+    fused = np.bincount(inverse, weights=np.concatenate(weights), minlength=len(unique))
+    order = np.lexsort((unique, -fused))
+    return [(int(unique[i]), float(fused[i])) for i in order]
+
+
+# 综合搜索的检索线程池（BM25 / 稀疏矩阵运算大多在 NumPy、SciPy 内释放 GIL，可与语义检索并行）
+hybrid_executor = ThreadPoolExecutor(max_workers=HYBRID_SEARCH_WORKERS, thread_name_prefix='hybrid-search')
+
+
+def tfidf_top_k(tfidf_matrix, query_vector, top_n):
+    """稀疏 TF-IDF 余弦 top-k
+
+    tfidf_matrix 为 文档 x 词 的 CSC 矩阵（按列即每个词的倒排表），行已 L2 归一化；
+    query_vector 为已归一化的 1 x 词 稀疏向量。只对含有查询词的文档累加点积。"""
+    columns = query_vector.indices
+    if not len(columns) or top_n <= 0:
+        return []
+    starts = tfidf_matrix.indptr[columns]
+    lengths = tfidf_matrix.indptr[columns + 1] - starts
+    total = int(lengths.sum())
+    if not total:
+        return []
+    # 各查询词倒排表在 indices/data 中的位置首尾相接
+    positions = np.arange(total, dtype=np.int64) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    doc_ids = tfidf_matrix.indices[positions]
+    weights = tfidf_matrix.data[positions].astype(np.float64) * np.repeat(query_vector.data, lengths)
+    num_docs = tfidf_matrix.shape[0]
+    if total * 8 >= num_docs:
+        # 候选很多时直接按文档号稠密累加，比排序去重快
+        scores = np.bincount(doc_ids, weights=weights, minlength=num_docs)
+        candidates = np.flatnonzero(scores)
+        return rank_top_k(candidates, scores[candidates], top_n)
+    candidates, inverse = np.unique(doc_ids, return_inverse=True)
+    return rank_top_k(candidates, np.bincount(inverse, weights=weights, minlength=len(candidates)), top_n)
+
+
 class BM25:
-    # BM25
-    def __init__(self, documents):
-        self.documents = documents
-        self.D = len(documents) 
-        self.avgdl = sum([len(doc) for doc in documents]) / self.D if self.D > 0 else 0 
-        self.f = []  
-        self.df = {} 
-        self.idf = {} 
-        self.k1 = 1.5 
-        self.b = 0.75  
-        self._initialize()
-
-    def _initialize(self):
-        # 计算词频和文档频率
-        for document in self.documents:
-            frequencies = Counter(document)
-            self.f.append(frequencies)
-            for word in frequencies:
-                self.df[word] = self.df.get(word, 0) + 1
-        # 计算每个词的 IDF
-        for word, freq in self.df.items():
-            freq = min(freq, self.D) 
-            self.idf[word] = math.log((self.D - freq + 0.5) / (freq + 0.5) + 1.0)
+    # BM25（倒排索引：词 -> 文档ID数组 + 词频数组）
+    BLOCK_SIZE = 128  # 动态剪枝时倒排表的分块大小
+    PRUNE_CHUNK_BLOCKS = 64  # 首轮按块上界降序处理的块数，之后逐轮翻倍
+    PRUNE_MIN_POSTINGS = 50000  # 命中倒排表总长度低于此值时直接全量打分
+    PRUNE_EPSILON = 1e-9  # 上界比较的浮点余量，避免误剪同分文档
+
+    def __init__(self, documents, k1=1.5, b=0.75, vocabulary=None):
+        self.D = 0
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {} if vocabulary is None else vocabulary  # 词 -> 词ID，可与调用方共用
+        self.postings_indptr = np.zeros(1, dtype=np.int64)  # 词ID t 的倒排表位于 [indptr[t], indptr[t+1])
+        self.postings_doc_ids = np.zeros(0, dtype=np.int32)
+        self.postings_tf = np.zeros(0, dtype=np.float64)
+        self.doc_len = np.zeros(0, dtype=np.float64)
+        self.doc_norm = np.zeros(0, dtype=np.float64)  # k1 * (1 - b + b * 文档长度 / 平均长度)
+        self.avgdl = 0
+        self.df = np.zeros(0, dtype=np.int64)
+        self.idf = np.zeros(0, dtype=np.float64)
+        if documents:
+            self.add_token_ids(*encode_documents(documents, self.vocabulary))
+
+    @classmethod
+    def from_token_ids(cls, token_ids, offsets, vocabulary, k1=1.5, b=0.75):
+        # 由词ID缓冲区构建（vocabulary 需已包含 token_ids 中的全部词ID）
+        bm25 = cls([], k1=k1, b=b, vocabulary=vocabulary)
+        bm25.add_token_ids(token_ids, offsets)
+        return bm25
+
+    @classmethod
+    def from_arrays(cls, vocabulary, indptr, doc_ids, tf, doc_len, k1=1.5, b=0.75):
+        # 由快照中的倒排表数组重建（数组可为只读内存映射，无需重新分词）
+        bm25 = cls.__new__(cls)
+        bm25.k1 = k1
+        bm25.b = b
+        bm25.vocabulary = vocabulary
+        bm25.postings_indptr = indptr
+        bm25.postings_doc_ids = doc_ids
+        bm25.postings_tf = tf
+        bm25.D = len(doc_len)
+        bm25.df = np.diff(indptr).astype(np.int64)
+        bm25._set_doc_stats(np.asarray(doc_len, dtype=np.float64))
+        return bm25
+
+    def _collect_postings(self, token_ids, offsets, doc_offset):
+        # 由词ID缓冲区按 (词ID, 文档ID) 排序统计词频；返回 (文档ID, 词频, df, 文档长度)
+        num_docs = len(offsets) - 1
+        lengths = np.diff(offsets)
+        doc_index = np.repeat(np.arange(num_docs, dtype=np.int64), lengths)
+        keys, tf = np.unique(np.asarray(token_ids, dtype=np.int64) * num_docs + doc_index, return_counts=True)
+        term_ids = keys // num_docs
+        df = np.bincount(term_ids, minlength=len(self.vocabulary)).astype(np.int64)
+        return ((keys % num_docs + doc_offset).astype(np.int32), tf.astype(np.float64),
+                df, lengths.astype(np.float64))
+
+    def add_documents(self, documents):
+        # 增量追加分词后的文档
+        if documents:
+            self.add_token_ids(*encode_documents(documents, self.vocabulary))
+
+    def add_token_ids(self, token_ids, offsets):
+        # 增量追加文档：只统计新文档，新文档ID接在末尾，按词合并倒排表并更新 df/idf 和长度统计
+        if len(offsets) <= 1:
+            return
+        new_doc_ids, new_tf, new_df, new_doc_len = self._collect_postings(token_ids, offsets, self.D)
+        old_df = np.concatenate((self.df, np.zeros(len(new_df) - len(self.df), dtype=np.int64)))
+        df = old_df + new_df
+        indptr = np.concatenate(([0], np.cumsum(df))).astype(np.int64)
+
+        # 每个词的旧条目在前、新条目在后，文档ID仍保持升序
+        old_shift = np.repeat(indptr[:len(self.df)] - self.postings_indptr[:-1], self.df)
+        new_indptr = np.concatenate(([0], np.cumsum(new_df)))
+        new_shift = np.repeat(indptr[:-1] + old_df - new_indptr[:-1], new_df)
+        doc_ids = np.empty(indptr[-1], dtype=np.int32)
+        tfs = np.empty(indptr[-1], dtype=np.float64)
+        old_pos = np.arange(len(self.postings_doc_ids)) + old_shift
+        new_pos = np.arange(len(new_doc_ids)) + new_shift
+        doc_ids[old_pos], tfs[old_pos] = self.postings_doc_ids, self.postings_tf
+        doc_ids[new_pos], tfs[new_pos] = new_doc_ids, new_tf
+
+        # 先扩展文档统计再替换倒排表，查询线程不会拿到越界的文档ID
+        self.D += len(offsets) - 1
+        self._set_doc_stats(np.concatenate((self.doc_len, new_doc_len)), df)
+        self.postings_doc_ids, self.postings_tf, self.postings_indptr, self.df = doc_ids, tfs, indptr, df
+
+    def _set_doc_stats(self, doc_len, df=None):
+        # 文档长度、IDF 及长度归一化项
+        df = self.df if df is None else df
+        self.doc_len = doc_len
+        self.avgdl = float(doc_len.sum()) / self.D if self.D > 0 else 0
+        # 与逐词计算保持相同的浮点结果
+        self.idf = np.array([math.log((self.D - freq + 0.5) / (freq + 0.5) + 1.0)
+                             for freq in df.tolist()], dtype=np.float64)
+        self._update_doc_norm()
+
+    def _update_doc_norm(self):
+        # 预计算文档长度归一化项
+        if self.avgdl > 0:
+            self.doc_norm = self.k1 * (1 - self.b + self.b * self.doc_len / self.avgdl)
+        else:
+            self.doc_norm = np.zeros(self.D, dtype=np.float64)
+        self._bound_cache = {}  # 词ID -> 得分上界，参数变化后失效
+
+    def set_params(self, k1=None, b=None):
+        # 运行时调整 k1/b，只重算归一化项，无需重新分词
+        if k1 is not None: self.k1 = k1
+        if b is not None: self.b = b
+        self._update_doc_norm()
+
+    def _term_postings(self, word):
+        # 返回 (词ID, 文档ID数组, 词频数组)，词不存在时返回 None
+        term_id = self.vocabulary.get(word)
+        if term_id is None or term_id >= len(self.df):
+            return None # 词表共用时，追加中的新词可能尚未进入倒排表
+        start, end = self.postings_indptr[term_id], self.postings_indptr[term_id + 1]
+        return term_id, self.postings_doc_ids[start:end], self.postings_tf[start:end]
+
+    def _term_scores(self, term_id, doc_ids, doc_freq, freq):
+        # 某个查询词在其倒排表内各文档上的得分贡献
+        numerator = self.idf[term_id] * doc_freq * (self.k1 + 1)
+        denominator = doc_freq + self.doc_norm[doc_ids]
+        return (numerator / denominator) * freq
 
     def get_scores(self, query):
-        # 计算所有文档的 BM25 分数
-        scores = [0] * self.D
-        query_freqs = Counter(query) 
-        for word, freq in query_freqs.items():
-            if word not in self.idf: continue # 忽略不在 IDF 中的词
-            for i, doc in enumerate(self.documents):
-                if i >= len(self.f) or word not in self.f[i]: continue # 忽略不包含该词的文档
-                doc_len = len(doc)
-                doc_freq = self.f[i][word] 
-                numerator = self.idf[word] * doc_freq * (self.k1 + 1)
-                denominator = doc_freq + self.k1 * (1 - self.b + self.b * doc_len / self.avgdl)
-                scores[i] += (numerator / denominator) * freq 
+        # 计算所有文档的 BM25 分数（只访问包含查询词的文档）
+        scores = np.zeros(self.D, dtype=np.float64)
+        for word, freq in Counter(query).items():
+            postings = self._term_postings(word)
+            if postings is None: continue # 忽略不在词表中的词
+            term_id, doc_ids, doc_freq = postings
+            scores[doc_ids] += self._term_scores(term_id, doc_ids, doc_freq, freq)
+        return scores
+
+    def search(self, query, top_n=50):
+        # 前 N 个结果：在命中文档上累加分数，再做部分排序
+        hit_ids, hit_scores = [], []
+        for word, freq in Counter(query).items():
+            postings = self._term_postings(word)
+            if postings is None: continue
+            term_id, doc_ids, doc_freq = postings
+            hit_ids.append(doc_ids)
+            hit_scores.append(self._term_scores(term_id, doc_ids, doc_freq, freq))
+        if not hit_ids or top_n <= 0:
+            return []
+
+        candidates, inverse = np.unique(np.concatenate(hit_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(hit_scores), minlength=len(candidates))
+        return rank_top_k(candidates, scores, top_n)
+
+    def score_docs(self, query, doc_ids):
+        # 只对给定的（升序）文档计算 BM25 分数，用于短语等先筛选文档的查询
+        scores = np.zeros(len(doc_ids), dtype=np.float64)
+        for word, freq in Counter(query).items():
+            postings = self._term_postings(word)
+            if postings is None: continue
+            term_id, term_doc_ids, doc_freq = postings
+            found, pos = self._lookup(term_doc_ids, doc_ids)
+            if len(pos):
+                scores[found] += self._term_scores(term_id, doc_ids[found], doc_freq[pos], freq)
         return scores
 
+    def _term_bounds(self, term_id):
+        # 某词的全局最大得分贡献、分块最大值及按块最大值降序的块顺序（按需计算并缓存）
+        cached = self._bound_cache.get(term_id)
+        if cached is None:
+            start, end = self.postings_indptr[term_id], self.postings_indptr[term_id + 1]
+            contrib = self._term_scores(term_id, self.postings_doc_ids[start:end], self.postings_tf[start:end], 1)
+            block_max = np.maximum.reduceat(contrib, np.arange(0, end - start, self.BLOCK_SIZE))
+            cached = (float(block_max.max()), block_max, np.argsort(-block_max, kind='stable'))
+            self._bound_cache[term_id] = cached
+        return cached
+
+    @staticmethod
+    def _lookup(doc_ids, targets):
+        # 在有序倒排表中查找目标文档，返回 (命中掩码, 命中位置)
+        if len(doc_ids) == 0:
+            return np.zeros(len(targets), dtype=bool), np.zeros(0, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(doc_ids, targets), len(doc_ids) - 1)
+        found = doc_ids[pos] == targets
+        return found, pos[found]
+
+    def search_pruned(self, query, top_n=50):
+        # 动态剪枝的前 N 个结果（block-max MaxScore），结果与 search 完全一致
+        # 按得分上界从高到低处理查询词：当前第 N 名分数作为阈值，
+        # 上界达不到阈值的块不再引入新文档，只对已有候选查表累加
+        terms = []
+        for word, freq in Counter(query).items():
+            postings = self._term_postings(word)
+            if postings is None: continue
+            term_id, doc_ids, doc_freq = postings
+            max_score, block_max, block_order = self._term_bounds(term_id)
+            terms.append((term_id, doc_ids, doc_freq, freq, max_score * freq, block_max * freq, block_order))
+        if not terms or top_n <= 0:
+            return []
+        if sum(len(t[1]) for t in terms) <= self.PRUNE_MIN_POSTINGS:
+            return self.search(query, top_n=top_n) # 倒排表较短时剪枝收益不抵开销
+
+        query_terms = list(terms)  # 原查询词顺序，用于最终精确打分
+        terms.sort(key=lambda t: t[4], reverse=True)
+        rest_bounds = np.cumsum([t[4] for t in terms][::-1])[::-1].tolist() + [0.0]  # 第 i 个及之后各词的上界之和
+        slack = 1 + self.PRUNE_EPSILON
+
+        cand_ids = np.zeros(0, dtype=np.int32)  # 候选文档（有序）
+        cand_scores = np.zeros(0, dtype=np.float64)  # 候选文档的部分得分（得分下界）
+
+        def current_threshold():
+            if len(cand_scores) < top_n:
+                return 0.0
+            return float(np.partition(cand_scores, len(cand_scores) - top_n)[len(cand_scores) - top_n])
+
+        for i, (term_id, doc_ids, doc_freq, freq, upper_bound, block_max, block_order) in enumerate(terms):
+            # 已有候选：查表累加本词贡献
+            if len(cand_ids):
+                found, pos = self._lookup(doc_ids, cand_ids)
+                if len(pos):
+                    cand_scores[found] += self._term_scores(term_id, cand_ids[found], doc_freq[pos], freq)
+
+            threshold = current_threshold()
+            if rest_bounds[i] * slack < threshold:
+                continue # 新文档得分不可能超过阈值，本词及之后均只做查表
+            rest_after = rest_bounds[i + 1]
+
+            # 按块上界降序分批引入新文档，阈值随之提高，后续块可被整体跳过
+            chunk_start, chunk_size = 0, self.PRUNE_CHUNK_BLOCKS
+            while chunk_start < len(block_order):
+                blocks = block_order[chunk_start:chunk_start + chunk_size]
+                chunk_start, chunk_size = chunk_start + chunk_size, chunk_size * 2
+                blocks = blocks[(block_max[blocks] + rest_after) * slack >= threshold]
+                if len(blocks) == 0:
+                    break # 块按上界降序，之后的块同样无法达到阈值
+                entries = (blocks[:, None] * self.BLOCK_SIZE + np.arange(self.BLOCK_SIZE)).ravel()
+                entries = entries[entries < len(doc_ids)]
+                new_ids = doc_ids[entries]
+                new_scores = self._term_scores(term_id, new_ids, doc_freq[entries], freq)
+                keep = (new_scores + rest_after) * slack >= threshold
+                if len(cand_ids):
+                    existing, _ = self._lookup(cand_ids, new_ids)
+                    keep &= ~existing
+                if keep.any():
+                    cand_ids = np.concatenate((cand_ids, new_ids[keep]))
+                    cand_scores = np.concatenate((cand_scores, new_scores[keep]))
+                    order = np.argsort(cand_ids, kind='stable')
+                    cand_ids, cand_scores = cand_ids[order], cand_scores[order]
+                    threshold = current_threshold()
+
+        # 与阈值接近的候选按原查询词顺序重新精确打分，保证分数与 search 逐位一致
+        threshold = current_threshold()
+        near = cand_scores * slack >= threshold
+        cand_ids = cand_ids[near]
+        exact_scores = np.zeros(len(cand_ids), dtype=np.float64)
+        for term_id, doc_ids, doc_freq, freq, _, _, _ in query_terms:
+            found, pos = self._lookup(doc_ids, cand_ids)
+            if len(pos):
+                exact_scores[found] += self._term_scores(term_id, cand_ids[found], doc_freq[pos], freq)
+        return rank_top_k(cand_ids, exact_scores, top_n)
+
+
+class BM25Matrix(BM25):
+    # BM25（稀疏矩阵模式）：索引时预计算 词 x 文档 的权重 CSR 矩阵，查询即行切片求和
+    def __init__(self, tf_matrix, vocabulary, k1=1.5, b=0.75, lowercase=True):
+        # tf_matrix 为 文档 x 词 的原始词频矩阵，vocabulary 与 TF-IDF 共用
+        self.k1 = k1
+        self.b = b
+        self.lowercase = lowercase # 与 TF-IDF 词表一致，查询词转小写后再查词表
+        self.vocabulary = vocabulary
+        term_major = csr_matrix(tf_matrix, dtype=np.float64).T.tocsr()
+        term_major.sort_indices()
+        self.D = term_major.shape[1]
+        # 保留原始词频和文档长度，调整参数时只需重算权重
+        self.postings_indptr = term_major.indptr.astype(np.int64)
+        self.postings_doc_ids = term_major.indices.astype(np.int32)
+        self.postings_tf = term_major.data
+        self.df = np.diff(self.postings_indptr)
+        self._set_doc_stats(np.asarray(tf_matrix.sum(axis=1), dtype=np.float64).ravel())
+        self.weight_matrix = None
+        self._build_weights()
+
+    def _build_weights(self):
+        # 按当前 k1/b 计算全部 (词, 文档) 的 BM25 权重
+        row_idf = np.repeat(self.idf, self.df)
+        doc_freq = self.postings_tf
+        weights = row_idf * doc_freq * (self.k1 + 1) / (doc_freq + self.doc_norm[self.postings_doc_ids])
+        self.weight_matrix = csr_matrix((weights, self.postings_doc_ids, self.postings_indptr),
+                                        shape=(len(self.df), self.D))
+
+    def set_params(self, k1=None, b=None):
+        super().set_params(k1=k1, b=b)
+        self._build_weights()
+
+    def _term_postings(self, word):
+        return super()._term_postings(word.lower() if self.lowercase else word)
+
     def search(self, query, top_n=50):
-        # 前 N 个结果
-        scores = self.get_scores(query)
-        actual_top_n = min(top_n, self.D) #  top_n 不超过文档总数
-        top_indices = np.argsort(scores)[::-1][:actual_top_n] 
-        return [(i, scores[i]) for i in top_indices if scores[i] > 0]
+        # 查询向量与权重矩阵相乘，得到命中文档的稀疏分数
+        if self.lowercase:
+            query = [word.lower() for word in query]
+        rows, weights = [], []
+        for word, freq in Counter(query).items():
+            term_id = self.vocabulary.get(word)
+            if term_id is None or term_id >= self.weight_matrix.shape[0]: continue
+            rows.append(term_id)
+            weights.append(freq)
+        if not rows or top_n <= 0:
+            return []
+
+        query_vector = csr_matrix((np.asarray(weights, dtype=np.float64), (np.zeros(len(rows), dtype=np.int32), rows)),
+                                  shape=(1, self.weight_matrix.shape[0]))
+        hits = (query_vector @ self.weight_matrix).tocsr()
+        return rank_top_k(hits.indices, hits.data, top_n)
+
+    # 矩阵模式本身即为一次稀疏乘法，不做动态剪枝
+    search_pruned = search
+
+
+PROXIMITY_TOKEN_PATTERN = re.compile(r'"([^"]*)"|(?<!\S)NEAR/(\d+)(?!\S)|(\S+)')
+
+
+def parse_proximity_query(query):
+    """解析短语 / 邻近查询，返回子句列表（各子句需同时满足）：
+    ('phrase', 文本)，或 ('near', 文本A, 文本B, k) 表示 A、B 在同一文档中相隔不超过 k 个词（顺序不限）。
+    查询中没有引号或 NEAR/k 时返回 None（按普通关键词查询处理）。"""
+    items = []  # 操作数文本，或 NEAR 的距离 k（int）
+    for phrase, distance, word in PROXIMITY_TOKEN_PATTERN.findall(query or ''):
+        if distance:
+            items.append(int(distance))
+        elif phrase.strip() or word.strip('"'):
+            items.append(phrase if phrase else word.strip('"'))
+    if '"' not in (query or '') and not any(isinstance(item, int) for item in items):
+        return None
+
+    clauses, paired = [], set()
+    for i, item in enumerate(items):
+        if isinstance(item, int) and 0 < i < len(items) - 1 \
+                and isinstance(items[i - 1], str) and isinstance(items[i + 1], str):
+            clauses.append(('near', items[i - 1], items[i + 1], item))
+            paired.update((i - 1, i + 1))
+    clauses.extend(('phrase', item) for i, item in enumerate(items) if isinstance(item, str) and i not in paired)
+    return clauses
+
+
+class PositionalIndex:
+    # 词位置倒排：每个词ID的出现位置（在全部文档词ID缓冲区中的全局下标，升序）。
+    # 文档按顺序首尾相接，全局下标即 (文档, 文档内位置)，相邻两词在同一文档中当且仅当下标差 1 且不跨文档边界
+    def __init__(self, indptr, positions, token_offsets):
+        self.indptr = indptr  # 词ID t 的位置位于 positions[indptr[t]:indptr[t+1]]
+        self.positions = positions
+        self.token_offsets = token_offsets  # 文档 i 的词位于 [offsets[i], offsets[i+1])
+
+    @classmethod
+    def build(cls, token_ids, token_offsets, vocab_size):
+        empty = cls(np.zeros(vocab_size + 1, dtype=np.int64), np.zeros(0, dtype=np.int64), token_offsets[:1])
+        return empty.add(token_ids, token_offsets)
+
+    def add(self, new_ids, token_offsets):
+        """追加文档后的新索引：new_ids 为接在原缓冲区末尾的词ID，token_offsets 为追加后的全部文档偏移"""
+        base = int(self.token_offsets[-1])
+        vocab_size = max(len(self.indptr) - 1, int(new_ids.max()) + 1 if len(new_ids) else 0)
+        old_counts = np.diff(self.indptr)
+        old_counts = np.concatenate((old_counts, np.zeros(vocab_size - len(old_counts), dtype=np.int64)))
+        new_order = np.argsort(new_ids, kind='stable')
+        new_counts = np.bincount(new_ids, minlength=vocab_size).astype(np.int64)
+        indptr = np.concatenate(([0], np.cumsum(old_counts + new_counts))).astype(np.int64)
+
+        # 每个词的旧位置在前、新位置在后，仍保持升序
+        positions = np.empty(indptr[-1], dtype=np.int64)
+        old_slots = np.arange(len(self.positions)) + np.repeat(indptr[:len(self.indptr) - 1] - self.indptr[:-1],
+                                                               np.diff(self.indptr))
+        new_starts = np.concatenate(([0], np.cumsum(new_counts)))
+        new_slots = np.arange(len(new_ids)) + np.repeat(indptr[:-1] + old_counts - new_starts[:-1], new_counts)
+        positions[old_slots] = self.positions
+        positions[new_slots] = new_order + base
+        return PositionalIndex(indptr, positions, token_offsets)
+
+    def term_positions(self, term_id):
+        if term_id >= len(self.indptr) - 1:
+            return np.zeros(0, dtype=np.int64)
+        return self.positions[self.indptr[term_id]:self.indptr[term_id + 1]]
+
+    def documents(self, positions):
+        # 全局位置 -> 文档号
+        return np.searchsorted(self.token_offsets, positions, side='right') - 1
+
+    @staticmethod
+    def _contains(sorted_values, targets):
+        if not len(sorted_values):
+            return np.zeros(len(targets), dtype=bool)
+        pos = np.minimum(np.searchsorted(sorted_values, targets), len(sorted_values) - 1)
+        return sorted_values[pos] == targets
+
+    def phrase(self, term_ids):
+        """短语（词ID序列）在文档内的全部出现起点（全局位置，升序）"""
+        if not term_ids:
+            return np.zeros(0, dtype=np.int64)
+        if len(term_ids) == 1:
+            return self.term_positions(term_ids[0])
+        postings = [self.term_positions(term_id) for term_id in term_ids]
+        # 从最短的倒排表出发，逐个词按偏移求交
+        rarest = min(range(len(term_ids)), key=lambda j: len(postings[j]))
+        starts = postings[rarest] - rarest
+        for j in sorted(range(len(term_ids)), key=lambda j: len(postings[j])):
+            if j != rarest and len(starts):
+                starts = starts[self._contains(postings[j], starts + j)]
+        starts = starts[starts >= 0]
+        # 整个短语须落在同一文档内
+        return starts[self.documents(starts) == self.documents(starts + len(term_ids) - 1)]
+
+    def near(self, starts_a, length_a, starts_b, length_b, distance):
+        """两个短语在同一文档中相隔不超过 distance 个词（不重叠，顺序不限）的文档号（升序去重）"""
+        if not len(starts_a) or not len(starts_b):
+            return np.zeros(0, dtype=np.int64)
+        docs = self.documents(starts_a)
+        doc_start, doc_end = self.token_offsets[docs], self.token_offsets[docs + 1]
+        # B 在 A 之后：A 之后最近的 B 起点须 <= a + la + k；B 在 A 之前：A 之前最近的 B 须 >= a - k - lb；都须在同一文档内
+        last = len(starts_b) - 1
+        following = np.searchsorted(starts_b, starts_a + length_a, side='left')
+        next_b = starts_b[np.minimum(following, last)]
+        after = (following <= last) & (next_b <= np.minimum(starts_a + length_a + distance, doc_end - length_b))
+        preceding = np.searchsorted(starts_b, starts_a - length_b, side='right') - 1
+        prev_b = starts_b[np.maximum(preceding, 0)]
+        before = (preceding >= 0) & (prev_b >= np.maximum(starts_a - distance - length_b, doc_start))
+        docs = docs[after | before]
+        # starts_a 升序，文档号也升序，相邻去重即可
+        return docs[np.concatenate(([True], docs[1:] != docs[:-1]))] if len(docs) else docs
+
+    def to_arrays(self):
+        return {'indptr': self.indptr, 'positions': self.positions}
+
+
+def fold_case(text):
+    # 小写化且不改变长度（个别字符小写后变成多个字符，保持原样），使字符位置与原文一致
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    return ''.join(char if len(char.lower()) != 1 else char.lower() for char in text)
+
+
+def regex_requirements(pattern):
+    """从正则中提取匹配必然包含的字面量：返回字面量字符串、('and', [...])、('or', [...])，无法约束时返回 None"""
+    return _sre_requirements(sre_parse.parse(pattern))
+
+
+def _sre_requirements(items):
+    parts, run = [], []
+
+    def flush():
+        if run:
+            parts.append(''.join(run))
+            run.clear()
+
+    for op, arg in items:
+        if op is sre_parse.LITERAL:
+            run.append(chr(arg))
+            continue
+        flush()
+        if op is sre_parse.SUBPATTERN:
+            parts.append(_sre_requirements(arg[-1]))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and arg[0] >= 1:
+            parts.append(_sre_requirements(arg[2]))
+        elif op is sre_parse.BRANCH:
+            branches = [_sre_requirements(branch) for branch in arg[1]]
+            parts.append(None if None in branches else ('or', branches))
+    flush()
+    parts = [part for part in parts if part is not None]
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else ('and', parts)
+
+
+class TrigramIndex:
+    # 消息正文的字符三元组倒排：正文小写化并在末尾补两个 \0，每个字符位置都开始一个三元组，
+    # 三个码位编码为一个 int64 键（各 21 位）。长度 >= 3 的字面量对其全部三元组求交；
+    # 1~2 个字符的字面量取以它开头的三元组键区间（倒排表在 rows 中连续）
+    CHAR_BITS = 21
+
+    def __init__(self, grams, indptr, rows, num_rows):
+        self.grams = grams  # 升序的三元组键
+        self.indptr = indptr  # 键 grams[i] 的消息行号位于 rows[indptr[i]:indptr[i+1]]（升序）
+        self.rows = rows
+        self.num_rows = num_rows  # 已建索引的消息行数
+
+    @classmethod
+    def build(cls, contents, num_rows, chunk_size=TRIGRAM_BUILD_CHUNK):
+        empty = cls(np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), 0)
+        return empty.add(contents, num_rows, chunk_size)
+
+    def add(self, contents, num_rows, chunk_size=TRIGRAM_BUILD_CHUNK):
+        """把正文列中 [self.num_rows, num_rows) 的行加入索引，返回新索引"""
+        chunks = [self._collect(contents, start, min(start + chunk_size, num_rows))
+                  for start in range(self.num_rows, num_rows, chunk_size)]
+        if not chunks:
+            return self
+        keys = np.concatenate([keys for keys, _ in chunks])
+        rows = np.concatenate([rows for _, rows in chunks])
+        order = np.argsort(keys, kind='stable') # 各批次内已按 (键, 行号) 排序，批次间行号递增
+        new_grams, new_counts = self._run_lengths(keys[order])
+        rows = rows[order]
+
+        # 与旧倒排表按键合并：每个键的旧行号在前、新行号在后
+        grams = self._run_lengths(np.sort(np.concatenate((self.grams, new_grams))))[0]
+        old_pos, new_pos = np.searchsorted(grams, self.grams), np.searchsorted(grams, new_grams)
+        old_counts = np.zeros(len(grams), dtype=np.int64)
+        old_counts[old_pos] = np.diff(self.indptr)
+        counts = old_counts.copy()
+        counts[new_pos] += new_counts
+        indptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        merged = np.empty(indptr[-1], dtype=np.int32)
+        merged[np.arange(len(self.rows)) + np.repeat(indptr[old_pos] - self.indptr[:-1], np.diff(self.indptr))] = self.rows
+        new_starts = np.concatenate(([0], np.cumsum(new_counts)))
+        merged[np.arange(len(rows)) + np.repeat(indptr[new_pos] + old_counts[new_pos] - new_starts[:-1], new_counts)] = rows
+        return TrigramIndex(grams, indptr, merged, num_rows)
+
+    @staticmethod
+    def _run_lengths(sorted_keys):
+        # 有序数组 -> (去重后的值, 各值出现次数)；比 np.unique 省去一次排序 / 哈希
+        if not len(sorted_keys):
+            return sorted_keys, np.zeros(0, dtype=np.int64)
+        starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+        return sorted_keys[starts], np.diff(np.append(starts, len(sorted_keys)))
+
+    @classmethod
+    def _collect(cls, contents, start, end):
+        # 一批消息的 (三元组键, 行号)，按键、行号排序并去重
+        # 整批正文一次解码（缓冲区写入时已保证是合法 UTF-8）
+        raw = bytes(contents.buffer[contents.offsets[start]:contents.offsets[end]])
+        codes = np.frombuffer(fold_case(raw.decode('utf-8')).encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+        # 字节偏移 -> 字符偏移：统计每个字节之前的非续字节数
+        char_starts = np.concatenate(([0], np.cumsum((np.frombuffer(raw, dtype=np.uint8) & 0xC0) != 0x80)))
+        char_offsets = char_starts[contents.offsets[start:end + 1] - contents.offsets[start]]
+
+        lengths = np.diff(char_offsets)
+        rows = np.repeat(np.arange(start, end, dtype=np.int32), lengths)
+        ends = np.repeat(char_offsets[1:], lengths)
+        positions = np.arange(len(codes))
+        padded = np.concatenate((codes, [0, 0]))
+        second = np.where(positions + 1 < ends, padded[positions + 1], 0)
+        third = np.where(positions + 2 < ends, padded[positions + 2], 0)
+        keys = (codes << (2 * cls.CHAR_BITS)) | (second << cls.CHAR_BITS) | third
+        order = np.argsort(keys, kind='stable') # 位置按行号递增，稳定排序后同键内行号仍升序
+        keys, rows = keys[order], rows[order]
+        keep = np.concatenate(([True], (keys[1:] != keys[:-1]) | (rows[1:] != rows[:-1])))[:len(keys)]
+        return keys[keep], rows[keep]
+
+    def _key(self, chars):
+        codes = [ord(char) for char in chars] + [0] * (3 - len(chars))
+        return (codes[0] << (2 * self.CHAR_BITS)) | (codes[1] << self.CHAR_BITS) | codes[2]
+
+    def _postings(self, lo, hi):
+        # 键区间 [lo, hi) 内全部三元组的行号（升序去重）
+        start, end = np.searchsorted(self.grams, lo), np.searchsorted(self.grams, hi)
+        rows = self.rows[self.indptr[start]:self.indptr[end]]
+        return rows if end - start <= 1 else np.unique(rows)
+
+    def literal_rows(self, literal):
+        """正文（小写化后）可能包含 literal 的消息行号（升序，需再校验）"""
+        literal = fold_case(literal)
+        if len(literal) < 3:
+            # 以该字面量开头的全部三元组
+            lo = self._key(literal)
+            return self._postings(lo, lo + (1 << (self.CHAR_BITS * (3 - len(literal)))))
+        keys = sorted({self._key(literal[i:i + 3]) for i in range(len(literal) - 2)})
+        postings = sorted((self._postings(key, key + 1) for key in keys), key=len)
+        rows = postings[0]
+        for other in postings[1:]:
+            if not len(rows):
+                break
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
+
+    def candidate_rows(self, requirement):
+        """regex_requirements 的结果 -> 候选消息行号"""
+        if isinstance(requirement, str):
+            return self.literal_rows(requirement)
+        op, parts = requirement
+        results = [self.candidate_rows(part) for part in parts]
+        if op == 'or':
+            return np.unique(np.concatenate(results))
+        results.sort(key=len)
+        rows = results[0]
+        for other in results[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
+
+    def to_arrays(self):
+        return {'grams': self.grams, 'indptr': self.indptr, 'rows': self.rows}
+
+
+PHONE_PATTERN = re.compile(r'\+?\d[\d\s\-()（）]{5,}\d')
+
+
+def normalize_phone(value):
+    """号码 -> 规范数字串：去掉空格、横线、括号等分隔符；+86 / 0086 开头的号码去掉国家码，
+    非手机号（不是 1 开头的 11 位）补回长途区号前的 0"""
+    text = str(value).strip()
+    digits = re.sub(r'\D', '', text)
+    if digits.startswith('0086'):
+        national = digits[4:]
+    elif text.startswith('+86') or (len(digits) == 13 and digits.startswith('861')):
+        national = digits[2:]
+    else:
+        return digits
+    return national if len(national) == 11 and national.startswith('1') else '0' + national.lstrip('0')
+
+
+def extract_phones(value):
+    # 字段中的全部号码（一个字段可能用逗号、分号等分隔多个号码），已规范化并去重
+    return list(dict.fromkeys(normalize_phone(match) for match in PHONE_PATTERN.findall(str(value or ''))))
+
+
+class PhoneIndex:
+    # 号码索引：规范化号码的有序数组做精确 / 前缀查找，逐位反转后的有序数组做尾号查找
+    # 号码和文档引用一一对应（一个联系人可有多个号码），追加时整体重排（号码数量远小于消息数）
+    EXACT_SCORE, PREFIX_SCORE, SUFFIX_SCORE = 3.0, 2.0, 1.0
+
+    def __init__(self, numbers=(), refs=()):
+        numbers = np.asarray(list(numbers), dtype=np.str_)
+        refs = np.asarray(list(refs), dtype=np.int64)
+        order = np.argsort(numbers, kind='stable')
+        self.numbers, self.refs = numbers[order], refs[order]
+        reversed_numbers = np.asarray([number[::-1] for number in self.numbers.tolist()], dtype=np.str_)
+        order = np.argsort(reversed_numbers, kind='stable')
+        self.reversed_numbers, self.reversed_refs = reversed_numbers[order], self.refs[order]
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def add(self, numbers, refs):
+        """追加 (号码, 引用)，返回新索引"""
+        if not numbers:
+            return self
+        return PhoneIndex(self.numbers.tolist() + list(numbers), self.refs.tolist() + list(refs))
+
+    @staticmethod
+    def _prefix_range(sorted_numbers, prefix):
+        # 以 prefix 开头的号码区间（号码只含数字，':' 排在 '9' 之后）
+        # 查询串不能长于数组的定长宽度，否则 searchsorted 会把整个数组转换为更宽的类型
+        width = sorted_numbers.dtype.itemsize // 4
+        if len(prefix) > width:
+            return 0, 0
+        start = np.searchsorted(sorted_numbers, prefix, side='left')
+        if len(prefix) == width:
+            return start, np.searchsorted(sorted_numbers, prefix, side='right')
+        return start, np.searchsorted(sorted_numbers, prefix + ':', side='left')
+
+    def search(self, digits, top_n=50):
+        """精确 > 前缀 > 尾号，返回 [(文档引用, 分数)]；同一引用只保留最高的一种匹配"""
+        if not digits or not len(self.numbers):
+            return []
+        start, end = self._prefix_range(self.numbers, digits)
+        exact_end = np.searchsorted(self.numbers[start:end], digits, side='right') + start
+        groups = [(self.refs[start:exact_end], self.EXACT_SCORE)]
+        if len(digits) >= PHONE_MIN_DIGITS:
+            groups.append((self.refs[exact_end:end], self.PREFIX_SCORE))
+            start, end = self._prefix_range(self.reversed_numbers, digits[::-1])
+            groups.append((self.reversed_refs[start:end], self.SUFFIX_SCORE))
+
+        hits, seen = [], set()
+        for refs, score in groups:
+            for ref in refs.tolist():
+                if ref not in seen:
+                    seen.add(ref)
+                    hits.append((ref, score))
+                    if len(hits) >= top_n:
+                        return hits
+        return hits
+
+    def to_arrays(self):
+        return {'numbers': self.numbers, 'refs': self.refs}
+
+
+class LSAIndex:
+    # LSA 语义索引：TF-IDF 经随机化 TruncatedSVD 降维为稠密向量（L2 归一化，float32），
+    # 用 IVF（球面 k-means 聚类 + 倒排列表）做近似最近邻；可选乘积量化（PQ）压缩向量，
+    # 量化的是向量与所属聚类中心的残差，内积 = q·中心 + q·残差（查表）
+    TRAIN_POINTS_PER_LIST = 40  # 每个聚类中心的训练样本数
+    KMEANS_ITERATIONS = 10
+    PQ_CENTROIDS = 256  # 每个子空间的码字数（编码为 uint8）
+    ASSIGN_CHUNK = 65536  # 分块计算向量与中心的内积，限制临时内存
+
+    def __init__(self, projection, centroids, list_indptr, list_doc_ids, vectors=None, codebooks=None, codes=None):
+        self.projection = projection  # TF-IDF 词数 x 维数（行连续），文档和查询的投影矩阵
+        self.centroids = centroids  # 列表数 x 维数
+        self.list_indptr = list_indptr  # 第 i 个列表的文档位于 [indptr[i], indptr[i+1])
+        self.list_doc_ids = list_doc_ids  # 按列表排列的文档号
+        self.vectors = vectors  # 按列表排列的文档向量（未量化时）
+        self.codebooks = codebooks  # PQ 码本：子向量数 x 256 x 子维数
+        self.codes = codes  # 按列表排列的 PQ 编码（量化时）
+
+    @classmethod
+    def build(cls, tfidf_matrix, dimensions=LSA_DIMENSIONS, n_lists=LSA_LISTS, pq_subvectors=LSA_PQ_SUBVECTORS, seed=42):
+        """由 TF-IDF 矩阵训练 LSA 投影和 IVF 索引；文档或词太少时返回 None"""
+        num_docs, num_terms = tfidf_matrix.shape
+        dimensions = min(dimensions, num_terms - 1, num_docs - 1)
+        if pq_subvectors:
+            dimensions -= dimensions % pq_subvectors # 维数需能被子向量数整除
+        if dimensions < 2:
+            return None
+        rng = np.random.default_rng(seed)
+        svd = TruncatedSVD(n_components=dimensions, algorithm='randomized', random_state=seed).fit(tfidf_matrix)
+        projection = np.ascontiguousarray(svd.components_.T, dtype=np.float32)
+        # 文档与查询用同一投影，保证分数可比
+        vectors = cls._normalize(np.asarray(tfidf_matrix @ projection, dtype=np.float32))
+
+        n_lists = n_lists or max(1, int(round(np.sqrt(num_docs))))
+        n_lists = min(n_lists, num_docs)
+        centroids = cls._kmeans(vectors, n_lists, rng, spherical=True)
+        codebooks = None
+        if pq_subvectors:
+            residuals = vectors - centroids[cls._nearest(vectors, centroids)]
+            sub_vectors = residuals.reshape(num_docs, pq_subvectors, -1)
+            codebooks = np.stack([cls._kmeans(sub_vectors[:, j], cls.PQ_CENTROIDS, rng, spherical=False)
+                                  for j in range(pq_subvectors)])
+        empty = cls(projection, centroids, np.zeros(n_lists + 1, dtype=np.int64),
+                    np.zeros(0, dtype=np.int64), codebooks=codebooks)
+        return empty.add(vectors, np.arange(num_docs, dtype=np.int64))
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    @classmethod
+    def _nearest(cls, vectors, centroids, spherical=True):
+        # 每个向量最近的中心：球面用内积最大，欧氏用 x·c - |c|²/2 最大
+        bias = None if spherical else -0.5 * np.einsum('ij,ij->i', centroids, centroids)
+        nearest = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), cls.ASSIGN_CHUNK):
+            scores = vectors[start:start + cls.ASSIGN_CHUNK] @ centroids.T
+            if bias is not None:
+                scores += bias
+            nearest[start:start + cls.ASSIGN_CHUNK] = scores.argmax(axis=1)
+        return nearest
+
+    @classmethod
+    def _kmeans(cls, vectors, k, rng, spherical=True):
+        # Lloyd k-means（在抽样上训练）；空簇用随机样本重新初始化
+        sample_size = min(len(vectors), k * cls.TRAIN_POINTS_PER_LIST)
+        sample = np.ascontiguousarray(vectors[rng.choice(len(vectors), size=sample_size, replace=False)], dtype=np.float32)
+        k = min(k, len(sample))
+        centroids = sample[rng.choice(len(sample), size=k, replace=False)].copy()
+        for _ in range(cls.KMEANS_ITERATIONS):
+            assignment = cls._nearest(sample, centroids, spherical)
+            membership = csr_matrix((np.ones(len(sample), dtype=np.float32), (assignment, np.arange(len(sample)))),
+                                    shape=(k, len(sample)))
+            counts = np.bincount(assignment, minlength=k)
+            sums = np.asarray(membership @ sample)
+            empty = counts == 0
+            centroids = sums / np.maximum(counts, 1)[:, None]
+            if empty.any():
+                centroids[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            if spherical:
+                centroids = cls._normalize(centroids)
+        return centroids.astype(np.float32)
+
+    @property
+    def num_terms(self):
+        return self.projection.shape[0]  # 训练时的 TF-IDF 词数
+
+    def covers(self, query_vector):
+        """查询词是否都在训练时的词表中（之后新增的词在投影中没有对应行）"""
+        return not len(query_vector.indices) or int(query_vector.indices.max()) < self.num_terms
+
+    def project(self, tfidf_rows):
+        """TF-IDF 行 -> 归一化的 LSA 向量（训练之后新增的词忽略）"""
+        width = self.num_terms
+        if tfidf_rows.shape[1] > width:
+            tfidf_rows = tfidf_rows[:, :width]
+        # 与投影矩阵同为 float32，避免 SciPy 把整个投影矩阵升为 float64
+        return self._normalize(np.asarray(tfidf_rows.astype(np.float32) @ self.projection))
+
+    def _encode(self, residuals):
+        m = len(self.codebooks)
+        sub_vectors = residuals.reshape(len(residuals), m, -1)
+        return np.stack([self._nearest(sub_vectors[:, j], self.codebooks[j], spherical=False) for j in range(m)],
+                        axis=1).astype(np.uint8)
+
+    def add(self, vectors, doc_ids):
+        """加入文档向量（沿用已训练的中心和码本），返回按列表重新排列的新索引（原索引不变，可并发查询）"""
+        n_lists = len(self.centroids)
+        old_lists = np.repeat(np.arange(n_lists), np.diff(self.list_indptr))
+        new_lists = self._nearest(vectors, self.centroids)
+        lists = np.concatenate((old_lists, new_lists))
+        order = np.argsort(lists, kind='stable')
+        list_indptr = np.searchsorted(lists[order], np.arange(n_lists + 1))
+        list_doc_ids = np.concatenate((self.list_doc_ids, doc_ids))[order]
+        if self.codebooks is not None:
+            old_codes = self.codes if self.codes is not None else np.zeros((0, len(self.codebooks)), dtype=np.uint8)
+            return LSAIndex(self.projection, self.centroids, list_indptr, list_doc_ids, codebooks=self.codebooks,
+                            codes=np.concatenate((old_codes, self._encode(vectors - self.centroids[new_lists])))[order])
+        old_vectors = self.vectors if self.vectors is not None else np.zeros((0, vectors.shape[1]), dtype=np.float32)
+        return LSAIndex(self.projection, self.centroids, list_indptr, list_doc_ids,
+                        vectors=np.concatenate((old_vectors, vectors))[order])
+
+    def search(self, query_vector, top_n=50, n_probe=LSA_PROBES):
+        """TF-IDF 查询向量 -> [(文档号, 余弦相似度)]，只扫描最近的 n_probe 个列表"""
+        query = self.project(query_vector)[0]
+        if not query.any():
+            return []
+        n_probe = min(n_probe, len(self.centroids))
+        centroid_scores = self.centroids @ query
+        probes = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        starts, ends = self.list_indptr[probes], self.list_indptr[probes + 1]
+        lengths = ends - starts
+        positions = np.arange(int(lengths.sum()), dtype=np.int64) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        if self.codebooks is not None:
+            # 非对称距离：查询子向量与码字的内积表查表求和
+            m = len(self.codebooks)
+            table = np.einsum('jd,jkd->jk', query.reshape(m, -1), self.codebooks)
+            scores = table[np.arange(m), self.codes[positions]].sum(axis=1) + np.repeat(centroid_scores[probes], lengths)
+        else:
+            scores = self.vectors[positions] @ query
+        return rank_top_k(self.list_doc_ids[positions], scores.astype(np.float64), top_n)
+
+    def to_arrays(self):
+        arrays = {'projection': self.projection, 'centroids': self.centroids,
+                  'list_indptr': self.list_indptr, 'list_doc_ids': self.list_doc_ids}
+        if self.codebooks is not None:
+            arrays.update({'codebooks': self.codebooks, 'codes': self.codes})
+        else:
+            arrays['vectors'] = self.vectors
+        return arrays
+
+
+class QueryHighlighter:
+    # 查询高亮器：查询词编译为一个正则，一次扫描找出所有词的全部出现位置（含重叠），
+    # 合并重叠/相邻的匹配后输出 【匹配】 标记和上下文窗口
+    def __init__(self, tokens=(), regex=None):
+        # 同一位置取最长的词即可覆盖该位置所有词的出现；零宽前瞻使每个位置都被尝试
+        # regex 为已编译的正则时直接高亮其匹配（子串 / 正则搜索）
+        if regex is not None:
+            self.pattern, self.group = regex, 0
+            return
+        tokens = sorted({token for token in tokens if token}, key=len, reverse=True)
+        self.pattern = re.compile('(?=(' + '|'.join(map(re.escape, tokens)) + '))') if tokens else None
+        self.group = 1
+
+    def highlight(self, text, window_size=20):
+        if not text or self.pattern is None:
+            return str(text) if text is not None else ''
+        text = str(text) 
+
+        # 合并重叠或相邻的匹配项
+        merged_matches = []
+        current_start = current_end = None
+        for match in self.pattern.finditer(text):
+            start, end = match.start(self.group), match.end(self.group)
+            if start == end:
+                continue
+            if current_end is not None and start <= current_end:
+                current_end = max(current_end, end)
+            else:
+                if current_end is not None:
+                    merged_matches.append((current_start, current_end))
+                current_start, current_end = start, end
+        if current_end is None:
+            return text # 没有匹配项则返回原文本
+        merged_matches.append((current_start, current_end))
+
+        # 带上下文的高亮字符串
+        parts = []
+        last_end = 0
+        for start, end in merged_matches:
+            context_start = max(0, start - window_size)
+            if context_start > last_end:
+                parts.append("... ")
+            parts.append(text[max(last_end, context_start):start])
+            parts.append(f"【{text[start:end]}】")
+            last_end = end
+
+        context_end = min(len(text), last_end + window_size)
+        parts.append(text[last_end:context_end])
+        # 上下文窗口未到达文本末尾，添加后缀省略号
+        if context_end < len(text):
+            parts.append(" ...")
+        return ''.join(parts)
 
 
 class EnhancedSearch:
     #  BM25+TF-IDF
-    def __init__(self):
-        self.message_df = None 
+    SNAPSHOT_VERSION = 8
+    SNAPSHOT_POINTER = 'CURRENT'  # 快照根目录下记录当前版本子目录名的文件
+    _snapshot_maps = {}  # 快照版本目录 -> 从中内存映射的数组（弱引用）；全部释放后目录才能删除
+
+    def __init__(self, bm25_mode=BM25_MODE, tokenize_workers=TOKENIZE_WORKERS, tokenizer=None,
+                 semantic_backend=SEMANTIC_BACKEND, store_positions=POSITIONAL_INDEX, store_trigrams=TRIGRAM_INDEX):
+        self.bm25_mode = bm25_mode
+        self.semantic_backend = semantic_backend
+        self.store_positions = store_positions
+        self.store_trigrams = store_trigrams
+        self.tokenize_workers = tokenize_workers
+        self.tokenizer = tokenizer or token_cache  # 带缓存的分词器
+        self.messages = MessageStore()  # 与 app_data['messages'] 共用的列式消息存储
+        self.indexed_messages = 0  # 已建索引的消息行数
         self.contact_df = None 
         self.bm25_index = None 
-        self.tfidf_vectorizer = None 
+        self.vocabulary = {}  # 词 -> 词ID（BM25 与 TF-IDF 共用）
+        self.token_ids = np.zeros(0, dtype=np.int32)  # 全部文档的词ID首尾相接
+        self.token_offsets = np.zeros(1, dtype=np.int64)  # 文档 i 的词ID位于 [offsets[i], offsets[i+1])
+        self.tfidf_vocabulary = {}  # 小写词 -> TF-IDF 列号
+        self.tfidf_columns = np.zeros(0, dtype=np.int32)  # 词ID -> TF-IDF 列号
+        self.tfidf_transformer = None 
+        self.tf_matrix = None  # 文档 x 词 的原始词频，追加数据时据此重算 TF-IDF
         self.tfidf_matrix = None 
-        self.doc_content = [] 
-        self.doc_metadata = []
-
-    def load_data(self, messages, contacts, wechat_groups, wechat_contacts):
-        # 消息 DataFrame
-        if messages:
-            self.message_df = pd.DataFrame(messages)
-            if 'time' in self.message_df.columns:
-                def parse_datetime(time_str):
-                    if isinstance(time_str, (int, float)):
-                        try: return pd.to_datetime(time_str, unit='s')
-                        except: return pd.NaT
-                    elif isinstance(time_str, str):
-                        try: return pd.to_datetime(time_str) # 尝试直接解析
-                        except ValueError:
-                            for fmt in ('%Y-%m-%d %H:%M:%S', '%Y/%m/%d %H:%M:%S'):
-                                try: return datetime.datetime.strptime(time_str, fmt)
-                                except ValueError: pass
-                            return pd.NaT 
-                    return pd.NaT 
-                self.message_df['time'] = self.message_df['time'].apply(parse_datetime)
-                self.message_df = self.message_df.dropna(subset=['time']) # 删除无法解析时间的行
-        else:
-            # 即使没有消息，DataFrame 也存在
-            self.message_df = pd.DataFrame(columns=['id', 'sender', 'content', 'time', 'is_sent', 'source_file'])
+        self.lsa_index = None  # semantic_backend 为 'lsa' 时的 LSA 近似最近邻索引
+        self.positional_index = None  # store_positions 时的词位置倒排（短语 / 邻近查询）
+        self.trigram_index = None  # store_trigrams 时消息正文的字符三元组索引（子串 / 正则搜索）
+        self.phone_index = PhoneIndex()  # 联系人、微信联系人、通话记录的号码索引
+        self.doc_refs = np.zeros(0, dtype=np.int64)  # 文档 -> 消息行号；非消息文档为 ~i，指向 doc_metadata[i]
+        self.doc_metadata = []  # 非消息文档（联系人、群组等）的元数据
+
+    def load_data(self, messages, contacts, wechat_groups, wechat_contacts, call_records=None):
+        # messages 可以是 MessageStore（直接共用）或消息 dict 列表
+        self.messages = messages if isinstance(messages, MessageStore) else MessageStore.from_records(messages)
+        self.indexed_messages = 0
+        self.contact_df = self._build_contact_df(contacts)
 
+        # 搜索索引
+        self._create_search_index(self._new_message_rows(), contacts, wechat_groups, wechat_contacts)
+        self.phone_index = PhoneIndex()
+        self._index_phones(0, call_records)
+        self.trigram_index = TrigramIndex.build(self.messages.contents, self.indexed_messages) if self.store_trigrams else None
+        self.messages.conversation_index() # 预建会话位置索引和发送者倒排
+        self.messages.sender_index()
+
+    def append_data(self, messages, contacts, wechat_groups, wechat_contacts, call_records=None):
+        # 增量追加数据：只对新增记录分词，在已有索引上更新统计量
+        # messages 为共用的 MessageStore 时，追加其中尚未建索引的行
+        if not len(self.doc_refs):
+            self.load_data(messages, contacts, wechat_groups, wechat_contacts, call_records)
+            return
+
+        if messages is not self.messages:
+            if isinstance(messages, MessageStore):
+                messages = messages.records(range(len(messages)))
+            self.messages.extend(messages or [])
+        if contacts:
+            self.contact_df = pd.concat([self.contact_df, self._build_contact_df(contacts)], ignore_index=True)
+
+        metadata_start = len(self.doc_metadata)
+        self._append_search_index(self._new_message_rows(), contacts, wechat_groups, wechat_contacts)
+        self._index_phones(metadata_start, call_records)
+        if self.trigram_index is not None:
+            self.trigram_index = self.trigram_index.add(self.messages.contents, self.indexed_messages)
+        self.messages.conversation_index()
+        self.messages.sender_index()
+
+    def appended(self, messages, contacts, wechat_groups, wechat_contacts, call_records=None):
+        """返回追加了新数据的新引擎，当前引擎不变（由 publish_search_engine 整体替换）
+
+        messages 为在当前消息存储上扩展出的新 MessageStore（见 MessageStore.extended）。
+        追加时会原地修改的词表、元数据和 BM25 统计量先复制，其余索引追加时本就生成新对象。"""
+        engine = copy.copy(self)
+        engine.messages = messages
+        engine.vocabulary = dict(self.vocabulary)
+        engine.tfidf_vocabulary = dict(self.tfidf_vocabulary)
+        engine.doc_metadata = list(self.doc_metadata)
+        if self.bm25_index is not None:
+            engine.bm25_index = copy.copy(self.bm25_index)
+            if self.bm25_index.vocabulary is self.vocabulary:
+                engine.bm25_index.vocabulary = engine.vocabulary
+        engine.append_data(messages, contacts, wechat_groups, wechat_contacts, call_records)
+        return engine
+
+    def _index_phones(self, metadata_start, call_records):
+        # 新增的联系人 / 微信联系人文档及通话记录的号码加入号码索引；
+        # 通话记录不参与分词，只作为元数据追加到 doc_metadata，由号码搜索引用
+        numbers, refs = [], []
+        for i in range(metadata_start, len(self.doc_metadata)):
+            metadata = self.doc_metadata[i]
+            if metadata.get('type') in ('contact', 'wechat_contact'):
+                for number in extract_phones(metadata.get('phone')):
+                    numbers.append(number)
+                    refs.append(~i)
+        for record in call_records or []:
+            raw_phones = [value for value in (record.get('phone'), record.get('details', {}).get('通话号码(sd)'))
+                          if extract_phones(value)]
+            if not raw_phones:
+                continue
+            phones = [number for value in raw_phones for number in extract_phones(value)]
+            ref = ~len(self.doc_metadata)
+            self.doc_metadata.append({
+                'type': 'call_record', 'id': record.get('id', ''), 'phone': raw_phones[0],
+                'time': record.get('time', ''), 'duration': record.get('duration', ''), 'call_type': record.get('call_type', '')
+            })
+            for number in dict.fromkeys(phones):
+                numbers.append(number)
+                refs.append(ref)
+        self.phone_index = self.phone_index.add(numbers, refs)
+
+    def _new_message_rows(self):
+        # 尚未建索引的消息行号
+        rows = range(self.indexed_messages, len(self.messages))
+        self.indexed_messages = len(self.messages)
+        return rows
+
+    def _build_contact_df(self, contacts):
         # 联系人 DataFrame
         if contacts:
             contact_data = []
@@ -173,34 +1673,24 @@ class EnhancedSearch:
                 if isinstance(contact.get('details'), dict):
                     flat_contact.update(contact['details']) # 合并详细信息
                 contact_data.append(flat_contact)
-            self.contact_df = pd.DataFrame(contact_data)
-        else:
-            # 即使没有联系人，DataFrame 也存在
-            self.contact_df = pd.DataFrame(columns=['id', 'name'])
-
-        # 搜索索引
-        self._create_search_index(messages, contacts, wechat_groups, wechat_contacts)
-
-    def _create_search_index(self, messages, contacts, wechat_groups, wechat_contacts):
-        # BM25+TF-IDF 索引
-        self.doc_content = []
-        self.doc_metadata = []
+            return pd.DataFrame(contact_data)
+        # 即使没有联系人，DataFrame 也存在
+        return pd.DataFrame(columns=['id', 'name'])
+
+    def _tokenize_documents(self, message_rows, contacts, wechat_groups, wechat_contacts):
+        # 生成文档：返回 (分词结果列表, 文档引用数组, 非消息文档元数据列表)
+        # 消息文档只记录行号，元数据在返回结果时从消息存储组装
+        store = self.messages
+        texts = [f"{store.senders[store.sender_ids[row]]} {store.contents[row]}" for row in message_rows]
+        refs = list(message_rows)
+        metadata_list = []
 
         def add_doc(text, metadata):
             # 添加文档到索引
             text = str(text) if text is not None else '' 
-            words = [word for word in jieba.cut(text) if word.strip()] 
-            self.doc_content.append(' '.join(words)) 
-            metadata['original_text'] = text 
-            self.doc_metadata.append(metadata)
-
-        # 添加消息数据
-        for msg in messages or []:
-            add_doc(f"{msg.get('sender', '')} {msg.get('content', '')}", {
-                'type': 'message', 'id': msg.get('id', ''), 'sender': msg.get('sender', ''),
-                'content': msg.get('content', ''), 'time': str(msg.get('time', '')),
-                'source': msg.get('source_file', ''), 'is_sent': msg.get('is_sent', False)
-            })
+            texts.append(text)
+            refs.append(~(len(self.doc_metadata) + len(metadata_list)))
+            metadata_list.append(metadata)
 
         # 添加联系人数据
         for contact in contacts or []:
@@ -224,334 +1714,1072 @@ class EnhancedSearch:
                  'remark': contact.get('remark', ''), 'group_name': contact.get('group_name', ''), 'phone': contact.get('phone', '')
              })
 
+        # 统一分词（重复文本只分一次，大语料并行）
+        tokenized_docs = self.tokenizer.tokenize_many(texts, workers=self.tokenize_workers)
+        logging.info(f"分词缓存统计：{self.tokenizer.stats()}")
+        return tokenized_docs, np.asarray(refs, dtype=np.int64), metadata_list
+
+    def _create_search_index(self, message_rows, contacts, wechat_groups, wechat_contacts):
+        # BM25+TF-IDF 索引
+        self.doc_metadata = []
+        tokenized_docs, self.doc_refs, self.doc_metadata = self._tokenize_documents(message_rows, contacts, wechat_groups, wechat_contacts)
+        self.vocabulary = {}
+        self.tfidf_vocabulary = {}
+        self.tfidf_columns = np.zeros(0, dtype=np.int32)
+        self.token_ids, self.token_offsets = self._encode(tokenized_docs)
+        del tokenized_docs # 之后只保留词ID
+
         # 仅当有内容时才添加索引
-        if self.doc_content:
-            tokenized_docs = [doc.split() for doc in self.doc_content]
-            self.bm25_index = BM25(tokenized_docs)
-            self.tfidf_vectorizer = TfidfVectorizer(analyzer='word', token_pattern=r'\S+')
-            self.tfidf_matrix = self.tfidf_vectorizer.fit_transform(self.doc_content)
+        if len(self.doc_refs):
+            self.tf_matrix = self._count_terms(self.token_ids, self.token_offsets)
+            self._update_tfidf()
+            self._build_lsa_index()
+            if self.store_positions:
+                self.positional_index = PositionalIndex.build(self.token_ids, self.token_offsets, len(self.vocabulary))
+            if self.bm25_mode == 'matrix':
+                # 复用 TF-IDF 词表的原始词频
+                self.bm25_index = BM25Matrix(self.tf_matrix, self.tfidf_vocabulary)
+            else:
+                self.bm25_index = BM25.from_token_ids(self.token_ids, self.token_offsets, self.vocabulary)
         else:
             # if没有内容，重置索引
             self.bm25_index = None
-            self.tfidf_vectorizer = None
+            self.tf_matrix = None
+            self.tfidf_transformer = None
             self.tfidf_matrix = None
+            self.lsa_index = None
+            self.positional_index = None
+
+    def _append_search_index(self, message_rows, contacts, wechat_groups, wechat_contacts):
+        # 追加索引：新文档ID接在已有文档之后，只对新文档分词和计数
+        tokenized_docs, refs, metadata_list = self._tokenize_documents(message_rows, contacts, wechat_groups, wechat_contacts)
+        if not tokenized_docs:
+            return
+        new_ids, new_offsets = self._encode(tokenized_docs)
+        del tokenized_docs
+        # 先追加元数据再更新索引，查询线程拿到的文档ID始终有效
+        self.doc_metadata.extend(metadata_list)
+        self.doc_refs = np.concatenate((self.doc_refs, refs))
+        self.token_offsets = np.concatenate((self.token_offsets, new_offsets[1:] + len(self.token_ids)))
+        self.token_ids = np.concatenate((self.token_ids, new_ids))
+
+        new_tf = self._count_terms(new_ids, new_offsets)
+        old_tf = self.tf_matrix
+        old_tf = csr_matrix((old_tf.data, old_tf.indices, old_tf.indptr), shape=(old_tf.shape[0], new_tf.shape[1]))
+        self.tf_matrix = sparse_vstack([old_tf, new_tf], format='csr')
+        self._update_tfidf()
+        lsa_index = self.lsa_index
+        if lsa_index is not None and self.tfidf_matrix.shape[1] <= lsa_index.num_terms * (1 + LSA_REBUILD_VOCAB_GROWTH):
+            # 新文档按已训练的投影和聚类加入（旧文档的向量不随 IDF 变化重算，新词不在投影中）；
+            # 新词较多时走下面的分支重新训练
+            new_rows = self.tfidf_matrix[old_tf.shape[0]:]
+            self.lsa_index = lsa_index.add(lsa_index.project(new_rows),
+                                           np.arange(old_tf.shape[0], self.tfidf_matrix.shape[0], dtype=np.int64))
+        else:
+            self._build_lsa_index()
+        if self.positional_index is not None:
+            self.positional_index = self.positional_index.add(new_ids, self.token_offsets)
+        if self.bm25_mode == 'matrix':
+            self.bm25_index = BM25Matrix(self.tf_matrix, self.tfidf_vocabulary,
+                                         k1=self.bm25_index.k1, b=self.bm25_index.b)
+        else:
+            self.bm25_index.add_token_ids(new_ids, new_offsets)
+
+    def _encode(self, tokenized_docs):
+        # 分词结果 -> 共用词表的词ID缓冲区；新词同时登记其小写形式的 TF-IDF 列号
+        new_columns = []
+        def on_new_token(word):
+            new_columns.append(self.tfidf_vocabulary.setdefault(word.lower(), len(self.tfidf_vocabulary)))
+        token_ids, offsets = encode_documents(tokenized_docs, self.vocabulary, on_new_token)
+        self.tfidf_columns = np.concatenate((self.tfidf_columns, np.asarray(new_columns, dtype=np.int32)))
+        return token_ids, offsets
+
+    def _count_terms(self, token_ids, offsets):
+        # 由词ID缓冲区统计 文档 x TF-IDF 列 的词频（大小写不同的词合并到同一列）
+        num_docs = len(offsets) - 1
+        rows = np.repeat(np.arange(num_docs, dtype=np.int64), np.diff(offsets))
+        counts = csr_matrix((np.ones(len(token_ids), dtype=np.float64), (rows, self.tfidf_columns[token_ids])),
+                            shape=(num_docs, len(self.tfidf_vocabulary)))
+        counts.sum_duplicates()
+        return counts
+
+    def _update_tfidf(self):
+        # 由原始词频重算 IDF 和 TF-IDF 矩阵（无需重新分词）
+        # 按列（词）存储、float32，语义搜索时按查询词取倒排表
+        transformer = TfidfTransformer().fit(self.tf_matrix)
+        self.tfidf_matrix = transformer.transform(self.tf_matrix).astype(np.float32).tocsc()
+        self.tfidf_transformer = transformer
+
+    def _build_lsa_index(self):
+        # semantic_backend 为 'lsa' 时训练 LSA 投影和 IVF 索引
+        if self.semantic_backend != 'lsa':
+            return
+        start = time.perf_counter()
+        self.lsa_index = LSAIndex.build(self.tfidf_matrix)
+        logging.info(f"LSA 索引构建完成，用时 {time.perf_counter() - start:.1f}s")
+
+    def _tfidf_query_vector(self, query_tokens):
+        # 查询词 -> TF-IDF 向量（词表外的词忽略）
+        num_columns = self.tfidf_matrix.shape[1]
+        term_counts = Counter(self.tfidf_vocabulary[word.lower()] for word in query_tokens
+                              if self.tfidf_vocabulary.get(word.lower(), num_columns) < num_columns)
+        query_counts = csr_matrix((np.asarray(list(term_counts.values()), dtype=np.float64),
+                                   (np.zeros(len(term_counts), dtype=np.int32), np.asarray(list(term_counts.keys()), dtype=np.int32))),
+                                  shape=(1, num_columns))
+        return self.tfidf_transformer.transform(query_counts)
+
+    def save_snapshot(self, path, extra=None):
+        # 索引快照：数组存为 .npy（加载时内存映射），词表/元数据等对象存为 pickle
+        # 每次写入 path 下新的版本子目录，写完后替换 CURRENT 指向它；正在使用的旧版本可能仍被内存映射
+        # （Windows 下无法删除），由 _remove_stale_snapshots 在不再映射后删除
+        version = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        version_path = os.path.join(path, version)
+        tmp_path = version_path + '.tmp'
+        os.makedirs(tmp_path)
+
+        message_arrays, message_objects = self.messages.to_arrays()
+        arrays = {f'msg_{name}': array for name, array in message_arrays.items()}
+        arrays.update({'token_ids': self.token_ids, 'token_offsets': self.token_offsets,
+                       'tfidf_columns': self.tfidf_columns, 'doc_refs': self.doc_refs})
+        if self.tf_matrix is not None:
+            arrays.update({
+                'tf_data': self.tf_matrix.data, 'tf_indices': self.tf_matrix.indices, 'tf_indptr': self.tf_matrix.indptr,
+                'tfidf_data': self.tfidf_matrix.data, 'tfidf_indices': self.tfidf_matrix.indices,
+                'tfidf_indptr': self.tfidf_matrix.indptr, 'tfidf_idf': self.tfidf_transformer.idf_
+            })
+        if self.bm25_index is not None and not isinstance(self.bm25_index, BM25Matrix):
+            # 矩阵模式可由原始词频直接重建，只需保存倒排表模式的数组
+            arrays.update({
+                'bm25_indptr': self.bm25_index.postings_indptr, 'bm25_doc_ids': self.bm25_index.postings_doc_ids,
+                'bm25_tf': self.bm25_index.postings_tf, 'bm25_doc_len': self.bm25_index.doc_len
+            })
+        if self.lsa_index is not None:
+            arrays.update({f'lsa_{name}': array for name, array in self.lsa_index.to_arrays().items()})
+        if self.positional_index is not None:
+            arrays.update({f'positions_{name}': array for name, array in self.positional_index.to_arrays().items()})
+        if self.trigram_index is not None:
+            arrays.update({f'trigram_{name}': array for name, array in self.trigram_index.to_arrays().items()})
+        arrays.update({f'phone_{name}': array for name, array in self.phone_index.to_arrays().items()})
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f'{name}.npy'), np.asarray(array))
+
+        objects = {
+            'doc_metadata': self.doc_metadata, 'vocabulary': self.vocabulary,
+            'tfidf_vocabulary': self.tfidf_vocabulary,
+            'messages': message_objects, 'contact_df': self.contact_df, 'extra': extra
+        }
+        with open(os.path.join(tmp_path, 'objects.pkl'), 'wb') as f:
+            pickle.dump(objects, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        manifest = {
+            'version': self.SNAPSHOT_VERSION, 'bm25_mode': self.bm25_mode,
+            'semantic_backend': self.semantic_backend,
+            'lsa_arrays': sorted(self.lsa_index.to_arrays()) if self.lsa_index is not None else [],
+            'positional_index': self.positional_index is not None,
+            'trigram_rows': self.trigram_index.num_rows if self.trigram_index is not None else None,
+            'k1': self.bm25_index.k1 if self.bm25_index is not None else None,
+            'b': self.bm25_index.b if self.bm25_index is not None else None,
+            'num_docs': len(self.doc_refs), 'created': datetime.datetime.now().isoformat()
+        }
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=4)
+
+        os.replace(tmp_path, version_path)
+        pointer_tmp = os.path.join(path, self.SNAPSHOT_POINTER + '.tmp')
+        with open(pointer_tmp, 'w', encoding='utf-8') as f:
+            f.write(version)
+        os.replace(pointer_tmp, os.path.join(path, self.SNAPSHOT_POINTER))
+        self._remove_stale_snapshots(path, version_path)
+
+    @classmethod
+    def _snapshot_in_use(cls, version_path):
+        return any(ref() is not None for ref in cls._snapshot_maps.get(os.path.abspath(version_path), ()))
+
+    @classmethod
+    def _remove_stale_snapshots(cls, path, current_path):
+        # 删除 current_path 以外、已没有数组映射的版本目录（包括未写完的 .tmp 目录和旧版单目录布局的文件）
+        for name in os.listdir(path):
+            entry = os.path.join(path, name)
+            if name.startswith(cls.SNAPSHOT_POINTER) or entry == current_path:
+                continue
+            if os.path.isdir(entry):
+                if cls._snapshot_in_use(entry):
+                    continue
+                try:
+                    shutil.rmtree(entry)
+                    cls._snapshot_maps.pop(os.path.abspath(entry), None)
+                except OSError as e:
+                    logging.info(f"旧索引快照 {entry} 暂时无法删除，下次保存时重试：{e}")
+            elif not cls._snapshot_in_use(path):
+                try:
+                    os.remove(entry)
+                except OSError as e:
+                    logging.info(f"旧索引快照文件 {entry} 暂时无法删除，下次保存时重试：{e}")
+
+    @classmethod
+    def snapshot_path(cls, path):
+        """path 下当前快照所在的目录（CURRENT 指向的版本，或旧版直接存放在 path 中），没有快照返回 None"""
+        pointer = os.path.join(path, cls.SNAPSHOT_POINTER)
+        if os.path.exists(pointer):
+            with open(pointer, 'r', encoding='utf-8') as f:
+                return os.path.join(path, f.read().strip())
+        if os.path.exists(os.path.join(path, 'manifest.json')):
+            return path
+        return None
+
+    @classmethod
+    def load_snapshot(cls, path):
+        # 加载索引快照，返回 (搜索引擎, 附加数据)；数组以只读内存映射方式打开
+        path = cls.snapshot_path(path)
+        if path is None:
+            raise FileNotFoundError("没有索引快照")
+        maps = cls._snapshot_maps.setdefault(os.path.abspath(path), [])
+        with open(os.path.join(path, 'manifest.json'), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != cls.SNAPSHOT_VERSION:
+            raise ValueError(f"不支持的索引快照版本：{manifest.get('version')}")
+        with open(os.path.join(path, 'objects.pkl'), 'rb') as f:
+            objects = pickle.load(f)
+
+        def load_array(name):
+            array = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+            maps.append(weakref.ref(array))  # 视图通过 base 引用此数组，数组存活期间文件保持映射
+            return array
+
+        engine = cls(bm25_mode=manifest['bm25_mode'], semantic_backend=manifest['semantic_backend'],
+                     store_positions=manifest['positional_index'], store_trigrams=manifest['trigram_rows'] is not None)
+        engine.messages = MessageStore.from_arrays(
+            {name: load_array(f'msg_{name}') for name in MessageStore.ARRAY_NAMES}, objects['messages'])
+        engine.indexed_messages = len(engine.messages)
+        engine.messages.conversation_index()
+        engine.messages.sender_index()
+        if manifest['trigram_rows'] is not None:
+            engine.trigram_index = TrigramIndex(load_array('trigram_grams'), load_array('trigram_indptr'),
+                                                load_array('trigram_rows'), manifest['trigram_rows'])
+        engine.contact_df = objects['contact_df']
+        engine.doc_refs = load_array('doc_refs')
+        engine.doc_metadata = objects['doc_metadata']
+        engine.phone_index = PhoneIndex(load_array('phone_numbers'), load_array('phone_refs'))
+        engine.vocabulary = objects['vocabulary']
+        engine.tfidf_vocabulary = objects['tfidf_vocabulary']
+        engine.token_ids = load_array('token_ids')
+        engine.token_offsets = load_array('token_offsets')
+        engine.tfidf_columns = load_array('tfidf_columns')
+
+        num_docs = manifest['num_docs']
+        if num_docs:
+            shape = (num_docs, len(engine.tfidf_vocabulary))
+            engine.tf_matrix = csr_matrix((load_array('tf_data'), load_array('tf_indices'), load_array('tf_indptr')), shape=shape)
+            engine.tfidf_matrix = csc_matrix((load_array('tfidf_data'), load_array('tfidf_indices'), load_array('tfidf_indptr')), shape=shape)
+            transformer = TfidfTransformer()
+            transformer.idf_ = np.array(load_array('tfidf_idf'))
+            transformer.n_features_in_ = shape[1]
+            engine.tfidf_transformer = transformer
+            if manifest['lsa_arrays']:
+                engine.lsa_index = LSAIndex(**{name: load_array(f'lsa_{name}') for name in manifest['lsa_arrays']})
+            if manifest['positional_index']:
+                engine.positional_index = PositionalIndex(load_array('positions_indptr'), load_array('positions_positions'),
+                                                          engine.token_offsets)
+            if engine.bm25_mode == 'matrix':
+                engine.bm25_index = BM25Matrix(engine.tf_matrix, engine.tfidf_vocabulary, k1=manifest['k1'], b=manifest['b'])
+            else:
+                engine.bm25_index = BM25.from_arrays(
+                    engine.vocabulary, load_array('bm25_indptr'), load_array('bm25_doc_ids'),
+                    load_array('bm25_tf'), load_array('bm25_doc_len'), k1=manifest['k1'], b=manifest['b'])
+        return engine, objects.get('extra')
+
+    def set_bm25_params(self, k1=None, b=None):
+        # 调整 BM25 参数（保留原始词频，不重建索引）
+        if self.bm25_index is not None:
+            self.bm25_index.set_params(k1=k1, b=b)
+
+    def document(self, idx):
+        # 文档号 -> 搜索结果元数据（消息按行组装）
+        return self.resolve(int(self.doc_refs[idx]))
+
+    def resolve(self, ref):
+        # 文档引用 -> 元数据：ref >= 0 为消息行号，否则为 doc_metadata[~ref]
+        if ref < 0:
+            return self.doc_metadata[~ref]
+        return self._message_document(ref)
+
+    def _message_document(self, row):
+        store = self.messages
+        return {
+            'type': 'message', 'id': store.ids[row], 'sender': store.senders[store.sender_ids[row]],
+            'content': store.contents[row], 'time': str(store.time_str(row)),
+            'source': store.sources[store.source_ids[row]], 'is_sent': bool(store.is_sent[row])
+        }
 
-    def keyword_search(self, query, top_n=50):
-        # BM25关键字搜索
+    def _result_key(self, ref):
+        # 去重键 (类型, ID)，消息只解码ID
+        if ref < 0:
+            metadata = self.doc_metadata[~ref]
+            return metadata.get('type', 'unknown'), metadata.get('id', 'no_id')
+        return 'message', self.messages.ids[ref]
+
+    def materialize(self, hits):
+        """(文档引用, 分数, 匹配类型) 列表 -> 搜索结果 dict 列表"""
+        return [dict(self.resolve(ref), score=score, match_type=match_type) for ref, score, match_type in hits]
+
+    def unique_hits(self, hits):
+        """去掉 (类型, ID) 重复的结果，保留排名靠前的"""
+        seen = set()
+        unique = []
+        for hit in hits:
+            result_key = self._result_key(hit[0])
+            if result_key not in seen:
+                seen.add(result_key)
+                unique.append(hit)
+        return unique
+
+    def ranked_search(self, query, search_type='combined', top_n=50):
+        """按搜索类型返回排序后的 (文档引用, 分数, 匹配类型) 列表，不组装元数据"""
+        if search_type == 'sender': return self._sender_hits(query, top_n)
+        if search_type == 'keyword': return self._keyword_hits(query, top_n)
+        if search_type == 'semantic': return self._semantic_hits(query, top_n)
+        if search_type == 'substring': return self._substring_hits(query, top_n)
+        if search_type == 'regex': return self._regex_hits(query, top_n)
+        if search_type == 'phone': return self._phone_hits(query, top_n)
+        return self._combined_hits(query, top_n)
+
+    def keyword_search(self, query, top_n=50, pruning=True):
+        return self.materialize(self._keyword_hits(query, top_n, pruning))
+
+    def _keyword_hits(self, query, top_n=50, pruning=True):
         if not self.bm25_index or not query:
             return []
-        query_tokens = [word for word in jieba.cut(query) if word.strip()] 
-        results = self.bm25_index.search(query_tokens, top_n=top_n)
+        clauses = parse_proximity_query(query)
+        if clauses is not None:
+            return self._proximity_hits(clauses, top_n)
+        results = self._keyword_results(self.tokenizer.tokenize(query), top_n, pruning)
+        return [(int(self.doc_refs[idx]), score, 'keyword') for idx, score in results]
+
+    def _keyword_results(self, query_tokens, top_n=50, pruning=True):
+        # BM25关键字搜索，pruning 时使用动态剪枝的 top-k（结果不变），返回 [(文档号, 分数)]
+        bm25_index = self.bm25_index
+        if not bm25_index or not query_tokens:
+            return []
+        if pruning:
+            results = bm25_index.search_pruned(query_tokens, top_n=top_n)
+        else:
+            results = bm25_index.search(query_tokens, top_n=top_n)
         # 确保索引有效
-        return [dict(self.doc_metadata[idx], score=score, match_type='keyword')
-                for idx, score in results if idx < len(self.doc_metadata)]
+        return [(idx, score) for idx, score in results if idx < len(self.doc_refs)]
 
     def semantic_search(self, query, top_n=50):
-        # TF-IDF 和余弦相似度进行语义搜索
-        if not self.tfidf_vectorizer or not self.tfidf_matrix is not None or not query:
-            return []
-        query_tokens = ' '.join([word for word in jieba.cut(query) if word.strip()]) 
-        query_vector = self.tfidf_vectorizer.transform([query_tokens])
-        cosine_similarities = cosine_similarity(query_vector, self.tfidf_matrix).flatten()
-        actual_top_n = min(top_n, self.tfidf_matrix.shape[0]) 
-        top_indices = np.argsort(cosine_similarities)[::-1][:actual_top_n] 
-        # 索引有效且分数大于 0
-        return [dict(self.doc_metadata[idx], score=float(cosine_similarities[idx]), match_type='semantic')
-                for idx in top_indices if cosine_similarities[idx] > 0 and idx < len(self.doc_metadata)]
-
-    def combined_search(self, query, top_n=50):
-        # 结合关键字搜索和语义搜索的结果
-        keyword_results = self.keyword_search(query, top_n=top_n * 2)
-        semantic_results = self.semantic_search(query, top_n=top_n * 2) 
+        return self.materialize(self._semantic_hits(query, top_n))
 
-        result_dict = {}
-        def get_result_key(res):
-            res_type = res.get('type', 'unknown')
-            res_id = res.get('id', 'no_id')
-            return f"{res_type}_{res_id}"
-
-        # 处理结果，优先保留分数更高的结果
-        for result in keyword_results + semantic_results:
-             if isinstance(result, dict): 
-                 result_key = get_result_key(result)
-                 current_score = result.get('score', 0)
-                 if result_key not in result_dict or current_score > result_dict[result_key].get('score', 0):
-                    result_dict[result_key] = result
-
-        # 排序
-        combined_results = sorted(result_dict.values(), key=lambda x: x.get('score', 0), reverse=True)
+    def _semantic_hits(self, query, top_n=50):
+        if not query:
+            return []
+        results = self._semantic_results(self.tokenizer.tokenize(query), top_n)
+        return [(int(self.doc_refs[idx]), score, 'semantic') for idx, score in results]
 
-        return combined_results[:top_n]
+    def _semantic_results(self, query_tokens, top_n=50):
+        # 语义搜索：默认 TF-IDF 余弦，启用 LSA 时查近似最近邻索引，返回 [(文档号, 分数)]
+        if self.tfidf_transformer is None or self.tfidf_matrix is None or not query_tokens:
+            return []
+        query_vector = self._tfidf_query_vector(query_tokens)
+        lsa_index = self.lsa_index
+        if lsa_index is not None and lsa_index.covers(query_vector):
+            results = lsa_index.search(query_vector, top_n)
+        else:
+            # 查询含 LSA 训练之后追加的新词时，改用精确的 TF-IDF 检索，避免这些词被忽略
+            results = tfidf_top_k(self.tfidf_matrix, query_vector, top_n)
+        # 索引有效且分数大于 0
+        return [(idx, score) for idx, score in results if idx < len(self.doc_refs)]
 
-    def highlight_matches(self, text, query, window_size=20):
-        # 高亮+上下文窗口
-        if not text or not query:
-            return str(text) if text is not None else ''
-        text = str(text) 
+    def combined_search(self, query, top_n=50, fusion=HYBRID_FUSION):
+        return self.materialize(self._combined_hits(query, top_n, fusion))
 
-        query_tokens = [word for word in jieba.cut(query) if word.strip()] 
-        matches = []
-        for token in query_tokens:
-            start = 0
-            while True:
-                pos = text.find(token, start)
-                if pos == -1:
-                    break # 未找到则退出循环
-                matches.append((pos, pos + len(token)))
-                start = pos + 1 
+    def _combined_hits(self, query, top_n=50, fusion=HYBRID_FUSION):
+        # 综合搜索：关键词检索在线程池中与语义检索并行，两路结果按文档号做排名融合
+        if not query:
+            return []
+        clauses = parse_proximity_query(query)
+        if clauses is not None:
+            return self._proximity_hits(clauses, top_n) # 短语 / 邻近查询只做精确匹配
+        query_tokens = self.tokenizer.tokenize(query)
+        keyword_future = hybrid_executor.submit(self._keyword_results, query_tokens, top_n * 2)
+        semantic_results = self._semantic_results(query_tokens, top_n * 2)
+        keyword_results = keyword_future.result()
+
+        # 融合后按 (类型, ID) 去重，只为最终的 top_n 取文档引用
+        keyword_docs = {idx for idx, _ in keyword_results}
+        seen = set()
+        hits = []
+        for idx, score in fuse_rankings([keyword_results, semantic_results], method=fusion):
+            ref = int(self.doc_refs[idx])
+            result_key = self._result_key(ref)
+            if result_key in seen:
+                continue
+            seen.add(result_key)
+            hits.append((ref, score, 'keyword' if idx in keyword_docs else 'semantic'))
+            if len(hits) >= top_n:
+                break
+        return hits
 
-        if not matches:
-            return text # 没有匹配项则返回原文本
+    def _proximity_docs(self, clauses):
+        """短语 / 邻近子句 -> 同时满足全部子句的文档号（升序）；未建词位置索引时返回 None"""
+        index = self.positional_index
+        if index is None:
+            return None
 
-        matches.sort(key=lambda x: x[0])
+        def operand(text):
+            # 操作数分词后按词ID求短语出现位置，返回 (起点, 词数)
+            term_ids = [self.vocabulary.get(word) for word in self.tokenizer.tokenize(text)]
+            if not term_ids or None in term_ids:
+                return np.zeros(0, dtype=np.int64), 0
+            return index.phrase(term_ids), len(term_ids)
+
+        docs = None
+        for clause in clauses:
+            if clause[0] == 'near':
+                (starts_a, length_a), (starts_b, length_b) = operand(clause[1]), operand(clause[2])
+                clause_docs = index.near(starts_a, length_a, starts_b, length_b, clause[3])
+            else:
+                clause_docs = np.unique(index.documents(operand(clause[1])[0]))
+            docs = clause_docs if docs is None else np.intersect1d(docs, clause_docs, assume_unique=True)
+            if not len(docs):
+                break
+        return docs
 
-        # 合并重叠或相邻的匹配项
-        merged_matches = []
-        if matches:
-            current_start, current_end = matches[0]
-            for start, end in matches[1:]:
-                if start <= current_end:
-                    current_end = max(current_end, end)
-                else:
-                    merged_matches.append((current_start, current_end))
-                    current_start, current_end = start, end
-            # 添加最后一个合并项
-            merged_matches.append((current_start, current_end))
+    def _proximity_hits(self, clauses, top_n=50):
+        # 短语 / 邻近查询：词位置索引筛选文档，再按全部操作数的 BM25 分数排序
+        docs = self._proximity_docs(clauses)
+        if docs is None or not len(docs) or not self.bm25_index:
+            return []
+        query_tokens = self._proximity_tokens(clauses)
+        results = rank_top_k(docs, self.bm25_index.score_docs(query_tokens, docs), top_n)
+        return [(int(self.doc_refs[idx]), score, 'keyword') for idx, score in results]
 
-        # 带上下文的高亮字符串
-        highlighted = ""
-        last_end = 0
-        for start, end in merged_matches:
-            context_start = max(0, start - window_size)
-            prefix = "... " if context_start > last_end else ""
-            highlighted += prefix + text[max(last_end, context_start):start]
-            highlighted += f"【{text[start:end]}】"
-            last_end = end
+    def _proximity_tokens(self, clauses):
+        # 各子句操作数的分词结果（去掉引号和 NEAR/k）
+        return [word for clause in clauses for text in clause[1:3] for word in self.tokenizer.tokenize(text)]
 
+    def _substring_hits(self, query, top_n=50):
+        # 子串搜索（不区分大小写）：三元组索引取候选，再逐条校验
+        if self.trigram_index is None or not query:
+            return []
+        needle = fold_case(query)
+        return self._verified_hits(self.trigram_index.literal_rows(query),
+                                   lambda content: needle in fold_case(content), top_n, 'substring')
 
-        context_end = min(len(text), last_end + window_size)
-        # 上下文窗口未到达文本末尾，添加后缀省略号
-        suffix = " ..." if context_end < len(text) else ""
-        highlighted += text[last_end:context_end] + suffix
+    def _regex_hits(self, query, top_n=50):
+        # 正则搜索：从正则中提取必需的字面量查三元组索引，只校验候选；正则无效或没有字面量时抛出 ValueError
+        if self.trigram_index is None or not query:
+            return []
+        try:
+            pattern = re.compile(query)
+            requirement = regex_requirements(query)
+        except re.error as e:
+            raise ValueError(f"无效的正则表达式：{e}")
+        if requirement is None:
+            raise ValueError("正则表达式中没有必须出现的普通字符，无法使用索引，请至少包含一个字面字符")
+        return self._verified_hits(self.trigram_index.candidate_rows(requirement),
+                                   lambda content: pattern.search(content) is not None, top_n, 'regex')
+
+    def _phone_hits(self, query, top_n=50):
+        # 号码搜索：查询规范化为数字后按精确、前缀、尾号匹配联系人 / 微信联系人 / 通话记录
+        return [(ref, score, 'phone') for ref, score in self.phone_index.search(normalize_phone(query), top_n)]
+
+    def _verified_hits(self, rows, predicate, top_n, match_type):
+        # 候选行按时间降序逐条校验正文，凑满 top_n 条即停止
+        store = self.messages
+        rows = rows[np.argsort(store.time_rank()[rows], kind='stable')]
+        hits = []
+        for row in rows:
+            if predicate(store.contents[row]):
+                hits.append((int(row), 1.0, match_type))
+                if len(hits) >= top_n:
+                    break
+        return hits
+
+    def highlighter(self, query, search_type='combined'):
+        """为查询编译一个高亮器，同一请求内的多段文本共用"""
+        if not query:
+            return QueryHighlighter([])
+        if search_type == 'substring':
+            return QueryHighlighter(regex=re.compile(re.escape(query), re.IGNORECASE))
+        if search_type == 'phone':
+            # 原始号码中的数字之间可能有空格、横线等分隔符
+            digits = normalize_phone(query)
+            return QueryHighlighter(regex=re.compile(r'[\s\-()（）]*'.join(digits)) if digits else None)
+        if search_type == 'regex':
+            try:
+                return QueryHighlighter(regex=re.compile(query))
+            except re.error:
+                return QueryHighlighter([])
+        clauses = parse_proximity_query(query)
+        return QueryHighlighter(self.tokenizer.tokenize(query) if clauses is None else self._proximity_tokens(clauses))
 
-        return highlighted
+    def highlight_matches(self, text, query, window_size=20):
+        # 高亮+上下文窗口（单次调用；批量高亮请用 highlighter）
+        return self.highlighter(query).highlight(text, window_size)
 
     def search_by_sender(self, sender_name, top_n=50):
-        # 按发件人姓名搜索消息
-        if self.message_df is None or self.message_df.empty or 'sender' not in self.message_df.columns:
-            return []
-
-        sender_series = self.message_df['sender'].astype(str).fillna('')
+        # 格式化结果以与其他搜索方法保持一致
+        return self.materialize(self._sender_hits(sender_name, top_n))
 
-        # 不区分大小写的搜索
-        matched_messages = self.message_df[sender_series.str.contains(sender_name, na=False, case=False)]
+    def _sender_hits(self, sender_name, top_n=50):
+        return [(int(row), 1.0, 'sender') for row in self.sender_rows(sender_name)[:top_n]]
 
-        # 前 N 个结果
-        results = matched_messages.head(top_n).to_dict('records')
+    def sender_rows(self, sender_name):
+        """按发件人姓名（不区分大小写的正则/子串）查找消息，返回按时间降序的全部行号
 
-        # 格式化结果以与其他搜索方法保持一致
-        search_results = []
-        for msg in results:
-            search_results.append({
-                'type': 'message',
-                'id': msg.get('id', ''),
-                'sender': msg.get('sender', ''),
-                'content': msg.get('content', ''),
-                'time': str(msg.get('time', '')), # 将时间转换为字符串
-                'source': msg.get('source_file', ''),
-                'score': 1.0, 
-                'match_type': 'sender',
-                'original_text': f"{msg.get('sender', '')} {msg.get('content', '')}", 
-                'is_sent': msg.get('is_sent', False)
-            })
-        return search_results
+        先在驻留的发送者名称里匹配，再合并这些发送者的倒排行号。"""
+        store = self.messages
+        if not len(store) or not sender_name:
+            return np.zeros(0, dtype=np.int64)
+        return store.sender_rows(store.match_senders(sender_name))
 
     def find_conversation_context(self, message_id, window_size=3):
-         # 查找上下文对话
-         if self.message_df is None or self.message_df.empty or 'id' not in self.message_df.columns or 'source_file' not in self.message_df.columns or 'time' not in self.message_df.columns:
-             logging.warning("消息 DataFrame 缺少用于上下文搜索的必要列 ('id', 'source_file', 'time')。")
-             return []
-
+         # 查找上下文对话：同一来源文件内按时间排序，取前后 window_size 条（查会话位置索引后切片）
+         store = self.messages
          try:
-             current_message_series = self.message_df[self.message_df['id'] == message_id]
-             if current_message_series.empty:
+             row = store.find(message_id)
+             position = store.conversation_position(row) if row is not None else None
+             if position is None:
                  logging.warning(f"上下文搜索：未找到消息 ID {message_id}。")
                  return []
-             current_message = current_message_series.iloc[0]
-             source_file = current_message['source_file']
-             current_message_time = current_message['time']
-
-             # 过滤来自相同源文件的消息
-             same_source_df = self.message_df[self.message_df['source_file'] == source_file].copy()
-
-             #  'time' 列是 datetime 
-             if not pd.api.types.is_datetime64_any_dtype(same_source_df['time']):
-                 same_source_df['time'] = pd.to_datetime(same_source_df['time'], errors='coerce')
-                 same_source_df = same_source_df.dropna(subset=['time']) 
-
-             # 按时间排序
-             same_source_df = same_source_df.sort_values(by='time')
-
-             # 在排序后的 DataFrame 中查找当前消息的索引
-             try:
-                  message_row = same_source_df.loc[current_message.name]
-                  sorted_idx = same_source_df.index.get_loc(current_message.name)
-             except KeyError:
-                  exact_match = same_source_df[(same_source_df['id'] == message_id) & (same_source_df['time'] == current_message_time)]
-                  if not exact_match.empty:
-                      sorted_idx = same_source_df.index.get_loc(exact_match.index[0])
-                  else:
-                      logging.warning(f"上下文搜索：排序后无法可靠地定位消息 {message_id}。")
-                      return []
-
-             # 计算上下文窗口的索引
-             start_idx = max(0, sorted_idx - window_size)
-             end_idx = min(len(same_source_df), sorted_idx + window_size + 1) # +1 以包含结束索引
-
-             # 上下文消息
-             context_df = same_source_df.iloc[start_idx:end_idx]
-
-             context_messages = context_df.to_dict('records')
-
-             # 格式化时间
+             order, start, current, end = position
+
+             context_messages = store.records(order[max(start, current - window_size):min(end, current + window_size + 1)])
              for msg in context_messages:
-                 msg['time'] = str(msg['time']) if pd.notna(msg['time']) else None
                  msg['is_current_message'] = (msg.get('id') == message_id) # 标记原始消息
-
              return context_messages
          except Exception as e:
              logging.error(f"查找消息 {message_id} 的上下文时出错：{e}", exc_info=True)
              return []
 
-    def analyze_conversation(self, query=None, time_range=None):
-        # 分析对话数据（统计信息）
-        if self.message_df is None or self.message_df.empty:
-            return {'total_messages': 0, 'sender_stats': {}, 'time_stats': {}, 'keyword_stats': {}}
-
-        filtered_df = self.message_df.copy()
-
-        if 'content' in filtered_df.columns:
-            filtered_df['content'] = filtered_df['content'].astype(str).fillna('')
-        else:
-            filtered_df['content'] = ''
+    def conversation_page(self, message_id, direction='forward', limit=50):
+        """游标翻页：返回 message_id 之后（forward）或之前（backward）最多 limit 条同会话消息（按时间正序）及是否还有更多"""
+        store = self.messages
+        row = store.find(message_id)
+        position = store.conversation_position(row) if row is not None else None
+        if position is None:
+            return [], False
+        order, start, current, end = position
+        limit = max(0, limit)
+        if direction == 'backward':
+            page_start = max(start, current - limit)
+            return store.records(order[page_start:current]), page_start > start
+        page_end = min(end, current + 1 + limit)
+        return store.records(order[current + 1:page_end]), page_end < end
 
-        # 关键字过滤
-        if query:
-            query_tokens = [word for word in jieba.cut(query) if word.strip()]
-            if query_tokens:
-                pattern = '|'.join(map(re.escape, query_tokens))
-                mask = filtered_df['content'].str.contains(pattern, na=False, case=False)
-                filtered_df = filtered_df[mask]
+    def analyze_conversation(self, query=None, time_range=None):
+        # 分析对话数据（统计信息），只对筛选出的行解码正文
+        empty = {'total_messages': 0, 'sender_stats': {}, 'time_stats': {}, 'keyword_stats': {}}
+        store = self.messages
+        mask = store.valid_time_mask() # 无法解析时间的消息不参与分析
 
         # 时间范围过滤
         if time_range and len(time_range) == 2:
             start_str, end_str = time_range
-            #  'time' 列
-            if 'time' in filtered_df.columns:
-                if not pd.api.types.is_datetime64_any_dtype(filtered_df['time']):
-                    filtered_df['time'] = pd.to_datetime(filtered_df['time'], errors='coerce')
-                    filtered_df = filtered_df.dropna(subset=['time'])
-
-                # 仅当 'time' 列现在是 datetime 类型时才继续
-                if pd.api.types.is_datetime64_any_dtype(filtered_df['time']):
-                    try:
-                        start_dt = pd.to_datetime(start_str, errors='coerce') if start_str else None
-                        end_dt = pd.to_datetime(end_str, errors='coerce') if end_str else None
-
-                        if pd.notna(start_dt) and pd.notna(end_dt):
-                            filtered_df = filtered_df[(filtered_df['time'] >= start_dt) & (filtered_df['time'] <= end_dt)]
-                        elif pd.notna(start_dt):
-                            filtered_df = filtered_df[filtered_df['time'] >= start_dt]
-                        elif pd.notna(end_dt):
-                            filtered_df = filtered_df[filtered_df['time'] <= end_dt]
-                    except Exception as e: 
-                        logging.warning(f"分析的时间格式无效 ('{start_str}', '{end_str}'): {e}，跳过时间过滤器。")
-                else:
-                    logging.warning("无法将 'time' 列转换为 datetime 以进行分析过滤。")
-            else:
-                 logging.warning("缺少用于分析过滤的 'time' 列。")
+            try:
+                start_dt = pd.to_datetime(start_str, errors='coerce') if start_str else None
+                end_dt = pd.to_datetime(end_str, errors='coerce') if end_str else None
+                if pd.notna(start_dt):
+                    mask &= store.times >= np.datetime64(start_dt.tz_localize(None) if start_dt.tzinfo else start_dt, 'ns')
+                if pd.notna(end_dt):
+                    mask &= store.times <= np.datetime64(end_dt.tz_localize(None) if end_dt.tzinfo else end_dt, 'ns')
+            except Exception as e: 
+                logging.warning(f"分析的时间格式无效 ('{start_str}', '{end_str}'): {e}，跳过时间过滤器。")
+        rows = np.flatnonzero(mask)
+
+        # 关键字过滤：短语 / 邻近查询查词位置索引，不扫描正文
+        contents = None
+        clauses = parse_proximity_query(query) if query else None
+        if clauses is not None:
+            docs = self._proximity_docs(clauses)
+            refs = self.doc_refs[docs] if docs is not None else np.zeros(0, dtype=np.int64)
+            rows = rows[np.isin(rows, refs[refs >= 0])]
+        elif query:
+            query_tokens = self.tokenizer.tokenize(query)
+            if query_tokens:
+                pattern = re.compile('|'.join(map(re.escape, query_tokens)), re.IGNORECASE)
+                contents = [store.contents[row] for row in rows]
+                keep = [i for i, content in enumerate(contents) if pattern.search(content)]
+                rows = rows[keep]
+                contents = [contents[i] for i in keep]
 
         # 过滤后没有数据，则返回空统计信息
-        if filtered_df.empty:
-            return {'total_messages': 0, 'sender_stats': {}, 'time_stats': {}, 'keyword_stats': {}}
-
-        # 计算统计数据
-        total_messages = len(filtered_df)
+        if not len(rows):
+            return empty
 
         # 发件人统计
-        sender_stats = {}
-        if 'sender' in filtered_df.columns:
-            sender_stats = filtered_df['sender'].astype(str).fillna('Unknown').value_counts().to_dict()
+        sender_counts = np.bincount(store.sender_ids[rows], minlength=len(store.senders))
+        sender_stats = {store.senders[i]: int(sender_counts[i]) for i in np.argsort(-sender_counts, kind='stable')
+                        if sender_counts[i] > 0}
 
         # 时间统计
-        time_stats = {}
-        if 'time' in filtered_df.columns and pd.api.types.is_datetime64_any_dtype(filtered_df['time']):
-            filtered_df['date'] = filtered_df['time'].dt.date
-            time_stats = {str(k): int(v) for k, v in filtered_df['date'].value_counts().sort_index().to_dict()}
+        dates, date_counts = np.unique(store.times[rows].astype('datetime64[D]'), return_counts=True)
+        time_stats = {str(date): int(count) for date, count in zip(dates, date_counts)}
 
         # 关键字统计
-        keyword_stats = {}
-        if 'content' in filtered_df.columns:
-            all_words = []
-            for content in filtered_df['content'].dropna():
-                words = [word for word in jieba.cut(str(content)) if word.strip() and len(word) > 1]
-                all_words.extend(words)
-            keyword_stats = {k: int(v) for k, v in Counter(all_words).most_common(50)}
+        if contents is None:
+            contents = [store.contents[row] for row in rows]
+        all_words = []
+        for tokens in self.tokenizer.tokenize_many(contents):
+            all_words.extend(word for word in tokens if len(word) > 1)
+        keyword_stats = {k: int(v) for k, v in Counter(all_words).most_common(50)}
 
         return {
-            'total_messages': total_messages,
+            'total_messages': len(rows),
             'sender_stats': sender_stats,
             'time_stats': time_stats,
             'keyword_stats': keyword_stats
         }
 
+# --- 搜索结果缓存 ---
+class SearchResultCache:
+    # 搜索结果缓存（LRU）：(规范化查询, 搜索类型, 数据集代数) -> 排序后的文档引用、分数、匹配类型
+    # 只缓存排序结果，元数据/高亮在返回时再组装；按估算的内存占用淘汰
+    MATCH_TYPES = ('keyword', 'semantic', 'sender', 'substring', 'regex', 'phone')
+    ENTRY_OVERHEAD = 256  # 每个条目的固定开销估计（字节）
+
+    def __init__(self, max_bytes=SEARCH_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # 键 -> (引用数组, 分数数组, 匹配类型编码数组, 字节数)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(query, search_type, generation):
+        # 查询只规范化空白（关键词搜索区分大小写）；子串 / 正则查询原样作为键
+        if search_type in ('substring', 'regex'):
+            return query, search_type, generation
+        return ' '.join(query.split()), search_type, generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        refs, scores, types, _ = entry
+        return [(int(ref), float(score), self.MATCH_TYPES[code]) for ref, score, code in zip(refs, scores, types)]
+
+    def put(self, key, hits):
+        refs = np.fromiter((hit[0] for hit in hits), dtype=np.int64, count=len(hits))
+        scores = np.fromiter((hit[1] for hit in hits), dtype=np.float64, count=len(hits))
+        types = np.fromiter((self.MATCH_TYPES.index(hit[2]) for hit in hits), dtype=np.int8, count=len(hits))
+        size = refs.nbytes + scores.nbytes + types.nbytes + len(key[0].encode('utf-8')) + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[3]
+            self._entries[key] = (refs, scores, types, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[3]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """命中/未命中计数和内存占用"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits, 'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes
+        }
+
+
+search_cache = SearchResultCache()
+
+
+def publish_search_engine(engine):
+    """发布新建好的搜索引擎（引用整体替换），并使旧的搜索结果缓存失效"""
+    global search_engine, dataset_generation
+    search_engine = engine
+    dataset_generation += 1
+    search_cache.clear()
+
+
 # --- 数据提取函数 ---
-def load_json_file(file_path):
-    try:
-        with open(file_path, 'rb') as f:
-            raw_content = f.read()
-        if not raw_content:
-            logging.warning(f"文件 {file_path} 为空。")
-            return None
-        # 处理 BOM
-        if raw_content.startswith(b'\xef\xbb\xbf'):
-            raw_content = raw_content[3:]
+CONTROL_CHARS = re.compile(r'[\x00-\x1F\x7F-\x9F]')
+
+
+_content_ids = threading.local()  # 当前线程正在处理的文件中各内容已出现的次数（extract_file_records 设置）
+
+
+def content_id(entry):
+    # 没有 ID 的记录由内容派生 ID：重新导入同一文件得到相同 ID，收藏仍然有效
+    # 同一文件中内容完全相同的条目按出现次序区分，第 n 次出现（n > 0）时把 n 一起哈希
+    encoded = json.dumps(entry, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8', errors='replace')
+    digest = hashlib.blake2b(encoded, digest_size=16).digest()
+    counts = getattr(_content_ids, 'counts', None)
+    if counts is not None:
+        occurrence = counts[digest]
+        counts[digest] += 1
+        if occurrence:
+            digest = hashlib.blake2b(encoded + f'\x00{occurrence}'.encode('ascii'), digest_size=16).digest()
+    return digest.hex()
+
+C1_CONTROL_CHARS = re.compile(r'[\x80-\x9F]')
+CONTROL_BYTES = bytes(range(0x20)) + b'\x7f'
+# 可按字节删除控制字符的编码 -> (解码前删除的字节, 可能含 U+0080-U+009F 的块中出现的前导字节)
+# C0 控制字符和 0x7F 在这些编码中只会是单字节，不会出现在多字节字符内部；
+# U+0080-U+009F 在 UTF-8 / GB18030 中是多字节序列，只有块中出现其前导字节时才对解码后的文本再删一次
+BYTE_CLEANING = {
+    'utf-8': (CONTROL_BYTES, b'\xc2'),
+    'gbk': (CONTROL_BYTES, None),
+    'gb18030': (CONTROL_BYTES, b'\x810'),
+    'iso8859-1': (CONTROL_BYTES + bytes(range(0x80, 0xa0)), None),
+}
+SAMPLE_SYNC_BYTE = re.compile(rb'[\x00-\x2f]')
+JSON_WHITESPACE = re.compile(r'[ \t\r\n]*')
+NUMBER_TAIL = re.compile(r'[\d.eE+-]*')  # 数字在缓冲区末尾被截断时，剩下的部分只含这些字符
+# 流式解析时逐条读取的大列表所在路径 -> (分类字段所在的对象层级, 处理条目前必须已读到的字段)
+# () 表示顶层就是消息列表；字段在列表之后才出现时，条目先暂存到临时文件，读完文档再处理
+STREAM_LIST_PATHS = {
+    (): (None, ()),
+    ('contents',): (0, ('type', 'parents')),
+    ('contents', 'contents'): (0, ('type', 'parents')),
+    ('page', 'contents'): (1, ('type',)),
+}
 
-        content = None
-        # 常用编码解码
-        for encoding in ['utf-8', 'utf-16', 'gbk', 'gb18030', 'latin-1']:
-            try:
-                content = raw_content.decode(encoding)
-                content = re.sub(r'[\x00-\x1F\x7F-\x9F]', '', content)
-                break
-            except UnicodeDecodeError:
-                continue 
 
-        # 所有常用编码都失败，尝试使用 utf-8 并替换错误
-        if content is None:
+def _sample_decodes(encoding, head, samples, complete):
+    # head 从文件开头读取（complete 表示就是整个文件），samples 为文件中间的抽查块
+    decoder = codecs.getincrementaldecoder(encoding)()
+    try:
+        decoder.decode(head, final=complete)
+        if codecs.lookup(encoding).name not in BYTE_CLEANING:
+            return True  # UTF-16 等编码只检查文件头（增量解码器要求 BOM），其余内容在流式解码时校验
+        for sample in samples:
+            # 抽查块可能从多字节字符中间开始：从第一个小于 0x30 的字节（引号、逗号、空格等）之后解码，
+            # 这样的字节在 UTF-8 / GBK / GB18030 中只能是单字节字符；块尾不完整的字符不算错误
+            start = SAMPLE_SYNC_BYTE.search(sample)
+            if start is not None:
+                codecs.getincrementaldecoder(encoding)().decode(sample[start.end():])
+        return True
+    except UnicodeError:  # 增量 utf-16 解码器在没有 BOM 时抛出 UnicodeError
+        return False
+
+
+def detect_file_encoding(file_path, exclude=()):
+    """
+    根据文件头和均匀抽查的 ENCODING_SAMPLE_CHUNKS 块判断编码：按 JSON_ENCODINGS 的顺序
+    返回第一个能解码全部样本的编码（跳过 exclude），都失败返回 None。
+    样本之外的内容在 iter_json_text 解码时校验，见 parse_with_encoding_fallback。
+    """
+    size = os.path.getsize(file_path)
+    samples = []
+    with open(file_path, 'rb') as f:
+        if size <= ENCODING_SAMPLE_BYTES * (ENCODING_SAMPLE_CHUNKS + 1):
+            head = f.read()
+        else:
+            head = f.read(ENCODING_SAMPLE_BYTES)
+            for i in range(1, ENCODING_SAMPLE_CHUNKS + 1):
+                f.seek(size * i // (ENCODING_SAMPLE_CHUNKS + 1))
+                samples.append(f.read(ENCODING_SAMPLE_BYTES))
+    if head.startswith(b'\xef\xbb\xbf'):
+        head = head[3:]
+    for encoding in JSON_ENCODINGS:
+        if encoding not in exclude and _sample_decodes(encoding, head, samples, complete=not samples):
+            return encoding
+    return None
+
+
+def parse_with_encoding_fallback(file_path, parse):
+    """
+    用检测出的编码调用 parse(encoding) 流式解析整个文件。抽样判断的编码在样本之外解码失败时，
+    排除该编码重新检测，从头再解析一遍（parse 每次都要从空结果开始）。
+    """
+    tried = []
+    while True:
+        encoding = detect_file_encoding(file_path, exclude=tried)
+        if encoding is None:
             logging.warning(f"无法使用常用编码解码文件 {file_path}，尝试 utf-8 replace。")
-            content = raw_content.decode('utf-8', errors='replace')
-            content = re.sub(r'[\x00-\x1F\x7F-\x9F]', '', content)
-
-        content = content.strip()
+        try:
+            return parse(encoding)
+        except UnicodeDecodeError as err:
+            logging.warning(f"文件 {file_path} 抽样之外的内容无法按 {encoding} 解码（{err.reason}），换用其他编码重新解析。")
+            tried.append(encoding)
+
+
+def iter_json_text(file_path, encoding):
+    """
+    逐块读取并解码文件，去掉 UTF-8 BOM 和控制字符；encoding 为 None 时按 utf-8 解码并替换错误字节。
+    控制字符在 BYTE_CLEANING 列出的编码中解码前用 bytes.translate 按字节删除，其余编码解码后用正则删除。
+    """
+    decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='strict' if encoding else 'replace')
+    delete, lead = BYTE_CLEANING.get(codecs.lookup(encoding or 'utf-8').name, (None, None))
+    tail = b''
+    with open(file_path, 'rb') as f:
+        block = f.read(STREAM_READ_BYTES)
+        if block.startswith(b'\xef\xbb\xbf'):
+            block = block[3:]
+        while block:
+            if delete is None:
+                text = CONTROL_CHARS.sub('', decoder.decode(block))
+            else:
+                text = decoder.decode(block.translate(None, delete))
+                if lead:
+                    # 多字节的 C1 控制字符可能跨块，由这一块补全后才解码出来，还要检查上一块末尾最多 3 个字节
+                    if lead in block or lead in tail + block[:3]:
+                        text = C1_CONTROL_CHARS.sub('', text)
+                    tail = block[-3:]
+            if text:
+                yield text
+            block = f.read(STREAM_READ_BYTES)
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield CONTROL_CHARS.sub('', text)
+
+
+class JsonRecordStream:
+    """
+    流式解析导出的 JSON 文本（iter_json_text 产出的文本块）。
+    STREAM_LIST_PATHS 指定的大列表逐条解析，每 batch_size 条产出一次与原文档结构相同、
+    但该列表只含这一批条目的 data，其余字段照常整体解析；文档中没有大列表时整体产出一次。
+    内存占用只与单个条目和一批条目的大小有关，与文件大小无关。
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self, chunks, stream_paths=STREAM_LIST_PATHS, batch_size=STREAM_BATCH_ENTRIES):
+        self.chunks = iter(chunks)
+        self.stream_paths = stream_paths
+        self.batch_size = batch_size
+        self.buffer, self.pos, self.eof = '', 0, False
+        self.offset = 0  # 缓冲区起点在整个文本中的位置（用于报错）
+        self.stack = []  # 正在解析的对象链（根对象到当前对象）
+        self.spool, self.spool_paths = None, []  # 暂存条目的临时文件及其列表路径
+        self.streamed = False
+
+    def __iter__(self):
+        try:
+            self._skip_wrapper()
+            root = yield from self._parse(())
+            self._check_trailer()
+            if self.spool is not None:
+                yield from self._replay(root)
+            elif not self.streamed:
+                yield root
+        except json.JSONDecodeError as err:
+            raise ValueError(f"{err.msg}（第 {self.offset + err.pos} 个字符附近）") from err
+        finally:
+            if self.spool is not None:
+                self.spool.close()
+
+    def _fill(self):
+        # 读入下一个文本块，丢弃已解析的部分
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            return False
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        # 跳过空白，返回下一个字符（文档结束返回 ''）
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def _error(self, message):
+        return json.JSONDecodeError(message, self.buffer, self.pos)
+
+    def _value(self):
+        # 用标准库解析一个完整的值；缓冲区不够时成倍读入更多文本再试
+        # 值之后直到缓冲区末尾只剩数字字符（如 "1." 被截断在 "." 之后）时也要再读，可能是被截断的数字
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if NUMBER_TAIL.match(self.buffer, end).end() < len(self.buffer) or self.eof:
+                    self.value_start, self.pos = self.pos, end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            wanted = 2 * (len(self.buffer) - self.pos) + 1
+            while len(self.buffer) - self.pos < wanted and self._fill():
+                pass
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise self._error(f"此处应为 '{char}'")
+        self.pos += 1
+
+    def _parse(self, path):
+        # 解析 path 处的值：大列表逐条产出，通往大列表的对象逐个字段解析，其余整体解析
+        char = self._peek()
+        if char == '[' and path in self.stream_paths:
+            return (yield from self._stream_list(path))
+        if char == '{' and any(len(p) > len(path) and p[:len(path)] == path for p in self.stream_paths):
+            return (yield from self._parse_object(path))
+        return self._value()
+
+    def _parse_object(self, path):
+        obj = {}
+        self.stack.append(obj)
+        self.pos += 1
+        if self._peek() == '}':
+            self.pos += 1
+        else:
+            while True:
+                if self._peek() != '"':
+                    raise self._error("此处应为字段名")
+                key = self._value()
+                self._expect(':')
+                obj[key] = yield from self._parse(path + (key,))
+                char = self._peek()
+                self.pos += 1
+                if char == '}':
+                    break
+                if char != ',':
+                    self.pos -= 1
+                    raise self._error("此处应为 ',' 或 '}'")
+        self.stack.pop()
+        return obj
+
+    def _stream_list(self, path):
+        self.streamed = True
+        depth, keys = self.stream_paths[path]
+        ready = self.spool is None and (depth is None or all(key in self.stack[depth] for key in keys))
+        batch = []
+        self.pos += 1
+        if self._peek() == ']':
+            self.pos += 1
+            return []
+        scan, skip = self.decoder.scan_once, JSON_WHITESPACE.match
+        while True:
+            if ready:
+                # 快速路径：条目之后的分隔符也已在缓冲区内时直接用 scan_once 解析，否则交给 _value 补读
+                # （条目后不是 ',' 或 ']' 时可能是被块边界截断的数字，如 "1." | "5"）
+                buffer = self.buffer
+                try:
+                    value, end = scan(buffer, skip(buffer, self.pos).end())
+                    after = skip(buffer, end).end()
+                except (StopIteration, json.JSONDecodeError):
+                    after = len(buffer)
+                if after < len(buffer) and buffer[after] in ',]':
+                    self.pos, char = after, buffer[after]
+                else:
+                    value = self._value()
+                    char = self._peek()
+                batch.append(value)
+                if len(batch) >= self.batch_size:
+                    yield self._plug(self.stack, path, batch)
+                    batch = []
+            else:
+                self._spool_value(path)
+                char = self._peek()
+            self.pos += 1
+            if char == ']':
+                break
+            if char != ',':
+                self.pos -= 1
+                raise self._error("此处应为 ',' 或 ']'")
+        if batch:
+            yield self._plug(self.stack, path, batch)
+        # 已产出的列表在文档中留空，避免重复处理
+        return []
+
+    def _spool_value(self, path):
+        # 分类字段还没读到：条目原文按行写入临时文件（文本已去掉换行符）
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+        if path not in self.spool_paths:
+            self.spool_paths.append(path)
+        self._value()
+        self.spool.write(f"{self.spool_paths.index(path)}\t{self.buffer[self.value_start:self.pos]}\n")
+
+    def _replay(self, root):
+        # 文档读完后按顺序重新解析暂存的条目
+        self.spool.seek(0)
+        batch, batch_path = [], None
+        for line in self.spool:
+            index, _, text = line.partition('\t')
+            path = self.spool_paths[int(index)]
+            if batch and (path != batch_path or len(batch) >= self.batch_size):
+                yield self._plug(self._nodes(root, batch_path), batch_path, batch)
+                batch = []
+            batch_path = path
+            batch.append(json.loads(text))
+        if batch:
+            yield self._plug(self._nodes(root, batch_path), batch_path, batch)
+
+    @staticmethod
+    def _nodes(root, path):
+        nodes = [root]
+        for key in path[:-1]:
+            nodes.append(nodes[-1][key])
+        return nodes
+
+    @staticmethod
+    def _plug(nodes, path, batch):
+        # 复制路径上的各层对象，把大列表换成当前这批条目
+        if not path:
+            return batch
+        data = node = dict(nodes[0])
+        for child, key in zip(nodes[1:], path[:-1]):
+            node[key] = dict(child)
+            node = node[key]
+        node[path[-1]] = batch
+        return data
+
+    def _skip_wrapper(self):
+        # 去掉 "var page = " 和 ";static.mypico.json.xxx=" 包装前缀
+        while len(self.buffer.lstrip()) < 64 and self._fill():
+            pass
+        stripped = self.buffer.lstrip()
+        self.offset += len(self.buffer) - len(stripped)
+        self.buffer, self.pos = stripped, 0
+        if self.buffer.startswith('var page = '):
+            self.pos = len('var page = ')
+        elif self.buffer.startswith(';static.mypico.json.'):
+            while self.buffer.find('=') < 0 and self._fill():
+                pass
+            self.pos = self.buffer.find('=') + 1
+
+    def _check_trailer(self):
+        # 顶层值之后只允许空白和一个 ';'
+        rest = ''
+        while True:
+            rest = (rest + self.buffer[self.pos:]).strip()
+            if rest not in ('', ';'):
+                raise self._error("文档末尾有多余内容")
+            self.pos = len(self.buffer)
+            if not self._fill():
+                break
 
-        if content.startswith('var page = '):
-            content = content[len('var page = '):]
-        elif content.startswith(';static.mypico.json.'):
-            prefix_end = content.find('=')
-            if prefix_end > 0:
-                content = content[prefix_end+1:].strip()
 
-        
-        if content.endswith(';'):
-            content = content[:-1].strip()
+def iter_json_records(file_path, encoding):
+    """按 encoding 流式读取导出的 JSON 文件，逐批产出 data（见 JsonRecordStream）；解析失败抛出 ValueError"""
+    return iter(JsonRecordStream(iter_json_text(file_path, encoding)))
 
-        # 将清理后的内容解析为 JSON
-        return json.loads(content)
 
-    except json.JSONDecodeError as json_err:
-         logging.error(f"文件 {file_path} 中的 JSON 解析错误：{json_err} 在行 {json_err.lineno} 列 {json_err.colno}")
-         return None 
+def load_json_file(file_path):
+    """一次性加载整个 JSON 文件；大文件应使用 iter_json_records 流式处理"""
+    try:
+        if not os.path.getsize(file_path):
+            logging.warning(f"文件 {file_path} 为空。")
+            return None
+        return parse_with_encoding_fallback(file_path, lambda encoding: next(
+            iter(JsonRecordStream(iter_json_text(file_path, encoding), stream_paths={})), None))
+    except ValueError as json_err:
+        logging.error(f"文件 {file_path} 中的 JSON 解析错误：{json_err}")
+        return None
     except Exception as e:
         # log其他异常
         logging.error(f"加载/解析文件 {file_path} 时出错：{e}", exc_info=True)
@@ -572,7 +2800,7 @@ def extract_messages(data, file_path):
         # 仅在找到文本内容时添加消息
         if text_content is not None:
             messages.append({
-                'id': msg_dict.get('id', str(uuid.uuid4())),
+                'id': msg_dict['id'] if 'id' in msg_dict else content_id(msg_dict),
                 'sender': msg_dict.get('user_name', 'Unknown'), 
                 'content': text_content,
                 'time': msg_dict.get('time', None), 
@@ -594,10 +2822,10 @@ def extract_messages(data, file_path):
                  add_message(item)
     return messages
 
-def extract_device_info(data):
+def extract_device_info(data, file_path=None):
     # 提取设备信息
     device_info = {}
-    if isinstance(data, dict) and data.get('type') == 0:
+    if isinstance(data, dict):
         contents_data = data.get('contents')
         if isinstance(contents_data, dict):
             actual_contents = contents_data.get('contents')
@@ -616,24 +2844,16 @@ def extract_device_info(data):
                                 device_info[key] = value
     return device_info
 
-def extract_contacts(data):
-    # 提取联系人
+def extract_contacts(data, file_path=None):
+    # 提取联系人（是否为通讯录数据由 classify_records 判断）
     contacts = []
-    is_contact_data = False
-    if isinstance(data, dict) and isinstance(data.get('parents'), list):
-        for parent in data['parents']:
-             if isinstance(parent, list) and len(parent) > 0 and isinstance(parent[0], str) and \
-                any(keyword in parent[0].lower() for keyword in ['通讯录', '联系人', 'contact']):
-                 is_contact_data = True
-                 break
-    # 识别联系人数据，提取详细信息
-    if is_contact_data and isinstance(data.get('contents'), dict):
+    if isinstance(data.get('contents'), dict):
         actual_contents = data['contents'].get('contents')
         if isinstance(actual_contents, list):
             for contact_entry in actual_contents:
                 if isinstance(contact_entry, list) and len(contact_entry) >= 2:
                     contact_data = {
-                        'id': contact_entry[0][1] if len(contact_entry[0]) > 1 else str(uuid.uuid4()),
+                        'id': contact_entry[0][1] if len(contact_entry[0]) > 1 else content_id(contact_entry),
                         'name': contact_entry[1][1] if len(contact_entry[1]) > 1 else 'Unknown',
                         'details': {}
                     }
@@ -646,23 +2866,16 @@ def extract_contacts(data):
                     contacts.append(contact_data)
     return contacts
 
-def extract_app_summary(data):
+def extract_app_summary(data, file_path=None):
     # 提取应用摘要信息
     app_summary = []
-    is_app_data = False
-    if isinstance(data, dict) and isinstance(data.get('parents'), list):
-         for parent in data['parents']:
-             if isinstance(parent, list) and len(parent) > 0 and isinstance(parent[0], str) and \
-                any(keyword in parent[0].lower() for keyword in ['应用', 'app', '摘要', 'summary']):
-                 is_app_data = True
-                 break
-    if is_app_data and isinstance(data.get('contents'), dict):
+    if isinstance(data.get('contents'), dict):
         actual_contents = data['contents'].get('contents')
         if isinstance(actual_contents, list):
             for app_entry in actual_contents:
                 if isinstance(app_entry, list) and len(app_entry) >= 2:
                     app_data_item = {
-                        'id': app_entry[0][1] if len(app_entry[0]) > 1 else str(uuid.uuid4()),
+                        'id': app_entry[0][1] if len(app_entry[0]) > 1 else content_id(app_entry),
                         'name': app_entry[1][1] if len(app_entry[1]) > 1 else 'Unknown',
                         'details': {}
                     }
@@ -675,39 +2888,16 @@ def extract_app_summary(data):
                     app_summary.append(app_data_item)
     return app_summary
 
-def extract_wechat_data(data, file_path):
-    # 提取微信群组、联系人、消息
-    groups, contacts, messages = [], [], []
-    file_basename = os.path.basename(file_path)
-    is_wechat = False
-    if isinstance(data, dict) and isinstance(data.get('parents'), list):
-        for parent in data['parents']:
-            if isinstance(parent, list) and len(parent) > 0 and isinstance(parent[0], str) and \
-               any(kw in parent[0].lower() for kw in ['微信', 'wechat', 'weixin']):
-                is_wechat = True
-                break
-    if not is_wechat:
-        return groups, contacts, messages
-
-    # 提取消息
-    if data.get('type') == 1:
-        messages.extend(extract_messages(data, file_path))
-
-    # 提取群组
-    is_group_data = False
-    if isinstance(data.get('parents'), list):
-        for parent in data['parents']:
-            if isinstance(parent, list) and len(parent) > 0 and isinstance(parent[0], str) and \
-               any(kw in parent[0].lower() for kw in ['群组', 'group']):
-                is_group_data = True
-                break
-    if is_group_data and isinstance(data.get('contents'), dict):
+def extract_wechat_groups(data, file_path=None):
+    # 提取微信群组
+    groups = []
+    if isinstance(data.get('contents'), dict):
         actual_contents = data['contents'].get('contents')
         if isinstance(actual_contents, list):
             for group_entry in actual_contents:
                 if isinstance(group_entry, list) and len(group_entry) >= 2:
                     group_data = {
-                        'group_id': group_entry[0][1] if len(group_entry[0]) > 1 else str(uuid.uuid4()),
+                        'group_id': group_entry[0][1] if len(group_entry[0]) > 1 else content_id(group_entry),
                         'group_name': group_entry[1][1] if len(group_entry[1]) > 1 else 'Unknown Group',
                         'details': {}
                     }
@@ -718,22 +2908,18 @@ def extract_wechat_data(data, file_path):
                                 if isinstance(detail_item, list) and len(detail_item) >= 2 and isinstance(detail_item[0], str):
                                     group_data['details'][detail_item[0]] = detail_item[1]
                     groups.append(group_data)
+    return groups
 
+def extract_wechat_contacts(data, file_path=None):
     # 提取微信联系人
-    is_wechat_contact_data = False
-    if is_wechat and isinstance(data.get('parents'), list):
-         for parent in data['parents']:
-             if isinstance(parent, list) and len(parent) > 0 and isinstance(parent[0], str) and \
-                any(kw in parent[0].lower() for kw in ['联系人', 'contact']) and '通讯录' not in parent[0]: 
-                 is_wechat_contact_data = True
-                 break
-    if is_wechat_contact_data and isinstance(data.get('contents'), dict):
+    contacts = []
+    if isinstance(data.get('contents'), dict):
         actual_contents = data['contents'].get('contents')
         if isinstance(actual_contents, list):
              for contact_entry in actual_contents:
                  if isinstance(contact_entry, list) and len(contact_entry) >= 2:
                      wx_contact = {
-                         'wechat_id': contact_entry[0][1] if len(contact_entry[0]) > 1 else str(uuid.uuid4()),
+                         'wechat_id': contact_entry[0][1] if len(contact_entry[0]) > 1 else content_id(contact_entry),
                          'nickname': contact_entry[1][1] if len(contact_entry[1]) > 1 else 'Unknown',
                          'remark': '', 'group_name': '', 'phone': '', 'details': {}
                      }
@@ -748,40 +2934,56 @@ def extract_wechat_data(data, file_path):
                                      if '群' in key or 'group' in key.lower(): wx_contact['group_name'] = value
                                      if '电话' in key or 'phone' in key.lower(): wx_contact['phone'] = value
                      contacts.append(wx_contact)
+    return contacts
 
-    return groups, contacts, messages
 
+# --- 索引快照 ---
+def save_index_snapshot():
+    """保存搜索索引和数据快照"""
+    if search_engine is None:
+        return
+    try:
+        search_engine.save_snapshot(INDEX_SNAPSHOT_DIR, extra={key: app_data.get(key) for key in dataset_keys()})
+        logging.info(f"索引快照已保存到 {INDEX_SNAPSHOT_DIR}。")
+    except Exception as e:
+        logging.error(f"保存索引快照时出错: {e}", exc_info=True)
 
-# --- 文件处理逻辑 ---
-def process_file(file_path):
-    data = load_json_file(file_path)
-    if not data:
-        logging.warning(f"文件 {os.path.basename(file_path)} 加载失败或为空，跳过。")
-        return None, None, None, None, None, None, None
+def load_index_snapshot():
+    """加载上次保存的索引快照"""
+    if EnhancedSearch.snapshot_path(INDEX_SNAPSHOT_DIR) is None:
+        return False
+    try:
+        engine, dataset = EnhancedSearch.load_snapshot(INDEX_SNAPSHOT_DIR)
+        dataset = dataset or {}
+        missing = [key for key in dataset_keys() if key not in dataset]
+        for key in dataset_keys():
+            if key in dataset:
+                app_data[key] = dataset[key]
+        if missing:
+            # 快照保存时还没有注册这些记录类型：不恢复已导入文件的哈希，重新上传时会重新解析
+            logging.warning(f"索引快照中缺少 {missing}，重新上传原文件可补全。")
+            app_data['source_hashes'] = []
+        app_data['messages'] = engine.messages
+        publish_search_engine(engine)
+        logging.info(f"从 {INDEX_SNAPSHOT_DIR} 加载了索引快照，共 {len(engine.doc_refs)} 个文档。")
+        return True
+    except Exception as e:
+        logging.error(f"加载索引快照时出错: {e}", exc_info=True)
+        return False
 
-    device_info = extract_device_info(data)
-    contacts = extract_contacts(data)
-    messages = extract_messages(data, file_path)
-    app_summary = extract_app_summary(data)
-    wechat_groups, wechat_contacts, wechat_messages = extract_wechat_data(data, file_path)
 
-    # --- 提取通话记录 ---
+# --- 文件处理逻辑 ---
+def extract_call_records(data, file_path=None):
+    # 提取通话记录
     call_records = []
-    is_call_log_data = False
-    if isinstance(data, dict) and isinstance(data.get('parents'), list):
-        for parent in data['parents']:
-             if isinstance(parent, list) and len(parent) > 0 and isinstance(parent[0], str) and \
-                any(keyword in parent[0].lower() for keyword in ['通话记录', 'call log', 'call record']):
-                 is_call_log_data = True
-                 break
-    if is_call_log_data and isinstance(data.get('contents'), dict):
+    if isinstance(data.get('contents'), dict):
          actual_contents = data['contents'].get('contents')
          if isinstance(actual_contents, list):
               for call_entry in actual_contents:
                    # 假设通话记录条目结构为 [id_info, number_info, details_info]
                    if isinstance(call_entry, list) and len(call_entry) >= 3:
                         call_data = {
-                            'id': call_entry[0][1] if len(call_entry[0]) > 1 else str(uuid.uuid4()),
+                            'id': call_entry[0][1] if len(call_entry[0]) > 1 else content_id(call_entry),
                             'phone': call_entry[1][1] if len(call_entry[1]) > 1 else 'Unknown',
                             'details': {}
                         }
@@ -798,75 +3000,374 @@ def process_file(file_path):
                                           if '类型' in key or 'type' in key.lower(): call_data['call_type'] = value 
                                           if '删除' in key or 'delete' in key.lower(): call_data['is_deleted'] = value
                         call_records.append(call_data)
+    return call_records
+
+# --- 记录分类与提取函数注册表 ---
+WECHAT_KEYWORDS = ('微信', 'wechat', 'weixin')
+
+def parent_labels(data):
+    # parents 各项的名称（首个元素，小写）；data 不是带 parents 列表的 dict 时为空
+    if not isinstance(data, dict) or not isinstance(data.get('parents'), list):
+        return []
+    return [parent[0].lower() for parent in data['parents']
+            if isinstance(parent, list) and len(parent) > 0 and isinstance(parent[0], str)]
+
+def labels_match(labels, keywords, exclude=()):
+    # 是否有某个名称包含 keywords 之一，且不包含 exclude 中的词
+    return any(any(kw in label for kw in keywords) and not any(ex in label for ex in exclude) for label in labels)
+
+# 数据集键 -> (分类条件 matches(data, labels), 提取函数 extract(data, file_path))
+# 提取函数只会收到分类条件成立的 data，返回 dict（合并）或 list（追加）；新的数据类型用 register_record_kind 注册
+RECORD_KINDS = {
+    'device_info': (lambda data, labels: isinstance(data, dict) and data.get('type') == 0, extract_device_info),
+    'contacts': (lambda data, labels: labels_match(labels, ('通讯录', '联系人', 'contact')), extract_contacts),
+    'messages': (lambda data, labels: isinstance(data, list) or isinstance(data, dict) and (
+        data.get('type') == 1 or isinstance(data.get('page'), dict)), extract_messages),
+    'app_summary': (lambda data, labels: labels_match(labels, ('应用', 'app', '摘要', 'summary')), extract_app_summary),
+    'wechat_groups': (lambda data, labels: labels_match(labels, WECHAT_KEYWORDS) and labels_match(labels, ('群组', 'group')),
+                      extract_wechat_groups),
+    'wechat_contacts': (lambda data, labels: labels_match(labels, WECHAT_KEYWORDS) and labels_match(
+        labels, ('联系人', 'contact'), exclude=('通讯录',)), extract_wechat_contacts),
+    'call_records': (lambda data, labels: labels_match(labels, ('通话记录', 'call log', 'call record')),
+                     extract_call_records),
+}
 
-    # 合并消息 (去重)
-    existing_message_ids = {msg['id'] for msg in messages if 'id' in msg}
-    for wx_msg in wechat_messages:
-        if 'id' in wx_msg and wx_msg['id'] not in existing_message_ids:
-            messages.append(wx_msg)
-            existing_message_ids.add(wx_msg['id'])
+RECORD_KIND_EMPTY = {'device_info': dict}  # 提取结果为 dict 的记录类型的空值类型，其余为 list
+
+def register_record_kind(key, matches, extract, empty=list):
+    """注册一种记录：matches(data, labels) 判断文件是否含此类记录，extract(data, file_path) 提取一批 data 中的记录；
+    extract 返回 dict 时 empty 传 dict"""
+    RECORD_KINDS[key] = (matches, extract)
+    RECORD_KIND_EMPTY[key] = empty
+
+def empty_dataset():
+    """全部已注册记录类型的空数据集（消息为空的 MessageStore），以及已导入文件的哈希"""
+    dataset = {key: RECORD_KIND_EMPTY.get(key, list)() for key in RECORD_KINDS}
+    dataset['messages'] = MessageStore()
+    dataset['source_hashes'] = []
+    return dataset
+
+def dataset_keys():
+    """随索引快照保存的数据集键：全部已注册的记录类型（消息存储由搜索引擎保存）及已导入文件的哈希"""
+    return [key for key in RECORD_KINDS if key != 'messages'] + ['source_hashes']
+
+def classify_records(data):
+    """检查一次 type / parents，返回文件含有的记录类型（RECORD_KINDS 的键）"""
+    labels = parent_labels(data)
+    return [key for key, (matches, _) in RECORD_KINDS.items() if matches(data, labels)]
+
+def extract_file_records(file_path, encoding):
+    """流式解析文件，按首批 data 分类后只交给对应的提取函数；返回 {数据集键: 记录}，文件没有内容时返回 None"""
+    records, kinds = None, None
+    _content_ids.counts = Counter()
+    try:
+        # 大列表按批流式解析，峰值内存与文件大小无关；每批的 type / parents 相同，只分类一次
+        for data in iter_json_records(file_path, encoding):
+            if not data:
+                continue
+            if kinds is None:
+                kinds, records = classify_records(data), {}
+            for key in kinds:
+                batch_records = RECORD_KINDS[key][1](data, file_path)
+                if key not in records:
+                    records[key] = batch_records
+                elif isinstance(batch_records, dict):
+                    records[key].update(batch_records)
+                else:
+                    records[key].extend(batch_records)
+    finally:
+        _content_ids.counts = None
+    return records
 
-    return device_info, contacts, messages, app_summary, wechat_groups, wechat_contacts, call_records
+def process_file(file_path):
+    """解析单个文件，返回 {数据集键: 记录}；文件为空或解析失败返回 None"""
+    if not os.path.getsize(file_path):
+        logging.warning(f"文件 {os.path.basename(file_path)} 为空，跳过。")
+        return None
 
-def process_batch_files(file_paths, task_id=None):
-    """处理文件并合并数据"""
-    batch_data = {'device_info': {}, 'contacts': [], 'messages': [], 'app_summary': [],
-                  'wechat_groups': [], 'wechat_contacts': [], 'call_records': []}
-    processed, success, failed = 0, 0, 0
-    total = len(file_paths)
+    try:
+        records = parse_with_encoding_fallback(file_path, lambda encoding: extract_file_records(file_path, encoding))
+    except ValueError as json_err:
+        logging.error(f"文件 {file_path} 中的 JSON 解析错误：{json_err}")
+        return None
+    except Exception as e:
+        logging.error(f"加载/解析文件 {file_path} 时出错：{e}", exc_info=True)
+        return None
+    if records is None:
+        logging.warning(f"文件 {os.path.basename(file_path)} 加载失败或为空，跳过。")
+    return records
+
+def file_hash(file_path):
+    # 文件内容哈希（BLAKE2b），作为导入缓存的键
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(STREAM_READ_BYTES), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def save_upload(file, file_path):
+    """保存上传的文件，写入的同时计算内容哈希（与 file_hash 相同），返回哈希"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'wb') as f:
+        for block in iter(lambda: file.stream.read(STREAM_READ_BYTES), b''):
+            digest.update(block)
+            f.write(block)
+    return digest.hexdigest()
+
+
+class IngestCache:
+    # 导入缓存：按文件内容哈希保存 process_file 的提取结果（消息为列式数组），pickle 存盘
+    # 条目记录文件名、提取逻辑版本和记录类型，任一不同视为未命中（消息的来源文件取自文件名）
+    # 命中时更新条目的修改时间，写入后按修改时间从旧到新删除条目，直到总大小不超过 max_bytes
+    def __init__(self, cache_dir=INGEST_CACHE_DIR, max_bytes=INGEST_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, digest):
+        return os.path.join(self.cache_dir, f'{digest}.pkl')
+
+    def _tag(self, file_path):
+        return {'version': INGEST_CACHE_VERSION, 'file_name': os.path.basename(file_path), 'kinds': sorted(RECORD_KINDS)}
+
+    def get(self, digest, file_path):
+        """缓存的提取结果，未命中返回 None"""
+        entry = None
+        if self.cache_dir and os.path.exists(self._path(digest)):
+            try:
+                with open(self._path(digest), 'rb') as f:
+                    entry = pickle.load(f)
+            except Exception as e:
+                logging.warning(f"读取导入缓存 {digest} 失败：{e}")
+        with self._lock:
+            if entry is not None and entry['tag'] == self._tag(file_path):
+                self.hits += 1
+                try:
+                    os.utime(self._path(digest))
+                except OSError:
+                    pass
+                return entry['records']
+            self.misses += 1
+        return None
 
-    for file_path in file_paths:
-        processed += 1
-        logging.info(f"[任务 {task_id or 'N/A'}] 处理文件 {processed}/{total}: {os.path.basename(file_path)}")
+    def put(self, digest, file_path, records):
+        if not self.cache_dir:
+            return
         try:
-            results = process_file(file_path)
-            if any(res is not None for res in results):
-                success += 1
-                if isinstance(results[0], dict): batch_data['device_info'].update(results[0])
-                if isinstance(results[1], list): batch_data['contacts'].extend(results[1])
-                if isinstance(results[2], list): batch_data['messages'].extend(results[2])
-                if isinstance(results[3], list): batch_data['app_summary'].extend(results[3])
-                if isinstance(results[4], list): batch_data['wechat_groups'].extend(results[4])
-                if isinstance(results[5], list): batch_data['wechat_contacts'].extend(results[5])
-                if isinstance(results[6], list): batch_data['call_records'].extend(results[6]) 
-            else:
-                failed += 1
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # 先写临时文件再替换，避免留下半个条目
+            tmp_path = self._path(digest) + f'.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'tag': self._tag(file_path), 'records': records}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(digest))
+            self._evict(keep=self._path(digest))
         except Exception as e:
-            failed += 1
-            logging.error(f"[任务 {task_id or 'N/A'}] 处理文件 {os.path.basename(file_path)} 时出错：{e}", exc_info=True)
+            logging.warning(f"写入导入缓存 {digest} 失败：{e}")
+
+    def _entries(self):
+        # [(修改时间, 大小, 路径)]，按修改时间从旧到新
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # 并发删除
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def _evict(self, keep):
+        # 超出 max_bytes 时删除最久未使用的条目（刚写入的 keep 除外）
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError as e:
+                    logging.warning(f"删除导入缓存条目 {path} 失败：{e}")
+
+    def stats(self):
+        """命中/未命中计数"""
+        lookups = self.hits + self.misses
+        entries = self._entries() if self.cache_dir and os.path.isdir(self.cache_dir) else []
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'entries': len(entries), 'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes, 'enabled': bool(self.cache_dir)}
+
+
+# 全局共享的导入缓存
+ingest_cache = IngestCache()
+
+
+def _ingest_file(file_path):
+    # 进程池任务：处理单个文件；消息转为列式数组返回，序列化比 dict 列表小且快，时间解析也在子进程完成
+    records = process_file(file_path)
+    if records and 'messages' in records:
+        records['messages'] = MessageStore.from_records(records['messages']).to_arrays()
+    return records
+
+def _ingest_files_parallel(file_paths, workers, on_result):
+    """用进程池处理文件，每个文件完成时调用 on_result(序号, 结果或异常)；完成顺序不固定"""
+    # 使用 spawn：后台线程中 fork 可能继承其他线程持有的锁
+    context = multiprocessing.get_context('spawn')
+    crashed = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(file_paths)), mp_context=context) as executor:
+        futures = {executor.submit(_ingest_file, path): i for i, path in enumerate(file_paths)}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                crashed.append(futures[future])
+                continue
+            except Exception as e:
+                result = e
+            on_result(futures[future], result)
+    # 子进程异常退出（如内存不足被杀）会使整个进程池失效：未完成的文件各用一个新进程重试，
+    # 只有导致崩溃的文件记为失败
+    for i in sorted(crashed):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            try:
+                result = executor.submit(_ingest_file, file_paths[i]).result()
+            except Exception as e:
+                result = e
+        on_result(i, result)
+
+def process_batch_files(file_paths, task_id=None, workers=INGEST_WORKERS, file_hashes=None):
+    """
+    处理文件并合并数据；多个文件且总大小达到 PARALLEL_INGEST_MIN_BYTES 时用进程池，结果仍按文件顺序合并。
+    file_hashes 为各文件的内容哈希（None 时在这里计算），导入缓存命中的文件不再解析。
+    """
+    batch_data = empty_dataset()
+    success, failed = 0, 0
+    total = len(file_paths)
+    workers = workers or os.cpu_count() or 1
+    file_results = [None] * total
+    if file_hashes is None:
+        file_hashes = [file_hash(path) for path in file_paths]
+
+    def on_result(i, records):
+        nonlocal success, failed
+        file_name = os.path.basename(file_paths[i])
+        if isinstance(records, Exception):
+            logging.error(f"[任务 {task_id or 'N/A'}] 处理文件 {file_name} 时出错：{records}", exc_info=records)
+            records = None
+        ok = records is not None
+        success, failed = success + ok, failed + (not ok)
+        file_results[i] = records
+        if ok and i in pending:
+            ingest_cache.put(file_hashes[i], file_paths[i], records)
+        logging.info(f"[任务 {task_id or 'N/A'}] 处理文件 {success + failed}/{total}: {file_name}")
 
         # 更新任务状态
         if task_id and task_id in processing_tasks:
-            processing_tasks[task_id]['processed_files'] = processed
+            processing_tasks[task_id]['processed_files'] = processing_tasks[task_id].get('processed_files', 0) + 1
             # 成功/失败计数
-            processing_tasks[task_id]['success_files'] += (1 if results and any(res is not None for res in results) else 0)
-            processing_tasks[task_id]['failed_files'] += (1 if not results or all(res is None for res in results) else 0)
+            processing_tasks[task_id]['success_files'] += ok
+            processing_tasks[task_id]['failed_files'] += not ok
+
+    pending = []  # 导入缓存未命中、需要解析的文件序号
+    for i, file_path in enumerate(file_paths):
+        records = ingest_cache.get(file_hashes[i], file_path)
+        if records is None:
+            pending.append(i)
+        else:
+            on_result(i, records)
+
+    pending_paths = [file_paths[i] for i in pending]
+    if workers > 1 and len(pending) > 1 and sum(map(os.path.getsize, pending_paths)) >= PARALLEL_INGEST_MIN_BYTES:
+        _ingest_files_parallel(pending_paths, workers, lambda j, records: on_result(pending[j], records))
+    else:
+        for i in pending:
+            try:
+                records = _ingest_file(file_paths[i])
+            except Exception as e:
+                records = e
+            on_result(i, records)
+
+    # 按文件顺序合并，与完成顺序无关
+    for i, records in enumerate(file_results):
+        if records is not None:
+            batch_data['source_hashes'].append(file_hashes[i])
+        for key, value in (records or {}).items():
+            if key == 'messages':
+                batch_data['messages'].extend_store(MessageStore.from_arrays(*value))
+            elif isinstance(value, dict):
+                batch_data.setdefault(key, {}).update(value)
+            else:
+                batch_data.setdefault(key, []).extend(value)
 
     logging.info(f"[任务 {task_id or 'N/A'}] 批处理完成。成功: {success}, 失败: {failed}")
     return batch_data, success, failed
 
-def process_files_async(task_id, file_paths, batch_size=20):
-    """异步处理文件，分批进行"""
+def _remove_upload_dir(task_id):
+    # 清理上传目录
+    upload_dir = os.path.join('uploads', f'task_{task_id}')
+    if os.path.exists(upload_dir):
+         try:
+             shutil.rmtree(upload_dir)
+             logging.info(f"任务 {task_id}: 已清理上传目录 {upload_dir}")
+         except Exception as clean_e:
+             logging.error(f"任务 {task_id}: 清理上传目录 {upload_dir} 时出错：{clean_e}")
+
+def process_files_async(task_id, file_paths, batch_size=20, append=False, file_hashes=None):
+    """
+    异步处理文件，分批进行；append 为 True 时追加到现有数据集。
+    file_hashes 为各文件的内容哈希（保存上传文件时计算），已在当前数据集中的文件不会重复导入。
+    """
     global app_data, search_engine
     try:
         total_files = len(file_paths)
-        total_batches = (total_files + batch_size - 1) // batch_size
         total_success, total_failed = 0, 0
+        if file_hashes is None:
+            file_hashes = [file_hash(path) for path in file_paths]
+
+        loaded = search_engine is not None and len(search_engine.doc_refs) > 0
+        existing = set(app_data.get('source_hashes') or []) if loaded else set()
+        if existing and set(file_hashes) <= existing and (append or set(file_hashes) == existing):
+            # 重复上传：文件都已导入（全量模式下还要求正好是当前数据集的文件），数据和索引原样保留
+            logging.info(f"任务 {task_id}: {total_files} 个文件与当前数据集相同，跳过解析和建索引。")
+            if task_id in processing_tasks:
+                processing_tasks[task_id].update({
+                    'status': 'completed', 'success_files': total_files, 'failed_files': 0,
+                    'processed_files': total_files, 'reused': True
+                })
+            _remove_upload_dir(task_id)
+            return
+
+        # 追加模式需要已有可用的搜索引擎，否则按全量处理
+        append = append and loaded
+        if append:
+            # 已导入过的文件跳过，避免重复数据
+            skipped = sum(digest in existing for digest in file_hashes)
+            if skipped:
+                logging.info(f"任务 {task_id}: {skipped} 个文件已在当前数据集中，跳过。")
+                file_paths, file_hashes = zip(*[(path, digest) for path, digest in zip(file_paths, file_hashes)
+                                                if digest not in existing])
+                file_paths, file_hashes = list(file_paths), list(file_hashes)
+                total_success = skipped
+                if task_id in processing_tasks:
+                    processing_tasks[task_id]['processed_files'] = skipped
+                    processing_tasks[task_id]['success_files'] = skipped
+        total_batches = (len(file_paths) + batch_size - 1) // batch_size
+        # 本次任务解析出的数据先合并到私有的 dataset，索引建好后再与搜索引擎一起整体替换，
+        # 处理期间查询线程看到的始终是完整的旧数据集和旧索引；全量模式下新上传中没有的记录类型也会清空
+        dataset = empty_dataset()
 
-        # 初始化/清空应用数据，但保留历史和收藏
-        current_history = app_data.get('search_history', [])
-        current_favorites = app_data.get('favorites', [])
-        app_data = {
-            'device_info': {}, 'contacts': [], 'messages': [], 'app_summary': [],
-            'wechat_groups': [], 'wechat_contacts': [], 'call_records': [],
-            'search_history': current_history, 'favorites': current_favorites
-        }
-
-        logging.info(f"任务 {task_id}: 开始处理 {total_files} 个文件，共 {total_batches} 批。")
+        logging.info(f"任务 {task_id}: 开始处理 {len(file_paths)} 个文件，共 {total_batches} 批。")
 
         for batch_num in range(total_batches):
             start_idx = batch_num * batch_size
-            end_idx = min((batch_num + 1) * batch_size, total_files)
+            end_idx = min((batch_num + 1) * batch_size, len(file_paths))
             batch_files = file_paths[start_idx:end_idx]
             logging.info(f"任务 {task_id}: 处理批次 {batch_num + 1}/{total_batches} (文件 {start_idx + 1}-{end_idx})。")
 
@@ -878,18 +3379,19 @@ def process_files_async(task_id, file_paths, batch_size=20):
                 })
 
             try:
-                batch_data, success, failed = process_batch_files(batch_files, task_id)
+                batch_data, success, failed = process_batch_files(batch_files, task_id,
+                                                                  file_hashes=file_hashes[start_idx:end_idx])
                 total_success += success
                 total_failed += failed
 
-                # 合并数据到全局 app_data
-                app_data['device_info'].update(batch_data['device_info'])
-                app_data['contacts'].extend(batch_data['contacts'])
-                app_data['messages'].extend(batch_data['messages'])
-                app_data['app_summary'].extend(batch_data['app_summary'])
-                app_data['wechat_groups'].extend(batch_data['wechat_groups'])
-                app_data['wechat_contacts'].extend(batch_data['wechat_contacts'])
-                app_data['call_records'].extend(batch_data['call_records'])
+                # 合并数据到本次任务的 dataset
+                for key, value in batch_data.items():
+                    if key == 'messages':
+                        dataset['messages'].extend_store(value)
+                    elif isinstance(value, dict):
+                        dataset.setdefault(key, {}).update(value)
+                    else:
+                        dataset.setdefault(key, []).extend(value)
 
                 logging.info(f"任务 {task_id}: 批次 {batch_num + 1} 完成。成功: {success}, 失败: {failed}。累计: {total_success}/{total_failed}")
 
@@ -911,13 +3413,33 @@ def process_files_async(task_id, file_paths, batch_size=20):
         logging.info(f"任务 {task_id}: 所有批次处理完毕。总成功: {total_success}, 失败: {total_failed}。正在加载数据...")
 
         # --- 初始化搜索引擎 ---
-        global search_engine
-        search_engine = EnhancedSearch() 
-        search_engine.load_data(
-            app_data['messages'], app_data['contacts'],
-            app_data['wechat_groups'], app_data['wechat_contacts']
-        )
-        logging.info(f"任务 {task_id}: 数据已加载到搜索引擎。")
+        if append:
+            # 只对新增数据分词，在扩展出的新消息存储和引擎副本上更新索引，旧引擎不变
+            messages = app_data['messages'].extended(dataset['messages'])
+            engine = search_engine.appended(
+                messages, dataset['contacts'],
+                dataset['wechat_groups'], dataset['wechat_contacts'], dataset['call_records']
+            )
+            merged = {}
+            for key, value in dataset.items():
+                if key == 'messages':
+                    merged[key] = messages
+                elif isinstance(value, dict):
+                    merged[key] = {**app_data.get(key, {}), **value}
+                else:
+                    merged[key] = list(app_data.get(key, [])) + value
+            dataset = merged
+        else:
+            # 建好索引后再替换，建索引期间查询仍使用旧引擎
+            engine = EnhancedSearch()
+            engine.load_data(
+                dataset['messages'], dataset['contacts'],
+                dataset['wechat_groups'], dataset['wechat_contacts'], dataset['call_records']
+            )
+        # 先替换数据集再发布引擎：追加模式下新数据集包含旧引擎引用的全部行；保留历史和收藏
+        app_data = {**app_data, **dataset}
+        publish_search_engine(engine)
+        logging.info(f"任务 {task_id}: 数据已{'追加' if append else '加载'}到搜索引擎。")
 
         if task_id in processing_tasks:
             processing_tasks[task_id].update({
@@ -927,14 +3449,8 @@ def process_files_async(task_id, file_paths, batch_size=20):
                 'processed_files': total_files 
             })
 
-        # 清理上传目录
-        upload_dir = os.path.join('uploads', f'task_{task_id}')
-        if os.path.exists(upload_dir):
-             try:
-                 shutil.rmtree(upload_dir)
-                 logging.info(f"任务 {task_id}: 已清理上传目录 {upload_dir}")
-             except Exception as clean_e:
-                 logging.error(f"任务 {task_id}: 清理上传目录 {upload_dir} 时出错：{clean_e}")
+        save_index_snapshot()
+        _remove_upload_dir(task_id)
 
     except Exception as e:
         logging.error(f"任务 {task_id}: 处理过程中出现严重错误：{e}", exc_info=True)
@@ -977,6 +3493,9 @@ def start_processing():
     if not json_files:
          return jsonify({'status': 'error', 'message': '未找到有效的 JSON 文件'}), 400
 
+    # 是否追加到现有数据集
+    append = request.form.get('append', '').lower() in ('1', 'true', 'yes', 'on')
+
     task_id = str(uuid.uuid4())
     upload_dir = os.path.join('uploads', f'task_{task_id}')
     try:
@@ -985,13 +3504,13 @@ def start_processing():
          logging.error(f"无法创建上传目录 {upload_dir}: {e}")
          return jsonify({'status': 'error', 'message': '无法创建上传目录'}), 500
 
-    file_paths = []
+    file_paths, file_hashes = [], []
     for file in json_files:
         filename = os.path.basename(file.filename)
         if not filename: continue
         file_path = os.path.join(upload_dir, filename)
         try:
-            file.save(file_path)
+            file_hashes.append(save_upload(file, file_path))  # 保存时计算内容哈希，用于导入缓存和重复上传检测
             file_paths.append(file_path)
         except Exception as e:
             logging.error(f"保存文件失败 {filename}: {e}")
@@ -1003,12 +3522,13 @@ def start_processing():
     processing_tasks[task_id] = {
         'status': 'queued', 'task_id': task_id, 'total_files': len(file_paths),
         'processed_files': 0, 'success_files': 0, 'failed_files': 0,
-        'current_batch': 0, 'total_batches': 0,
+        'current_batch': 0, 'total_batches': 0, 'append': append,
         'start_time': datetime.datetime.now().isoformat()
     }
 
     # 后台线程处理
-    thread = threading.Thread(target=process_files_async, args=(task_id, file_paths))
+    thread = threading.Thread(target=process_files_async, args=(task_id, file_paths),
+                              kwargs={'append': append, 'file_hashes': file_hashes})
     thread.daemon = True
     thread.start()
     logging.info(f"任务 {task_id}: 为 {len(file_paths)} 个文件启动了后台线程。")
@@ -1037,6 +3557,8 @@ def get_task_status(task_id):
         'progress': round(progress, 2),
         'error': task.get('error', ''),
         'batch_errors': task.get('batch_errors', []),
+        'append': task.get('append', False),
+        'reused': task.get('reused', False),
         'start_time': task.get('start_time', None)
     }
     return jsonify(response)
@@ -1052,31 +3574,16 @@ def get_wechat_contacts(): return jsonify(app_data.get('wechat_contacts', []))
 def get_wechat_groups(): return jsonify(app_data.get('wechat_groups', []))
 @app.route('/api/messages')
 def get_messages():
-    # 按时间降序排列分页的消息列表，
+    # 按时间降序排列分页的消息列表，只组装当前页的消息
     page = request.args.get('page', 1, type=int)
     page_size = request.args.get('page_size', 50, type=int)
-    all_messages = app_data.get('messages', [])
-    total = len(all_messages)
-    messages_with_dt = []
-    for msg in all_messages:
-        msg_copy = msg.copy()
-        dt_obj = None
-        time_val = msg_copy.get('time')
-        if time_val:
-             try:
-                 if isinstance(time_val, (int, float)): dt_obj = pd.to_datetime(time_val, unit='s', errors='coerce')
-                 else: dt_obj = pd.to_datetime(time_val, errors='coerce')
-             except Exception: dt_obj = None 
-        msg_copy['_datetime'] = dt_obj if pd.notna(dt_obj) else datetime.datetime.min
-        messages_with_dt.append(msg_copy)
-
-    sorted_messages = sorted(messages_with_dt, key=lambda x: x['_datetime'], reverse=True)
-    for msg in sorted_messages: del msg['_datetime']
+    store = app_data['messages']
+    total = len(store)
 
     # 分页
-    start_idx = (page - 1) * page_size
-    end_idx = page * page_size
-    paged_messages = sorted_messages[start_idx:end_idx]
+    start_idx = max(0, (page - 1) * page_size)
+    end_idx = max(start_idx, page * page_size)
+    paged_messages = store.records(store.time_order()[start_idx:end_idx])
     return jsonify({
         'messages': paged_messages, 'page': page, 'page_size': page_size, 'total': total,
         'total_pages': (total + page_size - 1) // page_size if page_size > 0 else 0
@@ -1119,26 +3626,36 @@ def search():
     if not query:
         return jsonify({'results': [], 'page': page, 'page_size': page_size, 'total': 0, 'total_pages': 0, 'search_type': search_type, 'query': query})
 
-    # 初始化搜索引擎——显示前500条结果
-    results = []
-    if search_type == 'sender': results = search_engine.search_by_sender(query, top_n=500)
-    elif search_type == 'keyword': results = search_engine.keyword_search(query, top_n=500)
-    elif search_type == 'semantic': results = search_engine.semantic_search(query, top_n=500)
-    else: results = search_engine.combined_search(query, top_n=500)
-    results = results or []
-
-    # 格式化结果 (高亮, 上下文, 收藏状态)
-    formatted_results = []
-    seen_ids = set() 
-    favorite_ids = {(fav['type'], str(fav['id'])) for fav in app_data.get('favorites', [])} # 快速查找收藏项
+    start_idx = max(0, (page - 1) * page_size)
+    end_idx = max(start_idx, page * page_size)
+    if search_type == 'sender':
+        # 发送者搜索：倒排行号已按时间排好，直接对全部结果分页
+        engine = search_engine
+        rows = engine.sender_rows(query)
+        total_results = len(rows)
+        page_hits = [(int(row), 1.0, 'sender') for row in rows[start_idx:end_idx]]
+    else:
+        # 1. 排序（前500条，去重）：先查缓存；先取代数再取引擎，缓存的结果不会比键里的代数更旧
+        cache_key = search_cache.make_key(query, search_type, dataset_generation)
+        engine = search_engine
+        hits = search_cache.get(cache_key)
+        if hits is None:
+            try:
+                hits = engine.unique_hits(engine.ranked_search(query, search_type, top_n=SEARCH_RESULT_LIMIT))
+            except ValueError as e: # 正则无效等查询错误
+                return jsonify({'error': str(e)}), 400
+            search_cache.put(cache_key, hits)
+
+        # 2. 分页
+        total_results = len(hits)
+        page_hits = hits[start_idx:end_idx]
 
-    for result in results:
-        if not isinstance(result, dict): continue 
-        result_key = f"{result.get('type', 'unknown')}_{result.get('id', 'no_id')}"
-        if result_key in seen_ids: continue # 跳过重复项
-        seen_ids.add(result_key)
+    # 3. 只对当前页组装结果 (高亮, 上下文, 收藏状态)；context_size=0 时由前端按需请求上下文
+    paged_results = []
+    favorite_ids = {(fav['type'], str(fav['id'])) for fav in app_data.get('favorites', [])} # 快速查找收藏项
+    highlight = engine.highlighter(query, search_type).highlight # 查询只编译一次，整页共用
 
-        formatted_result_data = result.copy()
+    for formatted_result_data in engine.materialize(page_hits):
         item_type = formatted_result_data.get('type')
         item_id = str(formatted_result_data.get('id', ''))
 
@@ -1149,41 +3666,38 @@ def search():
         highlight_source = None 
         if item_type == 'message' and 'content' in formatted_result_data:
             original_content = str(formatted_result_data['content'] or '')
-            formatted_result_data['highlighted_content'] = search_engine.highlight_matches(original_content, query)
+            formatted_result_data['highlighted_content'] = highlight(original_content)
             highlight_source = 'content'
             if context_size > 0 and item_id:
-                context_messages = search_engine.find_conversation_context(item_id, window_size=context_size)
+                context_messages = engine.find_conversation_context(item_id, window_size=context_size)
                 # 上下文消息也高亮
                 for ctx_msg in context_messages:
                     if 'content' in ctx_msg:
-                        ctx_msg['highlighted_content'] = search_engine.highlight_matches(str(ctx_msg['content'] or ''), query)
+                        ctx_msg['highlighted_content'] = highlight(str(ctx_msg['content'] or ''))
                 formatted_result_data['conversation_context'] = context_messages
         elif item_type == 'contact' and 'name' in formatted_result_data:
-            if 'name' in formatted_result_data: formatted_result_data['highlighted_name'] = search_engine.highlight_matches(str(formatted_result_data['name'] or ''), query)
-            if 'phone' in formatted_result_data: formatted_result_data['highlighted_phone'] = search_engine.highlight_matches(str(formatted_result_data['phone'] or ''), query)
+            if 'name' in formatted_result_data: formatted_result_data['highlighted_name'] = highlight(str(formatted_result_data['name'] or ''))
+            if 'phone' in formatted_result_data: formatted_result_data['highlighted_phone'] = highlight(str(formatted_result_data['phone'] or ''))
             highlight_source = 'name/phone'
         elif item_type == 'wechat_group' and 'group_name' in formatted_result_data:
-            if 'group_name' in formatted_result_data: formatted_result_data['highlighted_group_name'] = search_engine.highlight_matches(str(formatted_result_data['group_name'] or ''), query)
-            if 'announcement' in formatted_result_data: formatted_result_data['highlighted_announcement'] = search_engine.highlight_matches(str(formatted_result_data.get('announcement','')), query)
+            if 'group_name' in formatted_result_data: formatted_result_data['highlighted_group_name'] = highlight(str(formatted_result_data['group_name'] or ''))
+            if 'announcement' in formatted_result_data: formatted_result_data['highlighted_announcement'] = highlight(str(formatted_result_data.get('announcement','')))
             highlight_source = 'group_name/announcement'
         elif item_type == 'wechat_contact':
-             if 'nickname' in formatted_result_data: formatted_result_data['highlighted_nickname'] = search_engine.highlight_matches(str(formatted_result_data['nickname'] or ''), query)
-             if 'remark' in formatted_result_data: formatted_result_data['highlighted_remark'] = search_engine.highlight_matches(str(formatted_result_data['remark'] or ''), query)
-             if 'phone' in formatted_result_data: formatted_result_data['highlighted_phone'] = search_engine.highlight_matches(str(formatted_result_data.get('phone','')), query)
+             if 'nickname' in formatted_result_data: formatted_result_data['highlighted_nickname'] = highlight(str(formatted_result_data['nickname'] or ''))
+             if 'remark' in formatted_result_data: formatted_result_data['highlighted_remark'] = highlight(str(formatted_result_data['remark'] or ''))
+             if 'phone' in formatted_result_data: formatted_result_data['highlighted_phone'] = highlight(str(formatted_result_data.get('phone','')))
              highlight_source = 'wechat_contact'
+        elif item_type == 'call_record':
+            formatted_result_data['highlighted_phone'] = highlight(str(formatted_result_data.get('phone') or ''))
+            highlight_source = 'phone'
 
-        formatted_results.append({
+        paged_results.append({
             'score': formatted_result_data.get('score', 0),
             'data': formatted_result_data,
             'highlight_source': highlight_source
         })
 
-    # 分页
-    total_results = len(formatted_results)
-    start_idx = (page - 1) * page_size
-    end_idx = page * page_size
-    paged_results = formatted_results[start_idx:end_idx]
-
     return jsonify({
         'results': paged_results, 'page': page, 'page_size': page_size, 'total': total_results,
         'total_pages': (total_results + page_size - 1) // page_size if page_size > 0 else 1,
@@ -1192,7 +3706,7 @@ def search():
 
 @app.route('/api/conversation-context')
 def get_conversation_context():
-    # 上下文对话
+    # 上下文对话；带 direction 参数时为游标模式，从 message_id 向后/向前翻阅整个会话
     global search_engine
     if search_engine is None:
         return jsonify({'error': '搜索引擎未初始化。'}), 503
@@ -1200,18 +3714,47 @@ def get_conversation_context():
     message_id = request.args.get('message_id', '')
     context_size = request.args.get('context_size', 3, type=int)
     query = request.args.get('q', '') 
+    direction = request.args.get('direction', '')
+    limit = request.args.get('limit', 50, type=int)
 
     if not message_id:
         return jsonify({'context': [], 'error': '缺少 message_id'}), 400
-
-    context_messages = search_engine.find_conversation_context(message_id, window_size=context_size)
+    if direction and direction not in ('forward', 'backward'):
+        return jsonify({'context': [], 'error': 'direction 只能是 forward 或 backward'}), 400
+
+    response = {}
+    if direction:
+        context_messages, has_more = search_engine.conversation_page(message_id, direction, limit)
+        # 下一页的游标：向后翻取最后一条，向前翻取最早一条
+        cursor_message = context_messages[-1 if direction == 'forward' else 0] if context_messages else None
+        response.update({'direction': direction, 'has_more': has_more,
+                         'next_cursor': cursor_message['id'] if cursor_message else None})
+    else:
+        context_messages = search_engine.find_conversation_context(message_id, window_size=context_size)
 
     if query: 
+        highlight = search_engine.highlighter(query).highlight
         for msg in context_messages:
             if 'content' in msg:
-                msg['highlighted_content'] = search_engine.highlight_matches(str(msg['content'] or ''), query)
+                msg['highlighted_content'] = highlight(str(msg['content'] or ''))
+
+    response['context'] = context_messages
+    return jsonify(response)
+
+@app.route('/api/token-cache-stats')
+def get_token_cache_stats():
+    # 分词缓存命中统计
+    return jsonify(token_cache.stats())
+
+@app.route('/api/search-cache-stats')
+def get_search_cache_stats():
+    # 搜索结果缓存命中统计
+    return jsonify(search_cache.stats())
 
-    return jsonify({'context': context_messages})
+@app.route('/api/ingest-cache-stats')
+def get_ingest_cache_stats():
+    # 导入缓存命中统计
+    return jsonify(ingest_cache.stats())
 
 @app.route('/api/analyze-conversation')
 def analyze_conversation():
@@ -1299,10 +3842,11 @@ def get_favorites():
     not_found_count = 0 # 记录未找到的收藏
 
     # 查找映射表（if数据量巨大，可以考虑优化）
-    message_map = {str(msg.get('id')): msg for msg in app_data.get('messages', []) if msg.get('id')}
+    message_store = app_data['messages'] # 消息按 ID 哈希查找，不建映射表
     contact_map = {str(con.get('id')): con for con in app_data.get('contacts', []) if con.get('id')}
     group_map = {str(grp.get('group_id')): grp for grp in app_data.get('wechat_groups', []) if grp.get('group_id')}
     wx_contact_map = {str(wxc.get('wechat_id')): wxc for wxc in app_data.get('wechat_contacts', []) if wxc.get('wechat_id')}
+    call_record_map = {str(rec.get('id')): rec for rec in app_data.get('call_records', []) if rec.get('id')}
 
     # traverse收藏项信息
     for fav_info in favorite_ids_with_query:
@@ -1312,10 +3856,13 @@ def get_favorites():
 
         found_item = None
         try:
-            if item_type == 'message': found_item = message_map.get(item_id)
+            if item_type == 'message':
+                row = message_store.find(item_id)
+                found_item = message_store.record(row) if row is not None else None
             elif item_type == 'contact': found_item = contact_map.get(item_id)
             elif item_type == 'wechat_group': found_item = group_map.get(item_id)
             elif item_type == 'wechat_contact': found_item = wx_contact_map.get(item_id)
+            elif item_type == 'call_record': found_item = call_record_map.get(item_id)
             # 添加其他类型的查找
 
             if found_item:
@@ -1356,6 +3903,7 @@ if __name__ == '__main__':
         logging.error(f"创建目录失败: {e}")
 
     load_persistent_data()
+    load_index_snapshot()
 
     # 初始化搜索引擎
     if search_engine is None:
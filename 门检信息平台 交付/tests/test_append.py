@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+from main import EnhancedSearch, MessageStore  # noqa: E402
+
+MESSAGES = [{'id': f'm{i}', 'sender': '张三', 'content': f'今天下午开会 {i}', 'time': f'2023-01-0{i + 1} 10:00:00',
+             'is_sent': False, 'source_file': 'a.json'} for i in range(5)]
+
+
+def test_appended_leaves_published_engine_unchanged():
+    # 追加在新存储和引擎副本上进行，旧引擎的行数、词表和结果不变
+    engine = EnhancedSearch()
+    engine.load_data(MessageStore.from_records(MESSAGES), [], [], [])
+    rows, vocabulary = len(engine.messages), dict(engine.vocabulary)
+    new = MessageStore.from_records([dict(MESSAGES[0], id='m9', sender='李四', content='明天出差')])
+    appended = engine.appended(engine.messages.extended(new), [{'id': 'c1', 'name': '王五'}], [], [])
+    assert len(engine.messages) == rows and engine.vocabulary == vocabulary
+    assert not engine.keyword_search('出差')
+    assert len(appended.messages) == rows + 1
+    assert [r['id'] for r in appended.keyword_search('出差')] == ['m9']
+    assert len(appended.keyword_search('开会')) == len(engine.keyword_search('开会'))
+
+
+WORDS = ['开会', '出差', '报销', '合同', '客户', '项目', '预算', '会议室', '周报', '培训']
+
+
+@pytest.mark.parametrize('growth', [0, 100])
+def test_lsa_finds_terms_first_seen_in_appended_data(monkeypatch, growth):
+    # 新词较多时重新训练 LSA；未重新训练时，含新词的查询改用 TF-IDF 检索
+    monkeypatch.setattr(main, 'LSA_REBUILD_VOCAB_GROWTH', growth)
+    messages = [dict(MESSAGES[0], id=f'm{i}', content=f'{WORDS[i % 10]} {WORDS[i * 3 % 10]} {i}') for i in range(40)]
+    engine = EnhancedSearch(semantic_backend='lsa')
+    engine.load_data(MessageStore.from_records(messages), [], [], [])
+    trained = engine.lsa_index
+    new = MessageStore.from_records([dict(MESSAGES[0], id='new', content='小李 明天 出差')])
+    appended = engine.appended(engine.messages.extended(new), [], [], [])
+    assert (appended.lsa_index.num_terms == appended.tfidf_matrix.shape[1]) == (growth == 0)
+    assert 'new' in [r['id'] for r in appended.semantic_search('小李')]
+    assert engine.lsa_index is trained
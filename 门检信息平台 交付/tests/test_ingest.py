@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+from main import EnhancedSearch, IngestCache, process_file  # noqa: E402
+
+
+def test_content_ids_stable_and_unique_within_file(tmp_path):
+    # 没有 ID 的重复条目在同一文件中各有不同 ID，重新导入后 ID 不变
+    path = tmp_path / 'dup.json'
+    path.write_text(json.dumps({'type': 1, 'contents': [{'content': '你好', 'time': '2023-01-01 10:00:00'}] * 3
+                                + [{'content': '再见'}]}, ensure_ascii=False), encoding='utf-8')
+    first = [message['id'] for message in process_file(str(path))['messages']]
+    second = [message['id'] for message in process_file(str(path))['messages']]
+    assert first == second
+    assert len(set(first)) == 4
+
+
+def test_ingest_cache_evicts_least_recently_used(tmp_path):
+    cache = IngestCache(str(tmp_path / 'cache'), max_bytes=0)
+    path = str(tmp_path / 'a.json')
+    cache.put('a' * 32, path, {'contacts': [{'id': 1}]})
+    os.utime(cache._path('a' * 32), (1, 1))  # 最久未使用
+    cache.max_bytes = os.path.getsize(cache._path('a' * 32)) * 2
+    cache.put('b' * 32, path, {'contacts': [{'id': 2}]})
+    assert cache.get('a' * 32, path) is not None  # 未超出上限，不删除，命中后成为最近使用
+    os.utime(cache._path('b' * 32), (2, 2))
+    cache.put('c' * 32, path, {'contacts': [{'id': 3}]})
+    assert cache.get('b' * 32, path) is None
+    assert cache.get('a' * 32, path) == {'contacts': [{'id': 1}]}
+    assert cache.get('c' * 32, path) == {'contacts': [{'id': 3}]}
+    assert cache.stats()['entries'] == 2
+
+
+def test_full_reload_clears_registered_kinds_missing_from_upload(tmp_path, monkeypatch):
+    # 全量重新导入时，新上传中没有的注册记录类型不保留旧数据
+    monkeypatch.setitem(main.RECORD_KINDS, 'browser_history', (lambda data, labels: False, lambda data, file_path: []))
+    monkeypatch.setattr(main, 'INDEX_SNAPSHOT_DIR', str(tmp_path / 'index_snapshot'))
+    monkeypatch.setattr(main, 'ingest_cache', IngestCache(str(tmp_path / 'cache')))
+    monkeypatch.setattr(main, 'search_engine', EnhancedSearch())
+    monkeypatch.setattr(main, 'app_data', dict(main.app_data, browser_history=[{'url': 'https://example.com'}]))
+    path = tmp_path / 'chat.json'
+    path.write_text(json.dumps({'type': 1, 'contents': [{'id': 'm1', 'content': '你好'}]}, ensure_ascii=False),
+                    encoding='utf-8')
+    monkeypatch.setitem(main.processing_tasks, 't1', {'processed_files': 0, 'success_files': 0, 'failed_files': 0})
+    main.process_files_async('t1', [str(path)])
+    assert main.processing_tasks['t1']['status'] == 'completed'
+    assert len(main.app_data['messages']) == 1
+    assert main.app_data['browser_history'] == []
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import STREAM_READ_BYTES, JsonRecordStream, iter_json_records  # noqa: E402
+
+DOCUMENT = '{"type": 1, "parents": [["微信"]], "contents": [1.5, 2e10, -3.25E-2, 40, {"id": "m1"}, 6.0]}'
+EXPECTED = [1.5, 2e10, -3.25E-2, 40, {'id': 'm1'}, 6.0]
+
+
+def streamed_contents(chunks):
+    return [entry for data in JsonRecordStream(iter(chunks)) for entry in data['contents']]
+
+
+@pytest.mark.parametrize('split', range(1, len(DOCUMENT)))
+def test_entries_split_at_any_block_boundary(split):
+    # 任意位置切分（包括数字中 "." / "e" 之后）都应得到相同结果
+    assert streamed_contents([DOCUMENT[:split], DOCUMENT[split:]]) == EXPECTED
+
+
+def test_number_across_read_block_boundary(tmp_path):
+    # 真实块大小下，数字在 "." 之后被块边界截断
+    prefix = '{"type": 1, "contents": ['
+    padding = ' ' * (STREAM_READ_BYTES - len(prefix) - len('1.'))
+    path = tmp_path / 'export.json'
+    path.write_text(prefix + padding + '1.5, 2]}', encoding='utf-8')
+    records = list(iter_json_records(str(path), 'utf-8'))
+    assert [entry for data in records for entry in data['contents']] == [1.5, 2]
+    assert json.loads(path.read_text(encoding='utf-8'))['contents'] == [1.5, 2]
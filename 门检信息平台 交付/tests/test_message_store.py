@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import MessageStore  # noqa: E402
+
+SENDERS = ['Zhang San', 'zhang  san', 'Li Si', '张三', 'san zhang']
+
+
+@pytest.mark.parametrize('pattern', ['zhang san', 'Zhang', 'zhang  san', 'an z', '张', 'z.*n', 'S'])
+def test_match_senders_same_as_full_scan(pattern):
+    store = MessageStore.from_records([{'id': str(i), 'sender': name, 'content': '', 'time': '2023-01-01 10:00:00'}
+                                       for i, name in enumerate(SENDERS)])
+    store.sender_index()
+    expected = [i for i, name in enumerate(store.senders) if re.search(pattern, name, re.IGNORECASE)]
+    assert store.match_senders(pattern) == expected
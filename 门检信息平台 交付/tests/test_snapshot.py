@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import gc
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+from main import EnhancedSearch, MessageStore  # noqa: E402
+
+MESSAGES = [{'id': f'm{i}', 'sender': '张三', 'content': f'今天下午开会 {i}', 'time': f'2023-01-0{i + 1} 10:00:00',
+             'is_sent': False, 'source_file': 'a.json'} for i in range(5)]
+
+
+def versions(path):
+    return sorted(name for name in os.listdir(path) if name != EnhancedSearch.SNAPSHOT_POINTER)
+
+
+def test_save_over_loaded_snapshot_keeps_mapped_version(tmp_path):
+    path = str(tmp_path / 'index_snapshot')
+    engine = EnhancedSearch()
+    engine.load_data(MESSAGES, [], [], [])
+    engine.save_snapshot(path)
+    first = EnhancedSearch.snapshot_path(path)
+
+    # 加载后的引擎内存映射着第一个版本：再次保存时换到新版本目录，旧目录保留
+    loaded, _ = EnhancedSearch.load_snapshot(path)
+    loaded.save_snapshot(path)
+    second = EnhancedSearch.snapshot_path(path)
+    assert second != first
+    assert versions(path) == sorted([os.path.basename(first), os.path.basename(second)])
+    assert loaded.keyword_search('开会')
+
+    # 映射释放后，下次保存时删除旧版本
+    reloaded, _ = EnhancedSearch.load_snapshot(path)
+    del loaded
+    gc.collect()
+    reloaded.save_snapshot(path)
+    assert os.path.basename(first) not in versions(path)
+    assert len(reloaded.keyword_search('开会')) == len(MESSAGES)
+
+
+def test_registered_record_kinds_survive_restart(tmp_path, monkeypatch):
+    # 注册的记录类型随快照保存；快照中缺少某类型时不恢复文件哈希，重新上传会重新解析
+    monkeypatch.setitem(main.RECORD_KINDS, 'browser_history', (lambda data, labels: False, lambda data, file_path: []))
+    monkeypatch.setattr(main, 'INDEX_SNAPSHOT_DIR', str(tmp_path / 'index_snapshot'))
+    engine = EnhancedSearch()
+    engine.load_data(MessageStore.from_records(MESSAGES), [], [], [])
+    monkeypatch.setattr(main, 'search_engine', engine)
+    monkeypatch.setattr(main, 'app_data', dict(main.app_data, browser_history=[{'url': 'https://example.com'}],
+                                               source_hashes=['h1'], messages=engine.messages))
+    main.save_index_snapshot()
+
+    monkeypatch.setattr(main, 'app_data', dict(main.app_data, browser_history=[], source_hashes=[]))
+    assert main.load_index_snapshot()
+    assert main.app_data['browser_history'] == [{'url': 'https://example.com'}]
+    assert main.app_data['source_hashes'] == ['h1']
+
+    monkeypatch.setitem(main.RECORD_KINDS, 'sms', (lambda data, labels: False, lambda data, file_path: []))
+    assert main.load_index_snapshot()
+    assert main.app_data['source_hashes'] == []